@@ -0,0 +1,288 @@
+"""Acquisition Schedule
+
+This module reorders a list of requested acquisitions so that the
+spectrometer and stages move as little as possible, then takes them.
+
+Grating turret changes and centre wavelength moves are mechanical and take
+seconds each, so running the acquisitions of a scripted scan in the order
+its loops produce them wastes most of the run moving. MoveCosts estimates
+the time between any two acquisitions from the grating, centre wavelength,
+exposure, LCVR voltage and Zaber position they need. schedule takes every
+acquisition of one grating together, then orders each grating's
+acquisitions as a shortest open path under those costs (a nearest
+neighbour tour refined with 2-opt). run_schedule takes them in that order
+and returns the files, and writes the log, in the original order.
+"""
+
+import collections
+import csv
+import glob
+import os
+from time import sleep
+import numpy as np
+
+Acquisition = collections.namedtuple(
+    'Acquisition', 'grating centre exposure voltage position name',
+    defaults=(None,))
+Acquisition.__doc__ = """One requested acquisition: grating (g/mm), centre
+wavelength (nm), exposure (ms), LCVR voltage (V), Zaber position
+(microsteps) and an optional file name."""
+
+# the instrument settings in the order of the state arrays
+_AXES = ('grating', 'centre', 'exposure', 'voltage', 'position')
+
+
+class MoveCosts:
+    """Estimated time in seconds of the moves between acquisitions.
+
+    Moves are made one after the other, so the time between two
+    acquisitions is the sum of the time of every setting that changes.
+    The defaults are rough figures for our spectrometer and stages and
+    should be replaced by measured ones.
+
+    Parameters
+    ----------
+    grating_change : float
+        Turret rotation to another grating.
+    centre_settle : float
+        Fixed part of a centre wavelength move.
+    centre_speed : float
+        Centre wavelength scan speed in nm/s.
+    exposure_change : float
+        Setting a new exposure time in LightField.
+    lcvr_settle : float
+        Settling of the liquid crystal after a voltage change, also waited
+        by run_schedule.
+    zaber_settle : float
+        Fixed part of a Zaber move.
+    zaber_speed : float
+        Zaber speed in microsteps/s.
+
+    """
+
+    def __init__(self, grating_change=30.0, centre_settle=2.0,
+                 centre_speed=50.0, exposure_change=0.5, lcvr_settle=1.0,
+                 zaber_settle=0.2, zaber_speed=20000.0):
+        self.grating_change = grating_change
+        self.centre_settle = centre_settle
+        self.centre_speed = centre_speed
+        self.exposure_change = exposure_change
+        self.lcvr_settle = lcvr_settle
+        self.zaber_settle = zaber_settle
+        self.zaber_speed = zaber_speed
+
+    def matrix(self, sources, targets):
+        """Returns the (sources, targets) move times between two lists of
+        acquisitions. Unknown (None) source settings always cost the
+        fixed part of their move."""
+        a = _states(sources)[:, np.newaxis]
+        b = _states(targets)[np.newaxis]
+        with np.errstate(invalid='ignore'):
+            changed = ~(a == b)
+            distance = np.nan_to_num(np.abs(a - b))
+        (grating, centre, exposure, voltage, position) = range(len(_AXES))
+        return (changed[..., grating] * self.grating_change
+                + changed[..., centre] * (self.centre_settle
+                                          + distance[..., centre]
+                                          / self.centre_speed)
+                + changed[..., exposure] * self.exposure_change
+                + changed[..., voltage] * self.lcvr_settle
+                + changed[..., position] * (self.zaber_settle
+                                            + distance[..., position]
+                                            / self.zaber_speed))
+
+
+def estimate(acquisitions, order=None, costs=None, start=None):
+    """Returns the total estimated move time in seconds of taking the
+    acquisitions in order (the given order by default), starting from the
+    start acquisition's settings if known."""
+    costs = costs or MoveCosts()
+    order = range(len(acquisitions)) if order is None else order
+    path = [acquisitions[i] for i in order]
+    if not path:
+        return 0.0
+    total = 0.0 if start is None else float(costs.matrix([start],
+                                                         path[:1])[0, 0])
+    if len(path) > 1:
+        steps = costs.matrix(path[:-1], path[1:])
+        total += float(np.trace(steps))
+    return total
+
+
+def schedule(acquisitions, costs=None, start=None, passes=20):
+    """Returns the order to take the acquisitions in.
+
+    The grating of the start settings is used first and the others follow
+    in increasing groove density, every grating is visited once.
+
+    Parameters
+    ----------
+    acquisitions : list of Acquisition
+        The requested acquisitions.
+    costs : MoveCosts, optional
+        The cost model, default figures otherwise.
+    start : Acquisition, optional
+        The current settings of the instruments.
+    passes : int
+        Largest number of 2-opt passes over each grating's path.
+
+    Returns
+    -------
+    list of int
+        Indices into acquisitions in the order they should be taken.
+
+    """
+    costs = costs or MoveCosts()
+    gratings = sorted({a.grating for a in acquisitions},
+                      key=lambda g: (start is None or g != start.grating, g))
+    order = []
+    state = start
+    for grating in gratings:
+        group = [i for i, a in enumerate(acquisitions) if a.grating == grating]
+        nodes = [acquisitions[i] for i in group]
+        if state is not None:
+            nodes = [state] + nodes
+        cost = costs.matrix(nodes, nodes)
+        path = _nearest_neighbour(cost, fixed=state is not None)
+        path = _two_opt(cost, path, passes)
+        if state is not None:
+            path = [p - 1 for p in path[1:]]
+        order.extend(group[p] for p in path)
+        state = acquisitions[order[-1]]
+    return order
+
+
+def run_schedule(acquisitions, lf, directory, lcvr=None, zaber=None,
+                 channel=1, order=None, costs=None, start=None, timeout=60,
+                 log=None, stop=None):
+    """Takes the acquisitions in a move minimising order.
+
+    Only the settings that differ from the previous acquisition are sent
+    to the instruments.
+
+    Parameters
+    ----------
+    acquisitions : list of Acquisition
+        The requested acquisitions, in their logical order.
+    lf : pylightfield.LightField
+        The LightField connection.
+    directory : str
+        The directory LightField saves to.
+    lcvr : MeadowlarkD3050Controller, optional
+        Required if any acquisition has a voltage.
+    zaber : ZaberLinearActuator, optional
+        Required if any acquisition has a position.
+    channel : int
+        The LCVR channel.
+    order : list of int, optional
+        The order to take them in, schedule(acquisitions, costs, start)
+        by default.
+    costs, start
+        See schedule.
+    timeout : int
+        Acquisition timeout in seconds.
+    log : str, optional
+        CSV file listing every acquisition, its file and the step it was
+        taken at, in the logical order.
+    stop : callable, optional
+        Checked before every acquisition, the run ends when it returns
+        True.
+
+    Returns
+    -------
+    list of str
+        The SPE file of every acquisition in the logical order, None for
+        those not taken.
+
+    """
+    costs = costs or MoveCosts()
+    if order is None:
+        order = schedule(acquisitions, costs, start)
+    lf.set_directory(directory.rstrip("\\"))
+    files = [None] * len(acquisitions)
+    steps = [None] * len(acquisitions)
+    state = start
+    for step, i in enumerate(order):
+        if stop is not None and stop():
+            break
+        acq = acquisitions[i]
+        if state is None or acq.grating != state.grating:
+            lf.set_grating(acq.grating)
+        if state is None or acq.centre != state.centre:
+            lf.set_centerwavelength(acq.centre)
+        if state is None or acq.exposure != state.exposure:
+            lf.set_exposure(acq.exposure)
+        if acq.voltage is not None and (state is None
+                                        or acq.voltage != state.voltage):
+            lcvr.set_voltage(channel, acq.voltage)
+            sleep(costs.lcvr_settle)
+        if acq.position is not None and (state is None
+                                         or acq.position != state.position):
+            zaber.goto_pos(0, int(acq.position))
+        lf.set_filename(acq.name or "acq_%04d" % i)
+        lf.acquire(timeout)
+        files[i] = max(glob.iglob(os.path.join(directory, '*.spe')),
+                       key=os.path.getctime)
+        steps[i] = step
+        state = acq
+    if log is not None:
+        with open(log, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('index',) + Acquisition._fields
+                            + ('file', 'step'))
+            for i, acq in enumerate(acquisitions):
+                writer.writerow((i,) + tuple(acq) + (files[i], steps[i]))
+    return files
+
+
+def _states(acquisitions):
+    # (acquisitions, axes) float array of the settings, NaN if unknown
+    states = [[np.nan if getattr(a, name) is None else getattr(a, name)
+               for name in _AXES] for a in acquisitions]
+    return np.array(states, dtype=np.float64).reshape(-1, len(_AXES))
+
+
+def _nearest_neighbour(cost, fixed):
+    # open path visiting every node, from node 0 if fixed, otherwise from
+    # the node whose nearest neighbour is furthest (an end of the path)
+    n = cost.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    if fixed:
+        current = 0
+    else:
+        others = cost + np.diag(np.full(n, np.inf))
+        current = int(np.argmax(others.min(axis=1))) if n > 1 else 0
+    path = [current]
+    visited[current] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, cost[current])
+        current = int(np.argmin(row))
+        path.append(current)
+        visited[current] = True
+    return path
+
+
+def _two_opt(cost, path, passes):
+    # reverse path[i + 1:j + 1] while that shortens the open path, the
+    # first node stays in place
+    path = np.array(path)
+    n = path.size
+    for _ in range(passes):
+        improved = False
+        for i in range(n - 2):
+            a = path[i]
+            b = path[i + 1]
+            js = np.arange(i + 2, n)
+            c = path[js]
+            delta = cost[a, c] - cost[a, b]
+            inner = js < n - 1
+            after = path[js[inner] + 1]
+            delta[inner] += cost[b, after] - cost[c[inner], after]
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                j = js[k]
+                path[i + 1:j + 1] = path[i + 1:j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return path.tolist()
@@ -4,74 +4,132 @@ import _thread
 import glob
 import os
 from time import sleep
+import power_analysis
+import scan_params
 
 class AnalysisGUI(wx.Frame):
 
-    def __init__(self, Parent=None, title="QuIN Lab Analysis"):
+    def __init__(self, parent=None, title="QuIN Lab Analysis"):
         super(AnalysisGUI, self).__init__(parent, title=title, size=(1000,1000))  #NEED TO ADD SIZE MAYBE
         self._load_files = []
         self._save_files = []
-        
+        self._results = None
+
         self._main_panel = wx.Panel(self)
-        self._main_sizer = wx.BoxSizer(wx.Vertical)
-        
+        self._main_sizer = wx.BoxSizer(wx.VERTICAL)
+
         # Section 1 GUI Parts
         panel1 = wx.Panel(self._main_panel)
-        panel1_sizer = wx.BoxSizer(wx.Horizontal)
-        
+        panel1_sizer = wx.BoxSizer(wx.HORIZONTAL)
+
         self._files_button = wx.Button(
             panel1, label="Select Files", size=(-1, 20), style=wx.ALIGN_LEFT)
-        
+
         power_text = wx.StaticText(
-            panel1, label="Power Dependent: ", 
+            panel1, label="Power Dependent: ",
             size=(-1, 20), style=wx.ALIGN_RIGHT)
         self._power_check = wx.CheckBox(panel1)
-        
+
         self._load_button = wx.Button(
             panel1, label="Load", size=(-1, 20), style=wx.ALIGN_RIGHT)
-        
+
         self._files_button.Bind(wx.EVT_BUTTON, self._file_select)
         self._load_button.Bind(wx.EVT_BUTTON, self._load)
-        
+
         panel1_sizer.Add(self._files_button, 0, wx.ALL, 0)
         panel1_sizer.Add(power_text, 0, wx.ALL, 0)
         panel1_sizer.Add(self._power_check, 0, wx.ALL, 0)
-        panel1_sizer.Add(self._files_button, 0, wx.ALL, 0)
-        panel1_sizer.Addd(self._load_button, 0, wx.ALL, 0)
+        panel1_sizer.Add(self._load_button, 0, wx.ALL, 0)
         panel1.SetSizer(panel1_sizer)
-        
+
+        # Section 2 GUI Parts
+        self._results_text = wx.StaticText(
+            self._main_panel, label="", size=(980, 900))
+
         # Finishing Main Panel
         self._main_sizer.Add(panel1, 0, wx.ALL, 0)
-        self._main_panel.SetSizer(panel1)
+        self._main_sizer.Add(self._results_text, 0, wx.ALL, 5)
+        self._main_panel.SetSizer(self._main_sizer)
         self._main_panel.Layout()
         self.Show()
-        
-        
+
+
     def _file_select(self, evt):
         file_dialog = wx.FileDialog(
-            self, "Choose Files to Load", 
+            self, "Choose Files to Load",
             style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST | wx.FD_MULTIPLE)
         if file_dialog.ShowModal() == wx.ID_CANCEL:
             return
         self._load_files = file_dialog.GetPaths()
         file_dialog.Destroy()
         evt.Skip()
-        
+
     def _load(self, evt):
+        if not self._load_files:
+            return
         self._load_button.Disable()
+        self._results_text.SetLabel("Analysing %d files..."
+                                    % len(self._load_files))
         if self._power_check.IsChecked():
-            _load_power()
-            evt.Skip()
-        _load_normal()
+            _thread.start_new_thread(self._load_power, ())
+        else:
+            _thread.start_new_thread(self._load_normal, ())
         evt.Skip()
-        
-    def _load_normal():
-        return
-    
-    def _load_power():
-        return
-        
-    if __name__ == '__main__':
-        app = wx.App(redirect=True)
-        GUI = AnalysisGUI()
-        app.MainLoop()
+
+    def _load_normal(self):
+        self._analyse(power=False)
+
+    def _load_power(self):
+        self._analyse(power=True)
+
+    def _analyse(self, power):
+        try:
+            # the PowerDependentGUI keeps the power of a run fixed and
+            # sweeps the LCVR voltage instead
+            powers = {scan_params.parse_scan_filename(file)['power']
+                      for file in self._load_files}
+            axis = 'power' if len(powers) > 1 else 'voltage'
+            self._results = power_analysis.analyse_series(
+                self._load_files, power=power, workers=os.cpu_count() or 1,
+                axis=axis)
+            first = self._load_files[0]
+            csv_filename = os.path.splitext(first)[0] + '_analysis.csv'
+            power_analysis.save_csv(self._results, csv_filename)
+            self._save_files = [csv_filename]
+            summary = self._summary(self._results, csv_filename)
+        except Exception as err:
+            summary = "Analysis failed: %s" % err
+        wx.CallAfter(self._results_text.SetLabel, summary)
+        wx.CallAfter(self._load_button.Enable)
+
+    def _summary(self, results, csv_filename):
+        lines = ["Saved %s" % csv_filename, ""]
+        threshold = results.get('threshold')
+        if 'threshold' in results:
+            if threshold is None:
+                lines.append("No threshold found")
+            else:
+                lines.append("Threshold: %.4g %s (log-log slope %.2f)"
+                             % (threshold['excitation'], results['unit'],
+                                threshold['slope']))
+            lines.append("")
+        lines.append("%-12s %-12s %-12s %-12s %-10s"
+                     % ("Power (%s)" % results['unit'], "Intensity", "Peak (eV)",
+                        "FWHM (meV)", "Q"))
+        for i, filename in enumerate(results['filename']):
+            if results['error'][i] is not None:
+                lines.append("%s: %s" % (os.path.basename(filename),
+                                         results['error'][i]))
+                continue
+            lines.append("%-12.4g %-12.4g %-12.6f %-12.4g %-10.1f"
+                         % (results['excitation'][i],
+                            results['intensity'][i],
+                            results['peak_energy'][i],
+                            results['linewidth'][i] * 1000,
+                            results['q'][i]))
+        return "\n".join(lines)
+
+if __name__ == '__main__':
+    app = wx.App(redirect=True)
+    GUI = AnalysisGUI()
+    app.MainLoop()
@@ -0,0 +1,311 @@
+"""Power Series Analysis
+
+This module is the headless engine behind the AnalysisGUI. For a set of
+SPE files it parses the scan parameters from the file names, reads the
+files in a process pool and reduces each to a spectrum, then fits the
+emission peak of all spectra at once with spe_peakfit to give the
+integrated intensity above the fitted offset, the peak energy, linewidth
+and Q of every file.
+
+For power series the files are ordered by their excitation, which is the
+power meter reading in the file name, the LCVR voltage, or the power a
+voltage to power transmission curve gives for it, the log-log
+input/output curve is formed and the lasing threshold is taken where its
+slope peaks. The OD filter named in the file name can sit in the
+excitation path, attenuating the power, or in the detection path,
+attenuating the intensity. Results are cached by the stamps of the input files and the
+analysis settings, so re-opening a series is instant, and the spectra of
+single files can be kept in an spe_cache.ResultCache.
+"""
+
+import csv
+import hashlib
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import spereadNew as sperd
+import spe_background
+import spe_calibration
+import spe_manifest
+import spe_peakfit
+import scan_params
+
+ANALYSIS_CACHE = os.path.join(os.path.expanduser('~'), '.quinlab',
+                              'power_series')
+
+# bump whenever a change to this module alters the results
+ANALYSIS_VERSION = 2
+
+# per file columns, in the order written by save_csv
+COLUMNS = ('filename', 'name', 'od', 'wavelength', 'power', 'voltage',
+           'zaber', 'excitation', 'intensity', 'peak_energy',
+           'peak_energy_err', 'linewidth', 'linewidth_err', 'q', 'error')
+
+
+# OD filter positions
+OD_FILTERS = ('excitation', 'detection', None)
+
+
+def analyse_series(filenames, power=True, workers=1, rows=None, cols=None,
+                   model='lorentzian', background=None, min_slope=1.5,
+                   cache_dir=ANALYSIS_CACHE, result_cache=None,
+                   axis='power', od_filter='detection'):
+    """Analyses a series of SPE files.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The SPE files.
+    power : bool
+        Treat the files as a power series: order them by excitation and
+        look for a threshold. Otherwise they keep the order given.
+    workers : int
+        Number of worker processes reading files, 1 reads in the current
+        process.
+    rows, cols : tuple of int, optional
+        Half open (start, stop) region of interest summed into the
+        spectrum, the whole frame by default.
+    model : str
+        Peak shape, see spe_peakfit.fit_peaks.
+    background : BackgroundEngine, optional
+        Subtract the matching master dark from every file.
+    min_slope : float
+        Smallest log-log slope accepted as a threshold.
+    cache_dir : str, optional
+        Directory of the series result cache, no caching if None.
+    result_cache : ResultCache, optional
+        Cache of the per file spectra, so that series sharing files (or
+        analysed with other peak models) only read the new ones.
+    axis : str, tuple or callable
+        The excitation of every file: 'power' the power meter reading in
+        mW, 'voltage' the LCVR voltage, a (voltages, powers) transmission
+        curve interpolated at the voltage, or a function of the voltage
+        array returning the powers. The PowerDependentGUI keeps the power
+        of a run fixed and sweeps the voltage, so 'power' only suits
+        series whose file names carry the power of each file.
+    od_filter : str or None
+        Position of the OD filter: 'excitation' divides the power by
+        10**od (not allowed with the 'voltage' axis), 'detection'
+        multiplies the intensity by 10**od, None ignores the OD.
+
+    Returns
+    -------
+    dict
+        A column for every name in COLUMNS, one entry per file, the
+        'unit' of the excitation and for power series 'threshold', see
+        find_threshold.
+
+    """
+    if od_filter not in OD_FILTERS:
+        raise Exception("Invalid OD filter position")
+    if axis == 'voltage' and od_filter == 'excitation':
+        raise Exception("An excitation OD filter needs a power axis")
+    filenames = list(filenames)
+    if isinstance(axis, tuple):
+        axis_key = tuple(np.asarray(a, dtype=np.float64).tolist()
+                         for a in axis)
+    else:
+        # a function cannot be told apart from another one in the cache
+        axis_key = axis
+        if callable(axis):
+            cache_dir = None
+    settings = (ANALYSIS_VERSION, power, rows, cols, model, min_slope,
+                axis_key, od_filter,
+                background.stamp() if background is not None else None)
+    cache_file = _cache_file(cache_dir, filenames, settings, not power)
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as file:
+                return pickle.load(file)
+        except Exception:
+            pass
+
+    options = {'rows': rows, 'cols': cols, 'background': background,
+               'cache': result_cache,
+               'params': {'product': 'power_analysis.spectrum',
+                          'version': ANALYSIS_VERSION, 'rows': rows,
+                          'cols': cols, 'background': settings[-1]}}
+    if workers > 1 and len(filenames) > 1:
+        chunksize = max(1, len(filenames) // (workers * 4))
+        with ProcessPoolExecutor(workers) as pool:
+            reduced = list(pool.map(_reduce_file, filenames,
+                                    [options] * len(filenames),
+                                    chunksize=chunksize))
+    else:
+        reduced = [_reduce_file(file, options) for file in filenames]
+
+    count = len(filenames)
+    result = {name: np.full(count, np.nan) for name in COLUMNS}
+    result['filename'] = filenames
+    result['error'] = [error for _, error in reduced]
+    params = [scan_params.parse_scan_filename(file) for file in filenames]
+    result['name'] = [p['name'] for p in params]
+    for key in ('od', 'wavelength', 'power', 'voltage', 'zaber'):
+        result[key] = np.array([np.nan if p[key] is None else p[key]
+                                for p in params])
+    _fit_spectra(result, reduced, model)
+    _excitation(result, axis, od_filter)
+
+    if power:
+        order = np.argsort(result['excitation'], kind='stable')
+        for name in COLUMNS:
+            column = result[name]
+            result[name] = (column[order] if isinstance(column, np.ndarray)
+                            else [column[i] for i in order])
+        result['threshold'] = find_threshold(result['excitation'],
+                                             result['intensity'], min_slope)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as file:
+            pickle.dump(result, file)
+        os.replace(cache_file + '.tmp', cache_file)
+    return result
+
+
+def find_threshold(excitation, intensity, min_slope=1.5, window=3):
+    """Finds the threshold of a log-log input/output curve.
+
+    The slope d log(I) / d log(P) is fitted over every run of window
+    neighbouring points, and the threshold is the centre of the steepest
+    run, provided the emission grows at least min_slope times faster than
+    linearly there.
+
+    Returns
+    -------
+    dict or None
+        'excitation' at the threshold (the geometric mean of the steepest
+        run), its 'slope', the 'index' of its first point, and the log10
+        'log_excitation' and 'log_intensity' curve. None if there are
+        fewer than window usable points or no run is steep enough.
+
+    """
+    excitation = np.asarray(excitation, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    use = (excitation > 0) & (intensity > 0)
+    index = np.flatnonzero(use)
+    window = max(2, int(window))
+    if index.size < window:
+        return None
+    log_p = np.log10(excitation[use])
+    log_i = np.log10(intensity[use])
+    runs_p = sliding_window_view(log_p, window)
+    runs_i = sliding_window_view(log_i, window)
+    dp = runs_p - runs_p.mean(axis=1, keepdims=True)
+    di = runs_i - runs_i.mean(axis=1, keepdims=True)
+    spread = (dp**2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(spread > 0, (dp * di).sum(axis=1) / spread, np.nan)
+    if np.all(np.isnan(slope)):
+        return None
+    steepest = int(np.nanargmax(slope))
+    if slope[steepest] < min_slope:
+        return None
+    return {'excitation': float(10**runs_p[steepest].mean()),
+            'slope': float(slope[steepest]),
+            'index': int(index[steepest]),
+            'log_excitation': log_p,
+            'log_intensity': log_i}
+
+
+def save_csv(result, filename):
+    """Writes the per file columns of analyse_series to a csv file."""
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for row in zip(*(result[name] for name in COLUMNS)):
+            writer.writerow(row)
+        threshold = result.get('threshold')
+        if threshold is not None:
+            writer.writerow(['threshold', threshold['excitation'],
+                             'slope', threshold['slope']])
+
+
+def _reduce_file(filename, options):
+    # ((energy axis, mean spectrum, its sum), None) or (None, error)
+    try:
+        cache = options['cache']
+        if cache is None:
+            return _reduce_spe(filename, options), None
+        return cache.get_or_compute(
+            filename, options['params'],
+            lambda: _reduce_spe(filename, options)), None
+    except Exception as err:
+        return None, str(err)
+
+
+def _reduce_spe(filename, options):
+    with sperd.SPEFile(filename) as spe:
+        rows = options['rows']
+        cols = options['cols']
+        roi = spe.read_roi(rows=rows, cols=cols)
+        image = roi.mean(axis=0, dtype=np.float64)
+        background = options['background']
+        if background is not None:
+            master = background.master(spe_background.dark_key(spe))
+            if master is not None and master.shape == (spe.ydim, spe.xdim):
+                (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+                (c0, c1, _) = slice(*(cols or (None,))).indices(spe.xdim)
+                image -= master[r0:r1, c0:c1]
+        wavelength = spe.roi_xaxis(cols)
+    energy = spe_calibration.HC_EV_NM / np.asarray(wavelength)
+    spectrum = image.sum(axis=0)
+    return energy, spectrum, float(spectrum.sum())
+
+
+def _excitation(result, axis, od_filter):
+    # fill the excitation column and correct for the OD filter
+    od = np.nan_to_num(result['od'])
+    if axis == 'power':
+        excitation = result['power'].copy()
+    elif axis == 'voltage':
+        excitation = result['voltage'].copy()
+    elif isinstance(axis, tuple):
+        (voltages, powers) = (np.asarray(a, dtype=np.float64) for a in axis)
+        order = np.argsort(voltages)
+        excitation = np.interp(result['voltage'], voltages[order],
+                               powers[order], left=np.nan, right=np.nan)
+    elif callable(axis):
+        excitation = np.asarray(axis(result['voltage']), dtype=np.float64)
+    else:
+        raise Exception("Invalid excitation axis")
+    if od_filter == 'excitation':
+        excitation *= 10**-od
+    elif od_filter == 'detection':
+        result['intensity'] = result['intensity'] * 10**od
+    result['excitation'] = excitation
+    result['unit'] = 'V' if axis == 'voltage' else 'mW'
+
+
+def _fit_spectra(result, reduced, model):
+    # one batched fit per spectrum length
+    groups = {}
+    for i, (data, _) in enumerate(reduced):
+        if data is not None:
+            groups.setdefault(data[0].size, []).append(i)
+    for index in groups.values():
+        energy = np.stack([reduced[i][0][0] for i in index])
+        spectra = np.stack([reduced[i][0][1] for i in index])
+        fit = spe_peakfit.fit_peaks(energy, spectra, model)
+        result['peak_energy'][index] = fit['center']
+        result['peak_energy_err'][index] = fit['center_err']
+        result['linewidth'][index] = fit['fwhm']
+        result['linewidth_err'][index] = fit['fwhm_err']
+        result['q'][index] = fit['q']
+        # the fitted offset also removes any background left in the data
+        result['intensity'][index] = [reduced[i][0][2] for i in index] \
+            - fit['offset'] * energy.shape[1]
+
+
+def _cache_file(cache_dir, filenames, settings, ordered):
+    # a power series is sorted anyway, so only the set of files matters
+    if cache_dir is None:
+        return None
+    stamps = [spe_manifest.file_stamp(file) for file in filenames]
+    if None in stamps:
+        return None
+    if not ordered:
+        stamps.sort()
+    digest = hashlib.sha1(repr((stamps, settings)).encode())
+    return os.path.join(cache_dir, 'series_%s.pkl' % digest.hexdigest())
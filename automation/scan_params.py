@@ -0,0 +1,49 @@
+"""Scan Filename Parameters
+
+The acquisition GUIs encode the scan settings in the file names they
+write (see SpectroscopyGUI._set_filename and PowerDependentGUI._set_filename):
+
+    <name>_OD<od>_<wavelength>nm_<power>mW_<voltage>V[_<position>zaber...]
+
+This module parses those names back into numbers. The SpectroscopyGUI
+appends one zaber token per position of a sweep, so the last one is the
+position the file was taken at.
+"""
+
+import os
+import re
+
+_NUMBER = r'([-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)'
+_OD = re.compile(r'_OD' + _NUMBER)
+_WAVELENGTH = re.compile(r'_' + _NUMBER + r'nm(?![a-zA-Z])')
+_POWER = re.compile(r'_' + _NUMBER + r'mW(?![a-zA-Z])')
+_VOLTAGE = re.compile(r'_' + _NUMBER + r'V(?![a-zA-Z])')
+_ZABER = re.compile(r'_' + _NUMBER + r'zaber')
+
+
+def parse_scan_filename(filename):
+    """Returns the scan parameters encoded in a file name.
+
+    Parameters
+    ----------
+    filename : str
+        File name or path, with or without extension.
+
+    Returns
+    -------
+    dict
+        'name' (the user part of the name), 'od', 'wavelength' (nm),
+        'power' (mW), 'voltage' (V) and 'zaber' (position) values, None
+        for any that are missing from the name.
+
+    """
+    # the GUIs build windows paths, split on either separator
+    base = os.path.splitext(re.split(r'[\\/]', filename)[-1])[0]
+    params = {'name': base.split('_OD')[0] if '_OD' in base else base}
+    for key, pattern in (('od', _OD), ('wavelength', _WAVELENGTH),
+                         ('power', _POWER), ('voltage', _VOLTAGE)):
+        match = pattern.search(base)
+        params[key] = float(match.group(1)) if match else None
+    zaber = _ZABER.findall(base)
+    params['zaber'] = int(float(zaber[-1])) if zaber else None
+    return params
@@ -1,12 +1,62 @@
+import argparse
 import math
 import glob
-import re
+import os
+import functools
+import collections
 import numpy as np
-import matplotlib.pylab as pylab
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import spereadNew as sperd
+import spe_png
+import spe_manifest
+import spe_background
+import spe_reduce
+import spe_cosmic
+import spe_calibration
 
-def spe2pngFFNew(directory='./'):
+# State of the current (worker) process, set up once by _init_worker
+_settings = None
+_background = None
+_hot_pixels = None
+_figure = None
+
+# bump whenever a change to this module alters the rendered pixels
+RENDERER_VERSION = 4
+
+FarFieldROI = collections.namedtuple(
+    'FarFieldROI', 'xaxis yaxis yk iniIdx endIdx iniy endy')
+
+
+def spe2pngFFNew(directory='./', workers=1, fast=False, incremental=False,
+                 clean=False):
+    """Converts every far field SPE file in directory to a png image.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the SPE files, including the trailing separator.
+    workers : int
+        Number of worker processes, 1 converts in the current process.
+    fast : bool
+        Write only the colour-mapped region of interest with spe_png,
+        without matplotlib axes, labels or title.
+    incremental : bool
+        Only convert files whose png is missing or out of date according
+        to the manifest of the previous runs.
+    clean : bool
+        Repair hot pixels and remove cosmic ray spikes before rendering.
+        The hot pixel mask is built from the background file the first
+        time a detector is seen.
+
+    Returns
+    -------
+    list of tuple
+        (spe filename, png filename, error message) for every file, the
+        png filename is None and the message set if the file failed.
+
+    """
     dirname = directory
     #dirname = '070510/sample/';	#put directory name on top of output filenames
     pl = 770e-7
@@ -22,84 +72,135 @@ def spe2pngFFNew(directory='./'):
     #########################################################
     anglelim = 50
     #klim=math.sin(anglelim*math.pi/180)*(2*math.pi/pl)
-    filenames = glob.glob(dirname + '*.spe') 
-    #filenames = glob.glob('*300gmm.spe') 
-    num_files=len(filenames)
+    settings = {
+        'pl': pl,
+        'Snm': Snm,
+        'Lnm': Lnm,
+        'anglelim': anglelim,
+        'fobj': 4000,                 # objective focal length in um
+        'ypixsize': 20,               # pixel size in um
+        'angle_correction': -0.4,     # shift the center to right
+        'vmin': 100,
+        'fast': fast,
+        'clean': clean,
+        }
+    filenames = glob.glob(dirname + '*.spe')
+    #filenames = glob.glob('*300gmm.spe')
 
     # Acquire the background image
     background_filename = 'back.spe'
-    (background_image,background_xaxis,error_code,message) = sperd.spereadJanis(background_filename)
-    if (error_code == -1):
+    background = spe_background.BackgroundEngine()
+    if os.path.isfile(background_filename):
+        try:
+            background.add_darks([background_filename])
+        except Exception as err:
+            print(err)
+            return [(file, None, str(err)) for file in filenames]
+    else:
         print ('WARNING function spe2png_py: Background file %s not found in'
                ' directory %s.\n' %(background_filename,dirname))
-        background_exists = 0
-    elif (error_code <= 0):
-        print(message)
-        print('error code: %d.\n' %error_code)
-        exit()
+    if clean and os.path.isfile(background_filename):
+        spe_cosmic.HotPixelMask().build([background_filename])
+
+    if incremental:
+        manifest = spe_manifest.ConversionManifest(dirname, 'spe2pngFFNew')
+        params = dict(settings,
+                      background=spe_manifest.file_stamp(background_filename),
+                      renderer=RENDERER_VERSION)
+        if clean:
+            # rebuilt hot pixel masks or a new spike test re-render too
+            params.update(hot_pixels=spe_cosmic.HotPixelMask().stamp(),
+                          cosmic=spe_cosmic.COSMIC_VERSION)
+        filenames = [file for file in filenames
+                     if manifest.is_stale(file, params)]
+
+    if workers > 1 and len(filenames) > 1:
+        chunksize = max(1, len(filenames) // (workers * 4))
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(settings, background)) as pool:
+            results = list(pool.map(_convert_file, filenames,
+                                    chunksize=chunksize))
     else:
-        background_exists = 1
-
-    for file in filenames:
-        input_filename = file
-        #input_filename_up = filename.upper()
-        # directory name + input filename for plot convenience
-        dir_input_filename = dirname + input_filename
-        png_filename = input_filename.rstrip('.spe').rstrip('.SPE') + '.png'
-        png_filename_log = 'FFLog' + png_filename
-        png_filename_sum = 'FF' + png_filename
-        # ascii_filename = re.sub('.spe','.dat',input_filename)
-        # filesize = filenames[i] #Not done, but is never used.
-        (image, xaxis, error_code, message) = sperd.spereadJanis(input_filename)
-        if (error_code <= 0):
-            print(message)
-            print('error code: %d.\n' %error_code)
-            exit()
-        if (background_exists):
-            if (image.size == background_image.size):
-                if (background_xaxis == xaxis):
-                    image = image - background_image
-                else:
-                    print ('WARNING function spe2png_py: Background image',
-                           '%s has different xaxis than %s.\n' %(background_image,
-                                                                 input_filename))
-            else:
-                print ('WARNING function spe2png_py: Background image %s is of',
-                       'different size than %s.\n' %(background_filename,
-                                                     input_filename))
-
-        # Angle (y-axis) calibration
-        fobj = 4000     # objective focal length in um
-        ypixsize = 20   # pixel size in um
-        yindex = np.linspace(-199,200,400)
-        yaxis = np.arcsin(ypixsize*yindex/fobj)*180/math.pi #degrees
-        yk = (ypixsize*yindex/fobj)*2*math.pi/pl            #degrees
-
-        # set display range for the spectral image
-        xgap = abs(xaxis[0] - xaxis[1])/2
-        iniIdx = min(np.where(abs(xaxis-Snm)<xgap))
-        endIdx = max(np.where(abs(xaxis-Lnm)<xgap))
-        if not iniIdx.any():
-            iniIdx = 0
-        else:
-            iniIdx = np.amin(iniIdx)
-        if not endIdx.any():
-            endIdx = max(xaxis.shape)
-        else:
-            endIdx = np.amax(endIdx) + 1
-
-        angle_correction = -0.4         # shift the center to right
-        ygap = abs(yaxis[0]-yaxis[1])/2
-        iniy = min(np.where(abs(yaxis+anglelim+angle_correction)<ygap))
-        endy = max(np.where(abs(yaxis-anglelim+angle_correction)<ygap))
-        if not iniy.any():
-            iniy = 0
-        else:
-            iniy = np.amin(iniy)
-        if not endy.any():
-            endy = max(yaxis.shape)
-        else:
-            endy = np.amax(endy) + 1
+        _init_worker(settings, background)
+        results = [_convert_file(file) for file in filenames]
+    for input_filename, png_filename, message in results:
+        if message is not None:
+            print('ERROR function spe2png_py: %s: %s\n' %(input_filename,
+                                                         message))
+        elif incremental:
+            manifest.record(input_filename, [png_filename], params)
+    if incremental:
+        manifest.save()
+    return results
+
+
+@functools.lru_cache(maxsize=64)
+def far_field_roi(coeff, order, xdim, fobj, ypixsize, pl, Snm, Lnm,
+                  anglelim, angle_correction=-0.4):
+    """Returns the display axes and slice bounds for a far field image.
+
+    The result only depends on the calibration polynomial, the geometry
+    constants and the display limits, so it is computed once per
+    calibration and shared by every file (and live preview) using it.
+    The returned arrays are read-only.
+
+    Parameters
+    ----------
+    coeff : tuple of float
+        The SPE calibration polynomial coefficients.
+    order : int
+        The SPE calibration polynomial order.
+    xdim : int
+        Number of pixels along the wavelength axis.
+    fobj, ypixsize : float
+        Objective focal length and pixel size in um.
+    pl : float
+        Wavelength used for the k axis in cm.
+    Snm, Lnm : float
+        Shortest and longest wavelength displayed in nm.
+    anglelim : float
+        Largest angle displayed in degrees.
+    angle_correction : float
+        Shift of the angle window in degrees.
+
+    Returns
+    -------
+    FarFieldROI
+        (xaxis, yaxis, yk, iniIdx, endIdx, iniy, endy)
+
+    """
+    calibration = spe_calibration.get_calibration(coeff, order, xdim)
+    xaxis = calibration.wavelength
+
+    # Angle (y-axis) calibration
+    yindex = np.linspace(-199,200,400)
+    yaxis = calibration.angle_axis(400, ypixsize, fobj)  #degrees
+    yk = (ypixsize*yindex/fobj)*2*math.pi/pl            #1/cm
+
+    # set display range for the spectral image
+    xgap = abs(xaxis[0] - xaxis[1])/2
+    iniIdx = min(np.where(abs(xaxis-Snm)<xgap))
+    endIdx = max(np.where(abs(xaxis-Lnm)<xgap))
+    if not iniIdx.any():
+        iniIdx = 0
+    else:
+        iniIdx = np.amin(iniIdx)
+    if not endIdx.any():
+        endIdx = max(xaxis.shape)
+    else:
+        endIdx = np.amax(endIdx) + 1
+
+    ygap = abs(yaxis[0]-yaxis[1])/2
+    iniy = min(np.where(abs(yaxis+anglelim+angle_correction)<ygap))
+    endy = max(np.where(abs(yaxis-anglelim+angle_correction)<ygap))
+    if not iniy.any():
+        iniy = 0
+    else:
+        iniy = np.amin(iniy)
+    if not endy.any():
+        endy = max(yaxis.shape)
+    else:
+        endy = np.amax(endy) + 1
     #    ykgap=abs(yk[0]-yk[1])/2
     #    iniyk=min(np.where(abs(yk+klim)<ykgap))
     #    endyk=max(np.where(abs(yk-klim)<ykgap))
@@ -111,44 +212,115 @@ def spe2pngFFNew(directory='./'):
     #        endyk = max(yk.shape)
     #    else:
     #        endyk = np.amax(endyk) + 1
-            
-        # Region of interest for the figure
-        #ROIx = xaxis[iniIdx:endIdx]
-        #ROIy = yaxis[iniy:endy]     # +angle_correction
-        #ROIyk = yk[iniyk:endyk]
-        #ROIyk2 = np.sin(ROIy*math.pi/180)*2*math.pi/pl
-        #ROIxeV = 1238.82/ROIx
-
-        # definition of ROIimg (Region of Interest)
-        ROIimg = image[:,iniy:endy,iniIdx:endIdx].reshape(endy-iniy,endIdx-iniIdx)
-        #ROIimg = ROIimg / np.amax(ROIimg)      #intensity normalization
-    #    clims = np.array([100, np.amax(ROIimg[50:300,750:1000])+1000])
-        vmin = 100
-        vmax = np.amax(ROIimg[50:300,750:1000])+1000
-        imgplot = plt.imshow(ROIimg.astype(float), aspect='auto', cmap='jet', 
-                             vmin = vmin, vmax = vmax, 
-                             extent=[xaxis[iniIdx],xaxis[endIdx-1],
-                                     yaxis[iniy],yaxis[endy-1]])
-        #imgplot = plt.imshow(ROIimg, aspect='auto', cmap='jet')
-    #    plt.colorbar()
-        plt.ylabel('angle (degrees)')
-        #plt.ylabel('pixel index')
-        #plt.xlabel('Spatial Distance (um)')
-        plt.xlabel('Wavelength (nm)')
-        
-        A = input_filename.partition('.')[0]
-        A = '1/24/14 C3997.5' + A
-        #plt.ylim(-199, 200)
-        #plt.xlim(768.2, 772)
-    #    plt.xlim(775, 790)
-    #    plt.ylim(-40, 40)       #IMGs: x is for pixels, y: angle
-        #axis square
-        A = A.replace('_',' ')
-        A = A.replace('p','.')
-        plt.title(A)
-        pylab.savefig(png_filename, bbox_inches='tight')
-        plt.close()
+
+    # Region of interest for the figure
+    #ROIx = xaxis[iniIdx:endIdx]
+    #ROIy = yaxis[iniy:endy]     # +angle_correction
+    #ROIyk = yk[iniyk:endyk]
+    #ROIyk2 = np.sin(ROIy*math.pi/180)*2*math.pi/pl
+    #ROIxeV = 1238.82/ROIx
+
+    yk.setflags(write=False)
+    return FarFieldROI(xaxis, yaxis, yk, int(iniIdx), int(endIdx),
+                       int(iniy), int(endy))
+
+
+def _init_worker(settings, background):
+    # build the figure and image artist which every file is drawn into
+    global _settings, _background, _hot_pixels, _figure
+    _settings = settings
+    _background = background
+    # the masks are loaded once per process, not once per file
+    _hot_pixels = spe_cosmic.HotPixelMask() if settings['clean'] else None
+    if settings['fast']:
+        _figure = None
+        return
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    imgplot = ax.imshow(np.zeros((2, 2)), aspect='auto', cmap='jet')
+    #plt.colorbar()
+    ax.set_ylabel('angle (degrees)')
+    #ax.set_ylabel('pixel index')
+    #ax.set_xlabel('Spatial Distance (um)')
+    ax.set_xlabel('Wavelength (nm)')
+    _figure = (fig, ax, imgplot)
+
+
+def _convert_file(input_filename):
+    try:
+        return (input_filename, _render_far_field(input_filename), None)
+    except Exception as err:
+        return (input_filename, None, str(err))
+
+
+def _render_far_field(input_filename):
+    settings = _settings
+    pl = settings['pl']
+    Snm = settings['Snm']
+    Lnm = settings['Lnm']
+    anglelim = settings['anglelim']
+    #input_filename_up = filename.upper()
+    png_filename = os.path.splitext(input_filename)[0] + '.png'
+    png_filename_log = 'FFLog' + png_filename
+    png_filename_sum = 'FF' + png_filename
+    # ascii_filename = re.sub('.spe','.dat',input_filename)
+    # kinetics files are averaged over their frames in bounded memory
+    with sperd.SPEFile(input_filename) as spe:
+        correction = None
+        if settings['clean']:
+            correction = spe_cosmic.CosmicRayFilter(_hot_pixels)
+        reduced = spe_reduce.reduce_frames(spe, background=_background,
+                                           correction=correction)
+        spe_coeff = spe.polynom_coeff
+        spe_order = spe.polynom_order
+    image = reduced['mean']
+    if _background.stamp() and not reduced['background']:
+        print ('WARNING function spe2png_py: Background image has',
+               'different settings or size than %s.\n' %input_filename)
+
+    roi = far_field_roi(spe_coeff, spe_order, image.shape[1],
+                        settings['fobj'], settings['ypixsize'], pl, Snm, Lnm,
+                        anglelim, settings['angle_correction'])
+    (xaxis, yaxis, yk, iniIdx, endIdx, iniy, endy) = roi
+
+    # definition of ROIimg (Region of Interest)
+    ROIimg = image[iniy:endy,iniIdx:endIdx]
+    #ROIimg = ROIimg / np.amax(ROIimg)      #intensity normalization
+#    clims = np.array([100, np.amax(ROIimg[50:300,750:1000])+1000])
+    vmin = settings['vmin']
+    vmax = np.amax(ROIimg[50:300,750:1000])+1000
+    if settings['fast']:
+        # imshow draws row 0 at the top as well
+        spe_png.render_png(png_filename, ROIimg.astype(float), 'jet',
+                           vmin, vmax)
+        return png_filename
+
+    # only the image data, limits and title change between files
+    (fig, ax, imgplot) = _figure
+    imgplot.set_data(ROIimg.astype(float))
+    imgplot.set_clim(vmin, vmax)
+    imgplot.set_extent([xaxis[iniIdx],xaxis[endIdx-1],
+                        yaxis[iniy],yaxis[endy-1]])
+
+    A = os.path.basename(input_filename).partition('.')[0]
+    A = '1/24/14 C3997.5' + A
+    #ax.set_ylim(-199, 200)
+    #ax.set_xlim(768.2, 772)
+#    ax.set_xlim(775, 790)
+#    ax.set_ylim(-40, 40)       #IMGs: x is for pixels, y: angle
+    #axis square
+    A = A.replace('_',' ')
+    A = A.replace('p','.')
+    ax.set_title(A)
+    fig.savefig(png_filename, bbox_inches='tight')
+    return png_filename
 
 if __name__ == '__main__':
-    spe2pngFFNew()
-        
\ No newline at end of file
+    parser = argparse.ArgumentParser(
+        description="Converts the far field SPE files of the current "
+                    "directory to png images.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes converting in parallel, "
+                             "1 (the default) converts in this process")
+    spe2pngFFNew(workers=parser.parse_args().workers)
@@ -1,17 +1,37 @@
 import glob
-from matplotlib import image as mplimg
+import os
 import spereadNew as sperd
+import spe_png
+import spe_manifest
 
-def spe2pngraw(directory='./', file=''):
+# bump whenever a change to this module alters the rendered pixels
+RENDERER_VERSION = 1
+
+def spe2pngraw(directory='./', file='', bit16=False, incremental=False,
+               background=None):
     dirname = directory
     filename = file
     
     input_filename = filename
     dir_input_filename = dirname + input_filename
     png_filename = input_filename.rstrip('.spe').rstrip('.SPE') + '.png'
-    (image, xaxis, error_code, message) = sperd.spereadJanis(input_filename)
-    mplimg.imsave(png_filename, image[0], cmap="gray")
+    if incremental:
+        manifest = spe_manifest.ConversionManifest(
+            os.path.dirname(input_filename), 'spe2pngraw')
+        params = {'bit16': bit16, 'renderer': RENDERER_VERSION,
+                  'background': background.stamp() if background else None}
+        if not manifest.is_stale(input_filename, params):
+            return png_filename
+    with sperd.SPEFile(input_filename) as spe:
+        if background is not None:
+            image = background.read_subtracted(spe, 0)[0]
+        else:
+            image = spe[0]
+        spe_png.render_png(png_filename, image, cmap="gray", bit16=bit16)
+    if incremental:
+        manifest.record(input_filename, [png_filename], params)
+        manifest.save()
+    return png_filename
                     
 if __name__ == '__main__':
     spe2pngraw()
-        
\ No newline at end of file
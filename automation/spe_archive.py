@@ -0,0 +1,404 @@
+"""SPE Archive
+
+This module packs directories of SPE files into a single chunked,
+compressed container and reads them back with random access.
+
+Every block of frames is byte-shuffled (the low and high bytes of the
+pixels stored as separate planes, which compresses far better) and then
+compressed on its own with zlib or lzma. The layout of an archive is
+
+    MAGIC
+    compressed chunks, back to back
+    chunk index, one CHUNK_DTYPE record per chunk
+    zlib compressed JSON metadata
+    trailer: index offset, chunk count, metadata offset and size, MAGIC
+
+The metadata holds the header fields, calibration and the scan parameters
+parsed from the file name of every file, which the reader exposes as
+columns. Reading any frame costs one seek into the index held in memory
+and one seek and read of its chunk.
+
+The original header and any bytes after the data (the XML footer of SPE
+3.0 files) are kept as chunks too, so extract restores files byte for
+byte.
+"""
+
+import json
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import spereadNew as sperd
+import spe_calibration
+import scan_params
+
+MAGIC = b'QSPEARC1'
+ARCHIVE_VERSION = 1
+
+# offset, chunk count, metadata offset, metadata size, magic
+_TRAILER = struct.Struct('<QQQQ8s')
+
+CHUNK_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8'),
+                        ('raw_length', '<u8')])
+
+CODECS = ('zlib', 'lzma')
+
+# header fields stored as columns, see spereadNew.read_header
+_HEADER_COLUMNS = ('xdim', 'ydim', 'num_frames', 'datatype',
+                   'polynom_order', 'polynom_coeff', 'xDimDet', 'yDimDet',
+                   'exposure', 'center_wavelength')
+_PARAM_COLUMNS = ('name', 'od', 'wavelength', 'power', 'voltage', 'zaber')
+
+
+def build_archive(sources, archive_filename, codec='zlib', level=6,
+                  chunk_frames=1, workers=1):
+    """Packs SPE files into one archive.
+
+    Parameters
+    ----------
+    sources : str or list of str
+        A directory, whose .spe files are packed, or a list of files.
+    archive_filename : str
+        The archive to write, replaced atomically when complete.
+    codec : str
+        'zlib' or 'lzma'.
+    level : int
+        Compression level of the codec.
+    chunk_frames : int
+        Frames per compressed chunk, 1 gives the fastest access to
+        single frames.
+    workers : int
+        Number of processes compressing files, 1 compresses in the
+        current process.
+
+    Returns
+    -------
+    tuple
+        (number of files packed, total size of the sources in bytes,
+        size of the archive in bytes, list of (filename, error message)
+        of the files that could not be read and were left out).
+
+    """
+    if codec not in CODECS:
+        raise Exception("Invalid archive codec")
+    if isinstance(sources, str):
+        with os.scandir(sources) as entries:
+            filenames = sorted(entry.path for entry in entries
+                               if entry.name.lower().endswith('.spe')
+                               and entry.is_file())
+    else:
+        filenames = list(sources)
+    options = (codec, level, max(1, int(chunk_frames)))
+    tmp_name = archive_filename + '.tmp'
+    files = []
+    chunks = []
+    skipped = []
+    try:
+        with open(tmp_name, 'wb') as archive:
+            archive.write(MAGIC)
+            if workers > 1 and len(filenames) > 1:
+                with ProcessPoolExecutor(workers) as pool:
+                    packed = pool.map(_pack_file, filenames,
+                                      [options] * len(filenames))
+                    for filename, (entry, blobs, message) in zip(filenames,
+                                                                 packed):
+                        _write_file(archive, filename, entry, blobs, message,
+                                    files, chunks, skipped)
+            else:
+                for filename in filenames:
+                    (entry, blobs, message) = _pack_file(filename, options)
+                    _write_file(archive, filename, entry, blobs, message,
+                                files, chunks, skipped)
+            index = np.array(chunks, dtype=CHUNK_DTYPE)
+            index_offset = archive.tell()
+            archive.write(index.tobytes())
+            meta = zlib.compress(json.dumps({
+                'version': ARCHIVE_VERSION,
+                'codec': codec,
+                'chunk_frames': options[2],
+                'files': files,
+                }).encode())
+            meta_offset = archive.tell()
+            archive.write(meta)
+            archive.write(_TRAILER.pack(index_offset, len(chunks),
+                                        meta_offset, len(meta), MAGIC))
+        os.replace(tmp_name, archive_filename)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    source_bytes = sum(entry['size'] for entry in files)
+    return (len(files), source_bytes, os.path.getsize(archive_filename),
+            skipped)
+
+
+def update_headers(archive_filename, headers, level=6):
+    """Replaces the SPE headers of files in an archive, e.g. with a new
+    calibration, without rewriting their frames.
+
+    The new header chunks, chunk index, metadata and trailer are appended
+    to the archive, the ones they replace are left behind unused. The
+    archive is restored to its old length if the update fails.
+
+    Parameters
+    ----------
+    archive_filename : str
+        The archive to update, it must not be open for reading.
+    headers : dict
+        4100 byte headers keyed by the file (index, path or name).
+    level : int
+        Compression level of the new header chunks.
+
+    """
+    with SPEArchive(archive_filename) as archive:
+        indices = {archive.file_index(file): bytes(header)
+                   for file, header in headers.items()}
+        files = [dict(entry) for entry in archive._files]
+        chunks = archive._index.tolist()
+        codec = archive._codec
+        chunk_frames = archive.chunk_frames
+    size = os.path.getsize(archive_filename)
+    with open(archive_filename, 'r+b') as output:
+        try:
+            output.seek(size)
+            for index, header in indices.items():
+                if len(header) != sperd.SPE_HEADER_SIZE:
+                    raise Exception("SPE headers are %d bytes"
+                                    % sperd.SPE_HEADER_SIZE)
+                entry = files[index]
+                fields = sperd.parse_header(header)
+                entry.update((name, fields[name]) for name in _HEADER_COLUMNS)
+                blob = _compress(codec, level, header)
+                entry['header_chunk'] = len(chunks)
+                chunks.append((output.tell(), len(blob), len(header)))
+                output.write(blob)
+            index_offset = output.tell()
+            output.write(np.array(chunks, dtype=CHUNK_DTYPE).tobytes())
+            meta = zlib.compress(json.dumps({
+                'version': ARCHIVE_VERSION,
+                'codec': codec,
+                'chunk_frames': chunk_frames,
+                'files': files,
+                }).encode())
+            meta_offset = output.tell()
+            output.write(meta)
+            output.flush()
+            os.fsync(output.fileno())
+            output.write(_TRAILER.pack(index_offset, len(chunks),
+                                       meta_offset, len(meta), MAGIC))
+            output.flush()
+            os.fsync(output.fileno())
+        except BaseException:
+            output.truncate(size)
+            raise
+
+
+class SPEArchive:
+    """Random access reader of an SPE archive.
+
+    Parameters
+    ----------
+    filename : str
+        The archive written by build_archive.
+
+    Attributes
+    ----------
+    columns : dict
+        Per file columns, one entry per file: 'path', 'mtime_ns', 'size',
+        the header fields of spereadNew.read_header and the scan
+        parameters of scan_params.parse_scan_filename (NaN if missing).
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._file.seek(-_TRAILER.size, os.SEEK_END)
+            (index_offset, count, meta_offset, meta_size,
+             magic) = _TRAILER.unpack(self._file.read(_TRAILER.size))
+            if magic != MAGIC:
+                raise Exception("Not an SPE archive: %s" % filename)
+            self._file.seek(index_offset)
+            self._index = np.frombuffer(
+                self._file.read(count * CHUNK_DTYPE.itemsize), CHUNK_DTYPE)
+            self._file.seek(meta_offset)
+            meta = json.loads(zlib.decompress(self._file.read(meta_size)))
+        except Exception:
+            self._file.close()
+            raise
+        if meta['version'] > ARCHIVE_VERSION:
+            self._file.close()
+            raise Exception("SPE archive %s is of a newer version" % filename)
+        self._codec = meta['codec']
+        self.chunk_frames = meta['chunk_frames']
+        self._files = meta['files']
+        self._lookup = {entry['path']: i for i, entry in enumerate(self._files)}
+        self._lookup.update((os.path.basename(entry['path']), i)
+                            for i, entry in enumerate(self._files))
+        self.columns = {'path': [entry['path'] for entry in self._files]}
+        for name in ('mtime_ns', 'size') + _HEADER_COLUMNS:
+            self.columns[name] = np.array([entry[name]
+                                           for entry in self._files])
+        self.columns['name'] = [entry['name'] for entry in self._files]
+        for name in _PARAM_COLUMNS[1:]:
+            self.columns[name] = np.array(
+                [np.nan if entry[name] is None else entry[name]
+                 for entry in self._files], dtype=np.float64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._files)
+
+    def close(self):
+        self._file.close()
+
+    def file_index(self, file):
+        """Returns the index of a file given by index, path or name."""
+        if isinstance(file, str):
+            if file not in self._lookup:
+                raise Exception("File %s is not in the archive" % file)
+            return self._lookup[file]
+        return range(len(self._files))[file]
+
+    def read_frame(self, file, frame=0):
+        """Returns one (y, x) frame of a file."""
+        entry = self._files[self.file_index(file)]
+        if not 0 <= frame < entry['num_frames']:
+            raise Exception("Frame %d out of range" % frame)
+        block = self._read_block(entry, frame // self.chunk_frames)
+        return block[frame % self.chunk_frames]
+
+    def read_spectrum(self, file, frame=0, row=0):
+        """Returns one row of one frame of a file."""
+        return self.read_frame(file, frame)[row]
+
+    def read_file(self, file):
+        """Returns every frame of a file as a (frames, y, x) array."""
+        entry = self._files[self.file_index(file)]
+        blocks = [self._read_block(entry, i) for i in range(
+            -(-entry['num_frames'] // self.chunk_frames))]
+        return np.concatenate(blocks) if blocks else np.empty(
+            (0, entry['ydim'], entry['xdim']), _dtype(entry))
+
+    def xaxis(self, file):
+        """Returns the read-only wavelength axis of a file."""
+        entry = self._files[self.file_index(file)]
+        return spe_calibration.get_calibration(
+            tuple(entry['polynom_coeff']), entry['polynom_order'],
+            entry['xdim']).wavelength
+
+    def header_bytes(self, file):
+        """Returns the original 4100 byte header of a file."""
+        entry = self._files[self.file_index(file)]
+        return self._read_chunk(entry['header_chunk'])
+
+    def extract(self, file, filename):
+        """Restores a file of the archive, byte for byte."""
+        entry = self._files[self.file_index(file)]
+        with open(filename, 'wb') as output:
+            output.write(self._read_chunk(entry['header_chunk']))
+            for i in range(-(-entry['num_frames'] // self.chunk_frames)):
+                output.write(self._read_block(entry, i).tobytes())
+            output.write(self._read_chunk(entry['tail_chunk']))
+
+    def _read_chunk(self, chunk):
+        (offset, length, raw_length) = self._index[chunk]
+        self._file.seek(int(offset))
+        data = _decompress(self._codec, self._file.read(int(length)))
+        if len(data) != raw_length:
+            raise Exception("Corrupt chunk in SPE archive %s" % self.filename)
+        return data
+
+    def _read_block(self, entry, block):
+        dtype = _dtype(entry)
+        data = _unshuffle(self._read_chunk(entry['first_chunk'] + block),
+                          dtype)
+        return data.reshape(-1, entry['ydim'], entry['xdim'])
+
+
+def _dtype(entry):
+    return np.dtype(sperd.datatype_to_string(entry['datatype'])
+                    ).newbyteorder('<')
+
+
+def _shuffle(array):
+    # byte planes: all first bytes, then all second bytes, ...
+    return np.ascontiguousarray(
+        array.reshape(-1).view(np.uint8).reshape(-1, array.itemsize).T
+        ).tobytes()
+
+
+def _unshuffle(data, dtype):
+    planes = np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(-1)
+
+
+def _compress(codec, level, data):
+    if codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+def _decompress(codec, data):
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def _pack_file(filename, options):
+    # (metadata entry, [header, frame blocks..., tail] raw and compressed,
+    # error message), errors are returned rather than raised so one bad
+    # file does not abort the archive
+    try:
+        return _pack(filename, options) + (None,)
+    except Exception as err:
+        return None, None, str(err)
+
+
+def _pack(filename, options):
+    (codec, level, chunk_frames) = options
+    header = sperd.read_header(filename)
+    stat = os.stat(filename)
+    entry = {'path': os.path.abspath(filename), 'mtime_ns': stat.st_mtime_ns,
+             'size': stat.st_size}
+    entry.update((name, header[name]) for name in _HEADER_COLUMNS)
+    params = scan_params.parse_scan_filename(filename)
+    entry.update((name, params[name]) for name in _PARAM_COLUMNS)
+    blobs = []
+    with sperd.SPEFile(filename) as spe:
+        with open(filename, 'rb') as file:
+            raw = file.read(sperd.SPE_HEADER_SIZE)
+        blobs.append((len(raw), _compress(codec, level, raw)))
+        for _, chunk in spe.iter_chunks(chunk_frames, readahead=0):
+            raw = _shuffle(chunk)
+            blobs.append((len(raw), _compress(codec, level, raw)))
+        data_end = (sperd.SPE_HEADER_SIZE + spe.dtype.itemsize
+                    * spe.num_frames * spe.ydim * spe.xdim)
+    with open(filename, 'rb') as file:
+        file.seek(data_end)
+        raw = file.read()
+    blobs.append((len(raw), _compress(codec, level, raw)))
+    return entry, blobs
+
+
+def _write_file(archive, filename, entry, blobs, message, files, chunks,
+                skipped):
+    if message is not None:
+        print('ERROR function build_archive: %s: %s\n' % (filename, message))
+        skipped.append((filename, message))
+        return
+    first = len(chunks)
+    for raw_length, blob in blobs:
+        chunks.append((archive.tell(), len(blob), raw_length))
+        archive.write(blob)
+    entry['header_chunk'] = first
+    entry['first_chunk'] = first + 1
+    entry['tail_chunk'] = len(chunks) - 1
+    files.append(entry)
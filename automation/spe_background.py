@@ -0,0 +1,209 @@
+"""SPE Background Engine
+
+This module builds float32 master dark (background) frames from one or
+many dark SPE files and subtracts them from whole frame stacks in place.
+
+Master darks are cached by the acquisition settings they are valid for,
+the exposure time, the ADC settings and the readout region, so one engine
+can hold the darks for several settings and pick the right one for every
+file. The engine is picklable and is shared by the batch converters and
+the live SpectroscopyGUI preview.
+"""
+
+import hashlib
+import os
+import numpy as np
+import spereadNew as sperd
+import spe_manifest
+
+
+def dark_key(spe):
+    """Returns the settings a dark frame of spe is valid for.
+
+    Parameters
+    ----------
+    spe : SPEFile
+        The open SPE file.
+
+    Returns
+    -------
+    tuple
+        (exposure, ADC settings, (ydim, xdim, ROI)) of the file.
+
+    """
+    header = spe.header
+    adc = tuple(int(header[field]) for field in (
+        'ADCoffset', 'ADCrate', 'ADCtype', 'ADCresolution',
+        'ADCbitAdjust', 'gain'))
+    roi = (spe.ydim, spe.xdim, int(header['NumROI']),
+           tuple(int(v) for v in header['ROIinfblk'][0]))
+    return (round(float(header['exp_sec']), 6), adc, roi)
+
+
+def combine_frames(stack, method='mean', sigma=3.0, iterations=3):
+    """Combines a (frames, y, x) stack into a single float32 frame.
+
+    Parameters
+    ----------
+    stack : ndarray
+        The frames to combine.
+    method : str
+        'mean', 'median' or 'sigma_clip' (mean after iteratively
+        rejecting pixels more than sigma standard deviations away from
+        the median).
+    sigma : float
+        Rejection threshold of 'sigma_clip'.
+    iterations : int
+        Number of rejection passes of 'sigma_clip'.
+
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    if method == 'mean':
+        return stack.mean(axis=0, dtype=np.float64).astype(np.float32)
+    if method == 'median':
+        return np.median(stack, axis=0).astype(np.float32)
+    if method != 'sigma_clip':
+        raise Exception("Invalid combination method")
+    # clip around the median so a single bright spike cannot drag the
+    # centre of a small stack towards itself
+    work = stack.copy()
+    for _ in range(iterations):
+        center = np.nanmedian(work, axis=0)
+        std = np.nanstd(work, axis=0)
+        reject = np.abs(work - center) > sigma * std
+        if not reject.any():
+            break
+        work[reject] = np.nan
+    count = np.sum(~np.isnan(work), axis=0)
+    total = np.nansum(work, axis=0, dtype=np.float64)
+    # pixels where everything was rejected fall back to the median
+    return np.where(count > 0, total / np.maximum(count, 1),
+                    np.median(stack, axis=0)).astype(np.float32)
+
+
+class BackgroundEngine:
+    """Master dark cache and stack subtraction.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory where built master darks are stored and reused across
+        sessions. Masters are only kept in memory if not given.
+
+    """
+
+    def __init__(self, cache_dir=None):
+        self._cache_dir = cache_dir
+        self._masters = {}
+        self._sources = {}
+
+    def add_darks(self, filenames, method='mean', sigma=3.0):
+        """Builds master darks from dark SPE files.
+
+        The files are grouped by dark_key and every group is combined
+        into one master dark, replacing any earlier master for the same
+        settings.
+
+        Parameters
+        ----------
+        filenames : list of str
+            The dark SPE files.
+        method : str
+            Frame combination, see combine_frames.
+        sigma : float
+            Rejection threshold for 'sigma_clip'.
+
+        Returns
+        -------
+        list of tuple
+            The keys of the master darks built.
+
+        """
+        groups = {}
+        for filename in filenames:
+            with sperd.SPEFile(filename) as spe:
+                groups.setdefault(dark_key(spe), []).append(filename)
+        for key, group in groups.items():
+            stamps = sorted(spe_manifest.file_stamp(f) for f in group)
+            cache_file = self._cache_file(key, stamps, method, sigma)
+            if cache_file is not None and os.path.isfile(cache_file):
+                master = np.load(cache_file)
+            else:
+                master = self._build(group, method, sigma)
+                if cache_file is not None:
+                    os.makedirs(self._cache_dir, exist_ok=True)
+                    tmp_name = cache_file + '.tmp.npy'
+                    np.save(tmp_name, master)
+                    os.replace(tmp_name, cache_file)
+            master.setflags(write=False)
+            self._masters[key] = master
+            self._sources[key] = stamps
+        return list(groups)
+
+    def master(self, key):
+        """Returns the float32 master dark for key or None."""
+        return self._masters.get(key)
+
+    def stamp(self):
+        """Returns the (path, mtime, size) of every dark file in use."""
+        return sorted(s for stamps in self._sources.values() for s in stamps)
+
+    def subtract(self, stack, key):
+        """Subtracts the master dark for key from stack in place.
+
+        Parameters
+        ----------
+        stack : ndarray
+            float32 (frames, y, x) stack or single (y, x) frame.
+        key : tuple
+            dark_key of the file the stack was read from.
+
+        Returns
+        -------
+        bool
+            True if a matching master dark was found and subtracted.
+
+        """
+        master = self._masters.get(key)
+        if master is None or master.shape != stack.shape[-2:]:
+            return False
+        np.subtract(stack, master, out=stack)
+        return True
+
+    def read_subtracted(self, spe, frames=slice(None)):
+        """Reads frames of an open SPEFile as float32 minus the dark.
+
+        Returns
+        -------
+        tuple
+            (float32 stack, True if a dark was subtracted).
+
+        """
+        stack = np.array(spe.data[frames], dtype=np.float32)
+        return stack, self.subtract(stack, dark_key(spe))
+
+    def _build(self, filenames, method, sigma):
+        # a plain mean streams, the robust methods need every frame
+        if method == 'mean':
+            total = None
+            count = 0
+            for filename in filenames:
+                with sperd.SPEFile(filename) as spe:
+                    for _, frame in spe.iter_frames():
+                        if total is None:
+                            total = np.zeros(frame.shape, dtype=np.float64)
+                        total += frame
+                        count += 1
+            return (total / count).astype(np.float32)
+        frames = []
+        for filename in filenames:
+            with sperd.SPEFile(filename) as spe:
+                frames.append(np.array(spe.data, dtype=np.float32))
+        return combine_frames(np.concatenate(frames), method, sigma)
+
+    def _cache_file(self, key, stamps, method, sigma):
+        if self._cache_dir is None:
+            return None
+        digest = hashlib.sha1(
+            repr((key, stamps, method, float(sigma))).encode()).hexdigest()
+        return os.path.join(self._cache_dir, 'dark_%s.npy' % digest)
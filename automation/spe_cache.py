@@ -0,0 +1,281 @@
+"""SPE Result Cache
+
+This module keeps an on-disk cache of products derived from SPE files,
+such as background subtracted frames, spectra, fit results or thumbnails,
+so that re-opening a series does not re-read and re-process every file.
+
+Entries are keyed by a content hash of the source file and a hash of the
+processing parameters. Content hashes are remembered by path, mtime and
+size, so an unchanged file is only ever hashed once. The values are pickled
+into blob files and indexed in an SQLite database in WAL mode, which lets
+several processes (e.g. the workers of a process pool) share one cache.
+The least recently used entries are evicted once the cache grows past its
+size cap.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import uuid
+
+RESULT_CACHE = os.path.join(os.path.expanduser('~'), '.quinlab',
+                            'result_cache')
+
+INDEX_NAME = 'index.sqlite'
+
+# bytes read at a time while hashing source files
+_HASH_BLOCK = 2**20
+
+# seconds after its last lookup that the counters of an instance which
+# was never closed are dropped
+_COUNTER_AGE = 7 * 24 * 3600
+
+
+def params_hash(params):
+    """Returns the hex digest of JSON-like processing parameters."""
+    text = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class ResultCache:
+    """Size capped, process safe cache of derived results.
+
+    The cache can be pickled and sent to worker processes, every process
+    opens its own connection to the index. The hits and misses counters
+    are kept in the index, so they count the lookups made through this
+    instance and every copy of it sent to a worker. They are dropped when
+    the instance is closed in the process that created it, or a week
+    after its last lookup.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory holding the index and the blob files.
+    max_bytes : int
+        Size cap of the blob files, least recently used entries are
+        evicted beyond it.
+
+    """
+
+    def __init__(self, cache_dir=RESULT_CACHE, max_bytes=2 * 2**30):
+        self._cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self._session = uuid.uuid4().hex
+        self._owner = os.getpid()
+        self._db = None
+        self._pid = None
+        self._connect()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def hits(self):
+        """Number of lookups of this instance that were hits."""
+        return self._counters()[0]
+
+    @property
+    def misses(self):
+        """Number of lookups of this instance that were misses."""
+        return self._counters()[1]
+
+    @property
+    def hit_rate(self):
+        """Fraction of the lookups of this instance that were hits."""
+        (hits, misses) = self._counters()
+        lookups = hits + misses
+        return hits / lookups if lookups else 0.0
+
+    def close(self):
+        """Closes the index connection of this process, and drops the
+        counters if this is the process that created the instance."""
+        if os.getpid() == self._owner:
+            with self._connect() as db:
+                db.execute("DELETE FROM counters WHERE session = ?",
+                           (self._session,))
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def source_hash(self, filename):
+        """Returns the content hash of a file, hashing it only if it is
+        new or changed since it was last hashed."""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        db = self._connect()
+        row = db.execute(
+            "SELECT digest FROM sources WHERE path = ? AND mtime_ns = ? "
+            "AND size = ?", (path, stat.st_mtime_ns, stat.st_size)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(_HASH_BLOCK), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        with db:
+            db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                       (path, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    def key(self, source, params):
+        """Returns the entry key of a source file and parameters."""
+        return hashlib.sha1((self.source_hash(source) + ':'
+                             + params_hash(params)).encode()).hexdigest()
+
+    def get(self, source, params, default=None):
+        """Returns the cached result for source and params or default."""
+        key = self.key(source, params)
+        value = self._load(key)
+        self._count(value is not None)
+        return default if value is None else value[0]
+
+    def put(self, source, params, value):
+        """Stores the result for source and params."""
+        self._store(self.key(source, params), value)
+
+    def get_or_compute(self, source, params, compute):
+        """Returns the cached result or compute() after storing it."""
+        key = self.key(source, params)
+        value = self._load(key)
+        self._count(value is not None)
+        if value is not None:
+            return value[0]
+        result = compute()
+        self._store(key, result)
+        return result
+
+    def size(self):
+        """Returns the (number of entries, total bytes) in the cache."""
+        (count, total) = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return count, total
+
+    def clear(self):
+        """Removes every entry."""
+        db = self._connect()
+        with db:
+            keys = [row[0] for row in db.execute("SELECT key FROM entries")]
+            db.execute("DELETE FROM entries")
+        for key in keys:
+            self._remove_blob(key)
+
+    def _connect(self):
+        # a connection cannot cross a fork, reconnect in every process
+        if self._db is None or self._pid != os.getpid():
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(self._cache_dir, INDEX_NAME), timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_access "
+                "ON entries (last_access)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+                "digest TEXT)")
+            # counters of an older layout are only transient, drop them
+            columns = [row[1] for row in self._db.execute(
+                "PRAGMA table_info(counters)")]
+            if columns and 'last_access' not in columns:
+                self._db.execute("DROP TABLE counters")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "session TEXT PRIMARY KEY, hits INTEGER, misses INTEGER, "
+                "last_access REAL)")
+            self._db.execute("DELETE FROM counters WHERE last_access < ?",
+                             (time.time() - _COUNTER_AGE,))
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def _count(self, hit):
+        with self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO counters VALUES (?, 0, 0, 0)",
+                       (self._session,))
+            db.execute("UPDATE counters SET hits = hits + ?, "
+                       "misses = misses + ?, last_access = ? "
+                       "WHERE session = ?",
+                       (int(hit), int(not hit), time.time(), self._session))
+
+    def _counters(self):
+        row = self._connect().execute(
+            "SELECT hits, misses FROM counters WHERE session = ?",
+            (self._session,)).fetchone()
+        return row if row is not None else (0, 0)
+
+    def _blob(self, key):
+        return os.path.join(self._cache_dir, key[:2], key + '.pkl')
+
+    def _load(self, key):
+        # (value,) on a hit, None on a miss
+        db = self._connect()
+        if db.execute("SELECT 1 FROM entries WHERE key = ?",
+                      (key,)).fetchone() is None:
+            return None
+        try:
+            with open(self._blob(key), 'rb') as file:
+                value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # evicted by another process in the meantime, or damaged
+            with db:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        with db:
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?",
+                       (time.time(), key))
+        return (value,)
+
+    def _store(self, key, value):
+        filename = self._blob(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_name, 'wb') as file:
+            pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_name)
+        os.replace(tmp_name, filename)
+        db = self._connect()
+        with db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                       (key, size, time.time()))
+        self._evict()
+
+    def _evict(self):
+        db = self._connect()
+        with db:
+            # BEGIN IMMEDIATE so two processes never evict the same rows
+            db.execute("BEGIN IMMEDIATE")
+            (total,) = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in db.execute(
+                    "SELECT key, size FROM entries ORDER BY last_access"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+            db.executemany("DELETE FROM entries WHERE key = ?",
+                           [(key,) for key in evicted])
+        for key in evicted:
+            self._remove_blob(key)
+
+    def _remove_blob(self, key):
+        try:
+            os.remove(self._blob(key))
+        except OSError:
+            pass
@@ -0,0 +1,125 @@
+"""SPE Wavelength Calibration
+
+This module evaluates the full pixel to wavelength polynomial stored in
+SPE headers and derives the photon energy and far field angle / in-plane
+wavevector lookup tables from it.
+
+Calibrations are memoized by their coefficient tuple, so the thousands of
+files of a series taken with one grating and centre wavelength share a
+single set of read-only arrays.
+"""
+
+import functools
+import math
+import numpy as np
+
+# h*c in eV nm, photon energy (eV) = HC_EV_NM / wavelength (nm)
+HC_EV_NM = 1239.841984
+
+
+class Calibration:
+    """Lookup tables of one SPE wavelength calibration.
+
+    Use get_calibration rather than creating these directly, so that equal
+    calibrations are shared.
+
+    Parameters
+    ----------
+    coeff : tuple of float
+        The six polynom_coeff values of the SPE header.
+    order : int
+        The polynom_order of the header.
+    xdim : int
+        Number of pixels along the wavelength axis.
+
+    """
+
+    def __init__(self, coeff, order, xdim):
+        self.coeff = tuple(float(c) for c in coeff)
+        self.order = _valid_order(self.coeff, order)
+        self.xdim = int(xdim)
+        xindex = np.arange(0, self.xdim, dtype=np.float64)
+        self.wavelength = np.polynomial.polynomial.polyval(
+            xindex, self.coeff[:self.order + 1])
+        with np.errstate(divide='ignore'):
+            self.energy = HC_EV_NM / self.wavelength
+        self.wavelength.setflags(write=False)
+        self.energy.setflags(write=False)
+
+    @functools.lru_cache(maxsize=16)
+    def angle_axis(self, ydim, ypixsize, fobj, center=None):
+        """Returns the far field emission angle (degrees) of every row.
+
+        Row r sits at sin(angle) = ypixsize * (r - center) / fobj in the
+        Fourier plane, center defaults to (ydim - 1) // 2.
+
+        Parameters
+        ----------
+        ydim : int
+            Number of rows.
+        ypixsize, fobj : float
+            Pixel size and objective focal length in um.
+        center : float, optional
+            Row of normal emission.
+
+        """
+        angle = np.degrees(np.arcsin(np.clip(
+            self._sin_angle(ydim, ypixsize, fobj, center), -1, 1)))
+        angle.setflags(write=False)
+        return angle
+
+    @functools.lru_cache(maxsize=16)
+    def k_axis(self, ydim, ypixsize, fobj, wavelength=None, center=None):
+        """Returns the in-plane wavevector (1/um) of every row.
+
+        Parameters
+        ----------
+        wavelength : float, optional
+            Wavelength in nm, the centre of the calibrated range by
+            default.
+
+        See angle_axis for the other parameters.
+
+        """
+        if wavelength is None:
+            wavelength = float(self.wavelength[self.xdim // 2])
+        k = (2 * math.pi * 1000 / wavelength
+             * self._sin_angle(ydim, ypixsize, fobj, center))
+        k.setflags(write=False)
+        return k
+
+    @functools.lru_cache(maxsize=16)
+    def k_map(self, ydim, ypixsize, fobj, center=None):
+        """Returns the (ydim, xdim) in-plane wavevector (1/um) of every
+        pixel, using the wavelength of each column."""
+        k = np.outer(self._sin_angle(ydim, ypixsize, fobj, center),
+                     2 * math.pi * 1000 / self.wavelength)
+        k.setflags(write=False)
+        return k
+
+    def _sin_angle(self, ydim, ypixsize, fobj, center):
+        if center is None:
+            center = (ydim - 1) // 2
+        return ypixsize * (np.arange(ydim) - center) / fobj
+
+    def __eq__(self, other):
+        return (isinstance(other, Calibration)
+                and (self.coeff, self.order, self.xdim)
+                == (other.coeff, other.order, other.xdim))
+
+    def __hash__(self):
+        return hash((self.coeff, self.order, self.xdim))
+
+
+@functools.lru_cache(maxsize=256)
+def get_calibration(coeff, order, xdim):
+    """Returns the shared Calibration for a coefficient tuple."""
+    return Calibration(coeff, order, xdim)
+
+
+def _valid_order(coeff, order):
+    # headers without a sensible order fall back to the highest term set
+    if 1 <= order < len(coeff):
+        return int(order)
+    nonzero = [i for i, c in enumerate(coeff) if c != 0]
+    return max(nonzero) if nonzero else 0
@@ -0,0 +1,171 @@
+"""SPE Catalog
+
+This module keeps a persistent SQLite catalog of the SPE header fields of
+every file in an acquisition directory, so that a day of data can be
+listed and filtered without opening the files themselves.
+
+The catalog is keyed by path, modification time and size and is updated
+incrementally: only new or changed files have their headers read. Files
+whose header cannot be read are kept with their error message, so they
+are not read again until they change.
+"""
+
+import os
+import sqlite3
+import spereadNew as sperd
+import spe_calibration
+
+CATALOG_NAME = ".spe_catalog.sqlite"
+
+_COLUMNS = ("xdim", "ydim", "num_frames", "datatype", "polynom_order",
+            "c0", "c1", "c2", "c3", "c4", "c5", "xDimDet", "yDimDet",
+            "exposure", "center_wavelength", "wl_min", "wl_max")
+
+
+class SPECatalog:
+    """The SPE header catalog of one acquisition directory.
+
+    Parameters
+    ----------
+    directory : str
+        The acquisition directory to catalog.
+    db_path : str, optional
+        Location of the SQLite database, defaults to a hidden file
+        inside the directory.
+
+    """
+
+    def __init__(self, directory, db_path=None):
+        self._directory = os.path.abspath(directory)
+        if db_path is None:
+            db_path = os.path.join(self._directory, CATALOG_NAME)
+        self._db = sqlite3.connect(db_path)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spe ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, "
+            + ", ".join("%s REAL" % c for c in _COLUMNS) + ", error TEXT)")
+        # catalogs written before errors were kept
+        columns = [row["name"] for row in self._db.execute(
+            "PRAGMA table_info(spe)")]
+        if "error" not in columns:
+            self._db.execute("ALTER TABLE spe ADD COLUMN error TEXT")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS spe_wl ON spe (wl_min, wl_max)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS spe_frames ON spe (num_frames)")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def update(self):
+        """Brings the catalog in line with the directory contents.
+
+        Files whose header cannot be read are recorded as bad, see
+        errors, and left out of query.
+
+        Returns
+        -------
+        tuple of int
+            The number of (added or changed, removed) files.
+
+        """
+        known = {row["path"]: (row["mtime_ns"], row["size"])
+                 for row in self._db.execute(
+                     "SELECT path, mtime_ns, size FROM spe")}
+        present = set()
+        changed = []
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(".spe"):
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                present.add(entry.path)
+                if known.get(entry.path) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                try:
+                    row = _row(entry.path, stat,
+                               sperd.read_header(entry.path))
+                except Exception as err:
+                    row = ((entry.path, stat.st_mtime_ns, stat.st_size)
+                           + (None,) * len(_COLUMNS) + (str(err),))
+                changed.append(row)
+        removed = [(path,) for path in known if path not in present]
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO spe (path, mtime_ns, size, %s, error) "
+                "VALUES (%s)" % (", ".join(_COLUMNS),
+                                 ", ".join("?" * (4 + len(_COLUMNS)))),
+                changed)
+            self._db.executemany("DELETE FROM spe WHERE path = ?", removed)
+        return len(changed), len(removed)
+
+    def query(self, wavelength=None, min_frames=None, max_frames=None,
+              xdim=None, ydim=None):
+        """Returns the catalog entries matching every given filter.
+
+        Parameters
+        ----------
+        wavelength : tuple of float, optional
+            (start, end) window in nm which the file must cover.
+        min_frames, max_frames : int, optional
+            Bounds on the number of frames in the file.
+        xdim, ydim : int, optional
+            Required image dimensions.
+
+        Returns
+        -------
+        list of dict
+            One dict of header fields per file, sorted by path.
+
+        """
+        where = ["error IS NULL"]
+        args = []
+        if wavelength is not None:
+            where.append("wl_min <= ? AND wl_max >= ?")
+            args += [min(wavelength), max(wavelength)]
+        if min_frames is not None:
+            where.append("num_frames >= ?")
+            args.append(min_frames)
+        if max_frames is not None:
+            where.append("num_frames <= ?")
+            args.append(max_frames)
+        if xdim is not None:
+            where.append("xdim = ?")
+            args.append(xdim)
+        if ydim is not None:
+            where.append("ydim = ?")
+            args.append(ydim)
+        sql = ("SELECT * FROM spe WHERE " + " AND ".join(where)
+               + " ORDER BY path")
+        return [dict(row) for row in self._db.execute(sql, args)]
+
+    def errors(self):
+        """Returns the (path, error message) of every file whose header
+        could not be read, sorted by path."""
+        return [(row["path"], row["error"]) for row in self._db.execute(
+            "SELECT path, error FROM spe WHERE error IS NOT NULL "
+            "ORDER BY path")]
+
+
+def _row(path, stat, header):
+    # flatten a read_header dict into a catalog row
+    if header["xdim"] < 1:
+        raise Exception("No pixels in SPE file %s" % path)
+    coeff = header["polynom_coeff"]
+    wavelength = spe_calibration.get_calibration(
+        coeff, header["polynom_order"], header["xdim"]).wavelength
+    values = dict(header, wl_min=float(wavelength.min()),
+                  wl_max=float(wavelength.max()))
+    values.update(("c%d" % i, c) for i, c in enumerate(coeff))
+    return (path, stat.st_mtime_ns, stat.st_size) + tuple(
+        values[c] for c in _COLUMNS) + (None,)
@@ -0,0 +1,316 @@
+"""SPE Cosmic Ray and Hot Pixel Rejection
+
+This module removes stuck (hot) pixels and transient cosmic ray spikes
+from CCD frame stacks with whole-array NumPy operations.
+
+Hot pixels are found once per detector from dark frames and kept in a
+persistent mask cache. Cosmic rays are found per frame: by comparison with
+the other frames of the stack when there are several, and by the
+Laplacian edge test of L.A.Cosmic (van Dokkum 2001) when there is only
+one, together with a comparison along the slit, which only flags
+features sharper than the fine structure around them, standing out from
+the pixels above and below and with no excess of their own in the rows
+next to them, so narrow emission or lasing lines extending a few rows
+along the slit are left alone. ``CosmicRayFilter`` bundles both into a
+correction stage which pipelines such as ``spe_reduce.reduce_frames``
+apply to every chunk of frames, with earlier frames as context.
+"""
+
+import os
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import spereadNew as sperd
+
+HOT_PIXEL_CACHE = os.path.join(os.path.expanduser('~'), '.quinlab',
+                               'hot_pixels')
+
+# converts a median absolute deviation to a gaussian standard deviation
+MAD_SCALE = 1.4826
+
+# bump whenever a change to this module alters the cleaned pixels
+COSMIC_VERSION = 3
+
+# standard deviation of the 4 neighbour Laplacian of unit white noise
+_LAPLACIAN_NOISE = np.sqrt(20.0)
+
+# largest fraction of a single frame spike's excess over the columns either
+# side that its row neighbours may share, a line along the slit shares more
+_ISOLATION = 0.3
+
+
+def local_median(frames, size=3):
+    """Returns the size x size median around every pixel of each frame."""
+    frames = np.asarray(frames, dtype=np.float32)
+    pad = size // 2
+    padded = np.pad(frames, [(0, 0)] * (frames.ndim - 2) + [(pad, pad)] * 2,
+                    mode='edge')
+    windows = sliding_window_view(padded, (size, size), axis=(-2, -1))
+    return np.median(windows, axis=(-2, -1))
+
+
+def robust_sigma(values):
+    """Returns the MAD based standard deviation of all values."""
+    values = np.asarray(values)
+    return MAD_SCALE * float(np.median(np.abs(values - np.median(values))))
+
+
+def laplacian(frames):
+    """Returns the 4 neighbour Laplacian 4 * p - (up + down + left +
+    right) of every pixel of each frame, edges repeated."""
+    frames = np.asarray(frames, dtype=np.float32)
+    padded = np.pad(frames, [(0, 0)] * (frames.ndim - 2) + [(1, 1)] * 2,
+                    mode='edge')
+    return (4 * frames - padded[..., :-2, 1:-1] - padded[..., 2:, 1:-1]
+            - padded[..., 1:-1, :-2] - padded[..., 1:-1, 2:])
+
+
+def find_cosmic_rays(stack, threshold=6.0, size=3, contrast=2.0):
+    """Returns the mask of cosmic ray pixels and their replacement values.
+
+    Parameters
+    ----------
+    stack : ndarray
+        float32 (frames, y, x) stack.
+    threshold : float
+        Detection threshold in standard deviations of the noise.
+    size : int
+        Single frames only: rows of the median along the slit which a
+        spike must stand out from and which replaces it, at least 5.
+    contrast : float
+        Single frames only: smallest ratio of the Laplacian of a spike to
+        the fine structure around it. A real feature at least 2 pixels
+        across along either axis has a ratio near 1, a cosmic ray hit a
+        much larger one.
+
+    Returns
+    -------
+    tuple of ndarray
+        (bool spike mask, float32 replacement values), both shaped like
+        the stack.
+
+    """
+    frames = stack.shape[0]
+    if frames >= 3:
+        reference = np.median(stack, axis=0)[np.newaxis]
+        residual = stack - reference
+        read_noise = robust_sigma(residual)
+    elif frames == 2:
+        # a spike is only ever positive, so the other frame is the
+        # reference of whichever one is higher; the residual is then a
+        # difference of two frames with sqrt(2) times the noise of one
+        reference = np.minimum(stack[0], stack[1])[np.newaxis]
+        residual = stack - reference
+        read_noise = robust_sigma(stack[0] - stack[1]) / np.sqrt(2)
+    else:
+        return _single_frame_spikes(stack, threshold, size, contrast)
+    # read noise from the data plus shot noise of the reference level
+    noise = np.sqrt(read_noise**2 + np.maximum(reference, 0))
+    if frames == 2:
+        noise *= np.sqrt(2)
+    spikes = residual > threshold * noise
+    replacement = np.broadcast_to(reference, stack.shape).astype(np.float32)
+    return spikes, replacement
+
+
+def slit_median(frames, size=5):
+    """Returns the median of the size pixels along the slit (the rows)
+    around every pixel of each frame, edges mirrored. Frames of a single
+    row are returned unchanged."""
+    frames = np.asarray(frames, dtype=np.float32)
+    pad = size // 2
+    # mirroring keeps a hit on the edge row out of its own median
+    padded = np.pad(frames, [(0, 0)] * (frames.ndim - 2) + [(pad, pad),
+                                                            (0, 0)],
+                    mode='reflect' if frames.shape[-2] > pad else 'edge')
+    windows = sliding_window_view(padded, size, axis=-2)
+    return np.median(windows, axis=-1)
+
+
+def _single_frame_spikes(stack, threshold, size, contrast):
+    # L.A.Cosmic: significance of the positive Laplacian with the large
+    # scale structure removed, and its contrast to the fine structure
+    # (3 x 3 median minus the 7 x 7 median of that), which only a hit
+    # sharper than the point spread has. A line one pixel wide passes
+    # both, so a spike must also stand out from the pixels along the
+    # slit, which a spectral line extending along the slit never does,
+    # and its row neighbours must not share its excess over the columns
+    # either side, as those of a line a few rows tall do.
+    med3 = local_median(stack, 3)
+    read_noise = robust_sigma(stack - med3)
+    noise = np.sqrt(read_noise**2 + np.maximum(med3, 0))
+    edges = np.maximum(laplacian(stack), 0)
+    significance = edges / (_LAPLACIAN_NOISE * np.maximum(noise, 1e-6))
+    significance -= local_median(significance, 5)
+    fine = np.maximum(med3 - local_median(med3, 7), 0)
+    along_slit = slit_median(stack, max(size, 5))
+    padded = np.pad(stack, [(0, 0)] * (stack.ndim - 2) + [(1, 1)] * 2,
+                    mode='edge')
+    sides = (padded[..., 1:-1, :-2] + padded[..., 1:-1, 2:]) / 2
+    rows = np.minimum(padded[..., :-2, 1:-1], padded[..., 2:, 1:-1])
+    spikes = ((significance > threshold)
+              & (edges > contrast * np.maximum(fine, noise))
+              & (stack - along_slit > threshold * noise)
+              & (rows - sides <= _ISOLATION * (stack - sides)))
+    return spikes, along_slit
+
+
+class HotPixelMask:
+    """Persistent per detector mask of hot pixels.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory the masks are stored in.
+
+    """
+
+    def __init__(self, cache_dir=HOT_PIXEL_CACHE):
+        self._cache_dir = cache_dir
+        self._masks = {}
+
+    @staticmethod
+    def detector_key(spe):
+        """Returns (xDimDet, yDimDet, ydim, xdim) of an open SPEFile."""
+        return (int(spe.header['xDimDet']), int(spe.header['yDimDet']),
+                spe.ydim, spe.xdim)
+
+    def mask(self, key):
+        """Returns the bool hot pixel mask for a detector key or None."""
+        if key not in self._masks:
+            filename = self._filename(key)
+            if filename is not None and os.path.isfile(filename):
+                self._masks[key] = np.load(filename)
+            else:
+                return None
+        return self._masks[key]
+
+    def build(self, dark_files, threshold=8.0, force=False):
+        """Finds the hot pixels in dark SPE files and stores the masks.
+
+        A pixel is hot when its mean dark level lies more than threshold
+        robust standard deviations above the median of the frame.
+        Detectors which already have a mask are skipped unless force.
+
+        Returns
+        -------
+        dict
+            The number of hot pixels of every detector key built.
+
+        """
+        groups = {}
+        for filename in dark_files:
+            with sperd.SPEFile(filename) as spe:
+                key = self.detector_key(spe)
+                if not force and self.mask(key) is not None:
+                    continue
+                total = np.zeros((spe.ydim, spe.xdim), dtype=np.float64)
+                for _, frame in spe.iter_frames():
+                    total += frame
+                (mean_sum, count) = groups.get(key, (0, 0))
+                groups[key] = (mean_sum + total, count + spe.num_frames)
+        built = {}
+        for key, (total, count) in groups.items():
+            mean = total / count
+            level = np.median(mean)
+            mask = mean - level > threshold * max(robust_sigma(mean), 1.0)
+            self._masks[key] = mask
+            filename = self._filename(key)
+            if filename is not None:
+                os.makedirs(self._cache_dir, exist_ok=True)
+                np.save(filename + '.tmp.npy', mask)
+                os.replace(filename + '.tmp.npy', filename)
+            built[key] = int(mask.sum())
+        return built
+
+    def repair(self, stack, key):
+        """Replaces hot pixels in place by the median of their neighbours.
+
+        Returns
+        -------
+        bool
+            True if a mask for the detector was found and applied.
+
+        """
+        mask = self.mask(key)
+        if mask is None or mask.shape != stack.shape[-2:]:
+            return False
+        if not mask.any():
+            return True
+        ys, xs = np.nonzero(mask)
+        masked = np.array(stack, dtype=np.float32)
+        masked[..., mask] = np.nan
+        padded = np.pad(masked, [(0, 0)] * (stack.ndim - 2) + [(1, 1)] * 2,
+                        mode='edge')
+        # 3 x 3 neighbourhoods of the hot pixels only, hot ones ignored
+        offsets = np.arange(-1, 2)
+        rows = ys[:, np.newaxis, np.newaxis] + 1 + offsets[:, np.newaxis]
+        cols = xs[:, np.newaxis, np.newaxis] + 1 + offsets[np.newaxis, :]
+        neighbours = padded[..., rows, cols]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            values = np.nanmedian(
+                neighbours.reshape(neighbours.shape[:-2] + (-1,)), axis=-1)
+        stack[..., ys, xs] = np.where(np.isnan(values),
+                                      np.median(stack), values)
+        return True
+
+    def stamp(self):
+        """Returns the sorted (name, mtime_ns, size) of every stored mask,
+        which changes whenever a mask is built."""
+        if self._cache_dir is None or not os.path.isdir(self._cache_dir):
+            return []
+        stamps = []
+        with os.scandir(self._cache_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('hotpix_') \
+                        and entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    stamps.append([entry.name, stat.st_mtime_ns,
+                                   stat.st_size])
+        return sorted(stamps)
+
+    def _filename(self, key):
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir,
+                            'hotpix_%dx%d_%dx%d.npy' % key)
+
+
+class CosmicRayFilter:
+    """Correction stage removing hot pixels and cosmic rays.
+
+    Calling the filter with a float32 (frames, y, x) chunk and the SPEFile
+    it came from cleans the chunk in place and returns it. The first
+    context frames of the chunk are earlier frames given only as
+    reference for the stack test, their spikes are not counted, and
+    neither are any when count is False (a repeated pass over the same
+    frames).
+
+    Parameters
+    ----------
+    hot_pixels : HotPixelMask, optional
+        Hot pixel masks to apply before spike detection.
+    threshold : float
+        Spike detection threshold in standard deviations.
+    size : int
+        Rows of the median along the slit for single frames, see
+        find_cosmic_rays.
+
+    """
+
+    def __init__(self, hot_pixels=None, threshold=6.0, size=3):
+        self._hot_pixels = hot_pixels
+        self._threshold = threshold
+        self._size = size
+        self.spikes = 0
+
+    def __call__(self, stack, spe=None, context=0, count=True):
+        if self._hot_pixels is not None and spe is not None:
+            self._hot_pixels.repair(stack, HotPixelMask.detector_key(spe))
+        spikes, replacement = find_cosmic_rays(stack, self._threshold,
+                                               self._size)
+        np.copyto(stack, replacement, where=spikes)
+        if count:
+            self.spikes += int(spikes[context:].sum())
+        return stack
@@ -0,0 +1,408 @@
+"""SPE Spectral Cube
+
+This module assembles the SPE files of a Zaber position and/or LCVR
+voltage scan into one hyperspectral cube, a raw float32 file of records
+with a JSON sidecar holding the wavelength axis, the scan coordinates of
+every record and the source files.
+
+Each record is one file reduced to a (row, wavelength) image, or to a
+single spectrum when the rows are summed. Records are appended while the
+scan is still running, and the cube is read back as a memory map of shape
+(record, [row,] wavelength), which grid rearranges into (voltage,
+position, [row,] wavelength). Spectral maps of any band are sliced
+without opening the individual files.
+
+The sidecar is only rewritten after a record's data is on disk, so a
+reader never sees a partial record.
+
+For repeated band queries build_index keeps a float64 cumulative sum of
+every record along the wavelength axis next to the cube, after which any
+band integral is two lookups and a subtraction. The index is extended
+with the records appended since it was last brought up to date.
+"""
+
+import json
+import os
+import tempfile
+import numpy as np
+import spereadNew as sperd
+import spe_background
+import scan_params
+
+CUBE_VERSION = 1
+
+# scan coordinates recorded for every record
+COORDINATES = ('voltage', 'position', 'power', 'od')
+
+# largest block of records read at a time while building the band index
+_INDEX_BLOCK_BYTES = 64 * 2**20
+
+
+class SpectralCube:
+    """Appendable, memory-mapped cube of spectra.
+
+    Use create_cube to start a new cube, this opens an existing one.
+
+    Parameters
+    ----------
+    filename : str
+        The raw data file, the sidecar is filename + '.json'.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(self.sidecar) as file:
+            meta = json.load(file)
+        if meta['version'] > CUBE_VERSION:
+            raise Exception("Spectral cube %s is of a newer version"
+                            % filename)
+        self._meta = meta
+        self._data = None
+
+    @property
+    def sidecar(self):
+        return self.filename + '.json'
+
+    @property
+    def record_shape(self):
+        return tuple(self._meta['record_shape'])
+
+    @property
+    def count(self):
+        return self._meta['count']
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def wavelength(self):
+        return np.array(self._meta['wavelength'])
+
+    @property
+    def rows(self):
+        """The (start, stop) detector rows of every record."""
+        return tuple(self._meta['rows'])
+
+    @property
+    def summed(self):
+        """True if the rows of every record are summed into a spectrum."""
+        return self._meta['summed']
+
+    @property
+    def coords(self):
+        """Dict of the scan coordinates of every record, NaN if unknown."""
+        return {name: np.array(values, dtype=np.float64)
+                for name, values in self._meta['coords'].items()}
+
+    @property
+    def sources(self):
+        return list(self._meta['sources'])
+
+    @property
+    def data(self):
+        """Read-only (record, [row,] wavelength) memory map."""
+        if self._data is None or self._data.shape[0] != self.count:
+            if self.count == 0:
+                return np.empty((0,) + self.record_shape, np.float32)
+            self._data = np.memmap(self.filename, np.float32, 'r',
+                                   shape=(self.count,) + self.record_shape)
+        return self._data
+
+    def refresh(self):
+        """Re-reads the sidecar to see records appended by another
+        process."""
+        with open(self.sidecar) as file:
+            self._meta = json.load(file)
+
+    def append(self, record, source=None, **coords):
+        """Appends one record.
+
+        Parameters
+        ----------
+        record : ndarray
+            Array of record_shape.
+        source : str, optional
+            File the record was taken from.
+        **coords : float
+            Scan coordinates of the record, see COORDINATES.
+
+        """
+        record = np.asarray(record, dtype='<f4')
+        if record.shape != self.record_shape:
+            raise Exception("Record shape does not match the cube")
+        with open(self.filename, 'r+b') as file:
+            # overwrite whatever an interrupted append left behind
+            file.seek(self.count * record.nbytes)
+            file.write(record.tobytes())
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+        for name in COORDINATES:
+            value = coords.get(name)
+            self._meta['coords'][name].append(
+                None if value is None else float(value))
+        self._meta['sources'].append(source)
+        self._meta['count'] += 1
+        self._save()
+
+    def append_spe(self, spe_filename, background=None):
+        """Reduces an SPE file and appends it with the scan coordinates
+        parsed from its name (the last zaber token is the position)."""
+        record, wavelength = _reduce(spe_filename, self.rows, self.summed,
+                                     background)
+        if not np.allclose(wavelength, self._meta['wavelength']):
+            raise Exception("Wavelength axis of %s does not match the cube"
+                            % spe_filename)
+        params = scan_params.parse_scan_filename(spe_filename)
+        self.append(record, os.path.abspath(spe_filename),
+                    voltage=params['voltage'], position=params['zaber'],
+                    power=params['power'], od=params['od'])
+
+    @property
+    def index_filename(self):
+        return self.filename + '.cumsum'
+
+    def build_index(self):
+        """Creates or extends the band index to cover every record.
+
+        The index holds, for every record, the float64 cumulative sum
+        along the wavelength axis with a leading zero, so it takes twice
+        the space of the cube itself.
+
+        Returns
+        -------
+        int
+            The number of records added to the index.
+
+        """
+        done = self._indexed_count()
+        count = self.count
+        if done >= count:
+            return 0
+        record_bytes = 4 * int(np.prod(self.record_shape))
+        block = max(1, _INDEX_BLOCK_BYTES // record_bytes)
+        data = self.data
+        with open(self.index_filename, 'r+b' if done else 'wb') as file:
+            file.seek(done * self._index_record_bytes())
+            for start in range(done, count, block):
+                records = np.asarray(data[start:start + block],
+                                     dtype=np.float64)
+                cumsum = np.zeros(records.shape[:-1]
+                                  + (records.shape[-1] + 1,), '<f8')
+                np.cumsum(records, axis=-1, out=cumsum[..., 1:])
+                file.write(cumsum.tobytes())
+            file.truncate()
+        return count - done
+
+    @property
+    def band_index(self):
+        """Read-only (record, [row,] wavelength + 1) memory map of the
+        band index, None if it has not been built."""
+        done = self._indexed_count()
+        if done == 0:
+            return None
+        shape = self.record_shape[:-1] + (self.record_shape[-1] + 1,)
+        return np.memmap(self.index_filename, '<f8', 'r',
+                         shape=(done,) + shape)
+
+    def _index_record_bytes(self):
+        return 8 * int(np.prod(self.record_shape[:-1])) \
+            * (self.record_shape[-1] + 1)
+
+    def _indexed_count(self):
+        try:
+            size = os.path.getsize(self.index_filename)
+        except OSError:
+            return 0
+        return min(self.count, size // self._index_record_bytes())
+
+    def band_columns(self, wl_min, wl_max):
+        """Returns the (start, stop) wavelength columns of a band."""
+        wavelength = self.wavelength
+        inside = np.flatnonzero((wavelength >= min(wl_min, wl_max))
+                                & (wavelength <= max(wl_min, wl_max)))
+        if inside.size == 0:
+            return 0, 0
+        return int(inside[0]), int(inside[-1]) + 1
+
+    def band_map(self, wl_min, wl_max, axes=None):
+        """Integrates every record over a wavelength band.
+
+        Once build_index has been called the integrals come from the
+        band index, which is first extended to any new records.
+
+        Parameters
+        ----------
+        wl_min, wl_max : float
+            The band in nm.
+        axes : tuple of str, optional
+            Coordinates to grid the result by, see grid.
+
+        Returns
+        -------
+        ndarray or tuple
+            (record, [row]) float64 band integrals, or the result of grid
+            if axes are given.
+
+        """
+        (start, stop) = self.band_columns(wl_min, wl_max)
+        if os.path.isfile(self.index_filename):
+            self.build_index()
+            index = self.band_index
+        else:
+            index = None
+        if index is not None:
+            band = index[..., stop] - index[..., start]
+        else:
+            band = self.data[..., start:stop].sum(axis=-1, dtype=np.float64)
+        if axes is None:
+            return band
+        return self.grid(axes, band)
+
+    def grid(self, axes=('voltage', 'position'), values=None):
+        """Arranges records on the grid of their scan coordinates.
+
+        Parameters
+        ----------
+        axes : tuple of str
+            Coordinate names, one grid dimension each.
+        values : ndarray, optional
+            Per record values such as a band_map, the records themselves
+            by default.
+
+        Returns
+        -------
+        tuple
+            (array of shape (len(axis) for each axis) + values.shape[1:],
+            NaN where no record was taken, list of the sorted coordinate
+            values of each axis). A later record at the same coordinates
+            replaces an earlier one.
+
+        """
+        if values is None:
+            values = self.data
+        coords = self.coords
+        index = []
+        axis_values = []
+        for name in axes:
+            unique, inverse = np.unique(coords[name], return_inverse=True)
+            axis_values.append(unique)
+            index.append(inverse.reshape(-1))
+        shape = tuple(len(v) for v in axis_values) + values.shape[1:]
+        gridded = np.full(shape, np.nan, dtype=np.float64 if values.dtype
+                          == np.float64 else np.float32)
+        gridded[tuple(index)] = values
+        return gridded, axis_values
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.sidecar))
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(self._meta, file)
+        os.replace(tmp_name, self.sidecar)
+
+
+def create_cube(filename, wavelength, record_shape, rows=None, summed=False):
+    """Creates an empty cube and returns it opened.
+
+    Parameters
+    ----------
+    filename : str
+        The raw data file to create.
+    wavelength : ndarray
+        The wavelength axis, the last dimension of every record.
+    record_shape : tuple of int
+        Shape of each record.
+    rows : tuple of int, optional
+        (start, stop) detector rows the records hold.
+    summed : bool
+        True if the rows are summed into one spectrum per record.
+
+    """
+    meta = {
+        'version': CUBE_VERSION,
+        'record_shape': list(record_shape),
+        'count': 0,
+        'wavelength': [float(w) for w in wavelength],
+        'rows': list(rows) if rows is not None else None,
+        'summed': bool(summed),
+        'coords': {name: [] for name in COORDINATES},
+        'sources': [],
+        }
+    open(filename, 'wb').close()
+    # a band index left by an earlier cube of the same name is stale
+    if os.path.exists(filename + '.cumsum'):
+        os.remove(filename + '.cumsum')
+    with open(filename + '.json', 'w') as file:
+        json.dump(meta, file)
+    return SpectralCube(filename)
+
+
+def open_cube(filename, spe_filename=None, rows=None, summed=False):
+    """Opens a cube, creating it to match an SPE file if it is missing.
+
+    Parameters
+    ----------
+    filename : str
+        The raw data file of the cube.
+    spe_filename : str, optional
+        The first file of the scan, required to create the cube.
+    rows : tuple of int, optional
+        (start, stop) detector rows kept, all by default.
+    summed : bool
+        Sum the rows of every file into one spectrum.
+
+    """
+    if os.path.isfile(filename + '.json'):
+        return SpectralCube(filename)
+    if spe_filename is None:
+        raise Exception("Spectral cube %s does not exist" % filename)
+    with sperd.SPEFile(spe_filename) as spe:
+        (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+        wavelength = spe.xaxis
+        shape = (spe.xdim,) if summed else (r1 - r0, spe.xdim)
+    return create_cube(filename, wavelength, shape, (r0, r1), summed)
+
+
+def build_cube(filename, spe_filenames, rows=None, summed=False,
+               background=None):
+    """Assembles a cube from the SPE files of a scan.
+
+    Files are appended in (voltage, position) order of their names.
+
+    Returns
+    -------
+    SpectralCube
+        The cube, new or extended.
+
+    """
+    def order(spe_filename):
+        params = scan_params.parse_scan_filename(spe_filename)
+        return tuple(np.inf if params[name] is None else params[name]
+                     for name in ('voltage', 'zaber'))
+    spe_filenames = sorted(spe_filenames, key=order)
+    if not spe_filenames:
+        raise Exception("No SPE files to build the cube from")
+    cube = open_cube(filename, spe_filenames[0], rows, summed)
+    known = set(cube.sources)
+    for spe_filename in spe_filenames:
+        if os.path.abspath(spe_filename) not in known:
+            cube.append_spe(spe_filename, background)
+    return cube
+
+
+def _reduce(spe_filename, rows, summed, background):
+    # mean of all frames over the cube rows, minus the dark
+    with sperd.SPEFile(spe_filename) as spe:
+        roi = spe.read_roi(rows=rows)
+        image = roi.mean(axis=0, dtype=np.float64).astype(np.float32)
+        if background is not None:
+            master = background.master(spe_background.dark_key(spe))
+            if master is not None and master.shape == (spe.ydim, spe.xdim):
+                (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+                image -= master[r0:r1]
+        wavelength = np.array(spe.xaxis)
+    if summed:
+        image = image.sum(axis=0)
+    return image, wavelength
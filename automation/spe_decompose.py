@@ -0,0 +1,337 @@
+"""SPE Streaming Decomposition
+
+This module breaks large sets of spectra, the frames of a power series or
+the records of a hyperspectral scan, into a few spectral components
+without ever holding the whole data set in memory.
+
+Spectra are streamed in mini-batches from SPE files, an SPE archive or a
+spectral cube into an incremental PCA (the sequential Karhunen-Loeve
+update of Ross et al., which keeps only the current components and their
+singular values). An optional online NMF pass, which keeps only the
+running sufficient statistics of the factorisation, fits non-negative
+components from the PCA start. Memory use is set by the batch size
+alone.
+
+decompose writes the component spectra and the mean scores of every
+source file to an npz file.
+"""
+
+import numpy as np
+import spereadNew as sperd
+import spe_archive
+import spe_cube
+
+
+class IncrementalPCA:
+    """Principal components fitted batch by batch.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of components kept.
+
+    """
+
+    def __init__(self, n_components):
+        self.n_components = int(n_components)
+        self.n_samples_seen = 0
+        self.mean = None
+        self.components = None
+        self.singular_values = None
+        self.explained_variance = None
+
+    def partial_fit(self, spectra):
+        """Updates the components with a (spectra, points) batch.
+
+        The first batch must hold at least n_components spectra.
+
+        """
+        spectra = np.asarray(spectra, dtype=np.float64)
+        n = spectra.shape[0]
+        if n == 0:
+            return self
+        if self.n_samples_seen == 0 and n < self.n_components:
+            raise Exception("The first batch needs at least %d spectra"
+                            % self.n_components)
+        batch_mean = spectra.mean(axis=0)
+        total = self.n_samples_seen + n
+        centred = spectra - batch_mean
+        if self.n_samples_seen == 0:
+            stacked = centred
+            mean = batch_mean
+        else:
+            # old components weighted by their singular values, the new
+            # batch, and the shift between the old and new means
+            correction = (np.sqrt(self.n_samples_seen * n / total)
+                          * (self.mean - batch_mean))
+            stacked = np.vstack((self.singular_values[:, np.newaxis]
+                                 * self.components, centred, correction))
+            mean = self.mean + (batch_mean - self.mean) * (n / total)
+        _, s, vt = np.linalg.svd(stacked, full_matrices=False)
+        # fix the sign of every component so that repeated fits agree
+        signs = np.sign(vt[np.arange(vt.shape[0]),
+                           np.argmax(np.abs(vt), axis=1)])
+        vt *= signs[:, np.newaxis]
+        k = min(self.n_components, vt.shape[0])
+        self.components = vt[:k]
+        self.singular_values = s[:k]
+        self.explained_variance = s[:k]**2 / max(total - 1, 1)
+        self.mean = mean
+        self.n_samples_seen = total
+        return self
+
+    def transform(self, spectra):
+        """Returns the (spectra, components) scores of a batch."""
+        return (np.asarray(spectra, dtype=np.float64) - self.mean) \
+            @ self.components.T
+
+
+class OnlineNMF:
+    """Non-negative factorisation spectra ~ scores @ components, fitted
+    batch by batch from the running statistics scores.T @ scores and
+    scores.T @ spectra with hierarchical alternating least squares.
+
+    Parameters
+    ----------
+    components : ndarray
+        (components, points) non-negative starting components.
+    sweeps : int
+        Alternating least squares sweeps over the components for the
+        scores and the components of every batch.
+
+    """
+
+    def __init__(self, components, sweeps=3):
+        self.components = np.maximum(np.asarray(components, np.float64),
+                                     1e-12)
+        self.sweeps = int(sweeps)
+        self.new_pass()
+
+    def new_pass(self):
+        """Forgets the statistics of the previous pass over the data, which
+        were gathered with less converged components."""
+        k = self.components.shape[0]
+        self._hth = np.zeros((k, k))
+        self._htx = np.zeros(self.components.shape)
+
+    def transform(self, spectra):
+        """Returns the non-negative (spectra, components) scores."""
+        spectra = np.maximum(np.asarray(spectra, dtype=np.float64), 0)
+        w = self.components
+        wwt = w @ w.T
+        xwt = spectra @ w.T
+        # clipped least squares start, then alternating least squares
+        h = np.maximum(np.linalg.lstsq(wwt, xwt.T, rcond=None)[0].T, 0)
+        for _ in range(self.sweeps):
+            for j in range(h.shape[1]):
+                h[:, j] = np.maximum(h[:, j] + (xwt[:, j] - h @ wwt[:, j])
+                                     / max(wwt[j, j], 1e-12), 0)
+        return h
+
+    def partial_fit(self, spectra):
+        """Updates the components with a (spectra, points) batch."""
+        spectra = np.maximum(np.asarray(spectra, dtype=np.float64), 0)
+        h = self.transform(spectra)
+        self._hth += h.T @ h
+        self._htx += h.T @ spectra
+        w = self.components
+        for _ in range(self.sweeps):
+            for j in range(w.shape[0]):
+                w[j] = np.maximum(w[j] + (self._htx[j] - self._hth[j] @ w)
+                                  / max(self._hth[j, j], 1e-12), 1e-12)
+        return self
+
+
+def spectrum_batches(source, batch_size=256, rows=None, per_row=False):
+    """Yields (file index, spectra) mini-batches of a data source.
+
+    Parameters
+    ----------
+    source : list of str, SPEArchive or SpectralCube
+        SPE files, the files of an archive or the records of a cube.
+    batch_size : int
+        Largest number of spectra per batch.
+    rows : tuple of int, optional
+        (start, stop) rows of every frame, all by default.
+    per_row : bool
+        Take every row as a spectrum instead of the sum of the rows.
+
+    Yields
+    ------
+    tuple
+        (int array with the file or record index of every spectrum,
+        float64 (spectra, points) array).
+
+    """
+    buffer = []
+    owners = []
+    held = 0
+    for index, block in _blocks(source, rows):
+        if per_row and block.ndim == 3:
+            spectra = block.reshape(-1, block.shape[-1])
+        elif block.ndim == 3:
+            spectra = block.sum(axis=1, dtype=np.float64)
+        else:
+            spectra = block
+        buffer.append(np.asarray(spectra, dtype=np.float64))
+        owners.append(np.full(spectra.shape[0], index))
+        held += spectra.shape[0]
+        while held >= batch_size:
+            spectra = np.concatenate(buffer)
+            owner = np.concatenate(owners)
+            yield owner[:batch_size], spectra[:batch_size]
+            buffer = [spectra[batch_size:]]
+            owners = [owner[batch_size:]]
+            held -= batch_size
+    if held:
+        yield np.concatenate(owners), np.concatenate(buffer)
+
+
+def decompose(source, n_components=5, batch_size=256, rows=None,
+              per_row=False, nmf=False, nmf_passes=5, output=None):
+    """Decomposes a data source into spectral components.
+
+    The source is streamed once for the PCA, once more per NMF pass, and
+    a last time to score every file.
+
+    Parameters
+    ----------
+    source : list of str, SPEArchive or SpectralCube
+        See spectrum_batches.
+    n_components : int
+        Number of components.
+    batch_size, rows, per_row
+        See spectrum_batches.
+    nmf : bool
+        Also fit non-negative components, started from the PCA.
+    nmf_passes : int
+        Number of passes over the data of the NMF fit.
+    output : str, optional
+        npz file the result is saved to.
+
+    Returns
+    -------
+    dict
+        'mean', 'components' and 'explained_variance' of the PCA,
+        'scores' (files, components) mean PCA score of the spectra of
+        every file and 'counts' their number, plus 'nmf_components' and
+        'nmf_scores' if nmf, and 'wavelength' if the source has one.
+
+    """
+    pca = IncrementalPCA(n_components)
+    pending = []
+    for _, spectra in spectrum_batches(source, batch_size, rows, per_row):
+        # hold back batches until the first fit has enough spectra
+        if pca.n_samples_seen == 0:
+            pending.append(spectra)
+            if sum(p.shape[0] for p in pending) < n_components:
+                continue
+            spectra = np.concatenate(pending)
+            pending = []
+        pca.partial_fit(spectra)
+    if pca.n_samples_seen == 0:
+        raise Exception("Fewer spectra than components")
+
+    model = None
+    if nmf:
+        # NNDSVD-like start: the mean spectrum, then the largest positive
+        # and negative parts of the principal components scaled to it
+        mean = np.maximum(pca.mean, 0)
+        parts = [np.maximum(sign * component, 0)
+                 for component in pca.components for sign in (1, -1)]
+        parts.sort(key=np.linalg.norm, reverse=True)
+        start = np.array([mean] + parts[:n_components - 1])
+        start[1:] *= np.linalg.norm(mean) or 1.0
+        model = OnlineNMF(start)
+        for _ in range(max(1, int(nmf_passes))):
+            model.new_pass()
+            for _, spectra in spectrum_batches(source, batch_size, rows,
+                                               per_row):
+                model.partial_fit(spectra)
+
+    n_files = _source_length(source)
+    totals = np.zeros((n_files, pca.components.shape[0]))
+    nmf_totals = np.zeros((n_files, n_components)) if nmf else None
+    counts = np.zeros(n_files, dtype=np.int64)
+    for owner, spectra in spectrum_batches(source, batch_size, rows,
+                                           per_row):
+        np.add.at(totals, owner, pca.transform(spectra))
+        if nmf:
+            np.add.at(nmf_totals, owner, model.transform(spectra))
+        np.add.at(counts, owner, 1)
+    scale = 1 / np.maximum(counts, 1)[:, np.newaxis]
+    result = {
+        'mean': pca.mean,
+        'components': pca.components,
+        'explained_variance': pca.explained_variance,
+        'scores': totals * scale,
+        'counts': counts,
+        }
+    if nmf:
+        result['nmf_components'] = model.components
+        result['nmf_scores'] = nmf_totals * scale
+    wavelength = _source_wavelength(source)
+    if wavelength is not None:
+        result['wavelength'] = wavelength
+    if output is not None:
+        np.savez(output, sources=np.array(_source_names(source)), **result)
+    return result
+
+
+def _blocks(source, rows):
+    # (file or record index, (frames, rows, points) or (records, points))
+    if isinstance(source, spe_cube.SpectralCube):
+        data = source.data
+        step = 64
+        for start in range(0, source.count, step):
+            block = np.asarray(data[start:start + step], dtype=np.float64)
+            if rows is not None and block.ndim == 3:
+                block = block[:, rows[0]:rows[1]]
+            for i in range(block.shape[0]):
+                yield start + i, block[i:i + 1]
+        return
+    if isinstance(source, spe_archive.SPEArchive):
+        for index in range(len(source)):
+            for frame in range(int(source.columns['num_frames'][index])):
+                image = source.read_frame(index, frame)
+                if rows is not None:
+                    image = image[rows[0]:rows[1]]
+                yield index, image[np.newaxis]
+        return
+    xdim = None
+    for index, filename in enumerate(source):
+        with sperd.SPEFile(filename) as spe:
+            if xdim is None:
+                xdim = spe.xdim
+            elif spe.xdim != xdim:
+                raise Exception("SPE file %s has a different width"
+                                % filename)
+            for _, chunk in spe.iter_chunks():
+                if rows is not None:
+                    chunk = chunk[:, rows[0]:rows[1]]
+                yield index, chunk
+
+
+def _source_length(source):
+    if isinstance(source, spe_cube.SpectralCube):
+        return source.count
+    return len(source)
+
+
+def _source_names(source):
+    if isinstance(source, spe_cube.SpectralCube):
+        return [str(s) for s in source.sources]
+    if isinstance(source, spe_archive.SPEArchive):
+        return source.columns['path']
+    return list(source)
+
+
+def _source_wavelength(source):
+    if isinstance(source, spe_cube.SpectralCube):
+        return source.wavelength
+    if isinstance(source, spe_archive.SPEArchive):
+        return np.array(source.xaxis(0)) if len(source) else None
+    if len(source):
+        with sperd.SPEFile(source[0]) as spe:
+            return np.array(spe.xaxis)
+    return None
@@ -0,0 +1,208 @@
+"""SPE Dispersion Extraction
+
+This module extracts the mode dispersion E(k) from far field SPE files:
+the frames of every file are averaged over its region of interest,
+remapped onto uniform k and E axes with spe_kspace, the peak energy of
+every k row is found with parabolic sub-pixel refinement, and the
+parabola E = E0 + HBAR2_2M0 / m * k**2 is fitted to give the band bottom
+E0 and the effective mass m (in electron masses) of the file.
+
+dispersion_series runs a whole power or position series through a process
+pool and returns the results as columns, one entry per file.
+"""
+
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import spereadNew as sperd
+import spe_background
+import spe_kspace
+
+# hbar**2 / (2 * electron mass) in eV um**2
+HBAR2_2M0 = 3.80998e-8
+
+
+def peak_positions(images, axis, min_signal=0.0):
+    """Returns the peak position along the last axis of every row.
+
+    The brightest pixel of every row is refined to sub-pixel accuracy
+    with the vertex of the parabola through it and its two neighbours.
+
+    Parameters
+    ----------
+    images : ndarray
+        (..., rows, points) array, e.g. a (files, k, E) stack.
+    axis : ndarray
+        Uniformly spaced coordinate of the last axis.
+    min_signal : float
+        Rows whose peak does not exceed this value are NaN.
+
+    Returns
+    -------
+    tuple of ndarray
+        (positions, peak heights), NaN positions where no peak was found
+        or it sits on the edge of the axis.
+
+    """
+    images = np.asarray(images, dtype=np.float64)
+    axis = np.asarray(axis, dtype=np.float64)
+    index = np.argmax(images, axis=-1)
+    inner = np.clip(index, 1, images.shape[-1] - 2)[..., np.newaxis]
+    left = np.take_along_axis(images, inner - 1, axis=-1)[..., 0]
+    center = np.take_along_axis(images, inner, axis=-1)[..., 0]
+    right = np.take_along_axis(images, inner + 1, axis=-1)[..., 0]
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0)
+    shift = np.clip(shift, -0.5, 0.5)
+    step = (axis[-1] - axis[0]) / (axis.size - 1)
+    positions = axis[0] + (inner[..., 0] + shift) * step
+    height = np.take_along_axis(images, index[..., np.newaxis], axis=-1)[..., 0]
+    bad = ((index == 0) | (index == images.shape[-1] - 1)
+           | ~(height > min_signal))
+    positions[bad] = np.nan
+    return positions, height
+
+
+def fit_parabolic_dispersion(k, energy, k_max=None):
+    """Fits E = E0 + HBAR2_2M0 / m * k**2 to one or many dispersions.
+
+    Parameters
+    ----------
+    k : ndarray
+        (..., points) in-plane wavevectors in 1/um.
+    energy : ndarray
+        (..., points) peak energies in eV, NaN points are ignored.
+    k_max : float, optional
+        Only fit points with abs(k) <= k_max.
+
+    Returns
+    -------
+    dict
+        'E0' (eV), 'mass' (electron masses, inf for a flat band),
+        'curvature' (eV um**2), 'rms' (eV) and 'points' (number of
+        points fitted) arrays of the leading shape.
+
+    """
+    k = np.asarray(k, dtype=np.float64)
+    energy = np.asarray(energy, dtype=np.float64)
+    k, energy = np.broadcast_arrays(k, energy)
+    use = ~np.isnan(energy)
+    if k_max is not None:
+        use &= np.abs(k) <= k_max
+    # normal equations of the linear model E = E0 + a * k**2
+    x = np.where(use, k**2, 0)
+    y = np.where(use, energy, 0)
+    n = use.sum(axis=-1)
+    sx = x.sum(axis=-1)
+    sxx = (x * x).sum(axis=-1)
+    sy = y.sum(axis=-1)
+    sxy = (x * y).sum(axis=-1)
+    det = n * sxx - sx**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = np.where(det > 0, (n * sxy - sx * sy) / det, np.nan)
+        e0 = np.where(det > 0, (sy - curvature * sx) / n, np.nan)
+        residual = np.where(use, energy - e0[..., np.newaxis]
+                            - curvature[..., np.newaxis] * k**2, 0)
+        rms = np.sqrt((residual**2).sum(axis=-1) / n)
+        mass = HBAR2_2M0 / curvature
+    return {'E0': e0, 'mass': mass, 'curvature': curvature, 'rms': rms,
+            'points': n}
+
+
+def extract_dispersion(filename, rows=None, cols=None, ypixsize=20,
+                       fobj=4000, k_grid=None, energy_grid=None, center=None,
+                       background=None, min_signal=0.0, k_max=None):
+    """Extracts and fits the dispersion of one far field SPE file.
+
+    Parameters
+    ----------
+    filename : str
+        The SPE file, all its frames are averaged.
+    rows, cols : tuple of int, optional
+        Half open (start, stop) region of interest, the whole frame by
+        default. Only these rows are read from disk.
+    ypixsize, fobj, k_grid, energy_grid, center
+        Remapping geometry, see spe_kspace.KSpaceRemapper.
+    background : BackgroundEngine, optional
+        Subtract the matching master dark before remapping.
+    min_signal : float
+        Smallest peak height of a k row to be used.
+    k_max : float, optional
+        Fit only abs(k) <= k_max, in 1/um.
+
+    Returns
+    -------
+    dict
+        'k' and 'energy' (peak energy per k row) arrays, 'height' of the
+        peaks and the fit results of fit_parabolic_dispersion.
+
+    """
+    with sperd.SPEFile(filename) as spe:
+        roi = spe.read_roi(rows=rows, cols=cols)
+        image = roi.mean(axis=0, dtype=np.float64).astype(np.float32)
+        if background is not None:
+            master = background.master(spe_background.dark_key(spe))
+            if master is not None and master.shape == (spe.ydim, spe.xdim):
+                (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+                (c0, c1, _) = slice(*(cols or (None,))).indices(spe.xdim)
+                image -= master[r0:r1, c0:c1]
+        remapper = spe_kspace.remapper_for(spe, ypixsize, fobj, k_grid,
+                                           energy_grid, center, rows, cols)
+    remapped = remapper(image)
+    energy, height = peak_positions(remapped, remapper.energy_axis,
+                                    min_signal)
+    result = {'k': np.array(remapper.k_axis), 'energy': energy,
+              'height': height}
+    fit = fit_parabolic_dispersion(remapper.k_axis, energy, k_max)
+    result.update((name, value[()]) for name, value in fit.items())
+    return result
+
+
+def dispersion_series(filenames, workers=1, **options):
+    """Extracts the dispersion of every file of a series.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The far field SPE files.
+    workers : int
+        Number of worker processes, 1 runs in the current process.
+    **options
+        Passed on to extract_dispersion.
+
+    Returns
+    -------
+    dict
+        'filename' and 'error' lists, 'E0', 'mass', 'curvature', 'rms'
+        and 'points' arrays, and 'k', 'energy' lists of per file arrays,
+        one entry per file in the order given. Failed files have NaN
+        results, None curves and their error message set.
+
+    """
+    filenames = list(filenames)
+    extract = functools.partial(_extract_file, options=options)
+    if workers > 1 and len(filenames) > 1:
+        chunksize = max(1, len(filenames) // (workers * 4))
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(extract, filenames, chunksize=chunksize))
+    else:
+        results = [extract(file) for file in filenames]
+    series = {'filename': filenames,
+              'error': [message for _, message in results]}
+    for name in ('E0', 'mass', 'curvature', 'rms', 'points'):
+        series[name] = np.array([np.nan if result is None else result[name]
+                                 for result, _ in results])
+    for name in ('k', 'energy'):
+        series[name] = [None if result is None else result[name]
+                        for result, _ in results]
+    return series
+
+
+def _extract_file(filename, options):
+    # errors are returned rather than raised so one bad file does not
+    # abort the series
+    try:
+        return extract_dispersion(filename, **options), None
+    except Exception as err:
+        return None, str(err)
@@ -0,0 +1,162 @@
+"""SPE K-Space Remapping
+
+This module resamples far field (angle resolved) spectral images from
+detector pixels onto uniform in-plane wavevector k (1/um) and photon
+energy E (eV) grids, giving dispersion images E(k).
+
+Row r of a far field image sits at sin(angle) = ypixsize*(r - center)/fobj
+and k = 2*pi/wavelength * sin(angle), so the pixel feeding a given (k, E)
+point depends on both coordinates. The bilinear interpolation weights of
+every output point are built once per geometry into a sparse matrix and a
+whole frame stack is then remapped with a single sparse matrix product.
+"""
+
+import functools
+import math
+import numpy as np
+import scipy.sparse
+import spe_calibration
+
+
+class KSpaceRemapper:
+    """Sparse (k, E) resampling operator for one far field geometry.
+
+    Use get_remapper rather than creating these directly, so that equal
+    geometries share one operator.
+
+    Parameters
+    ----------
+    calibration : Calibration
+        Wavelength calibration of the images.
+    ydim : int
+        Number of rows of the images.
+    ypixsize, fobj : float
+        Pixel size and objective focal length in um.
+    k_grid : tuple, optional
+        (k_min, k_max, count) in 1/um, by default the k range seen at
+        every wavelength with one point per row.
+    energy_grid : tuple, optional
+        (E_min, E_max, count) in eV, by default the calibrated range
+        with one point per column.
+    center : float, optional
+        Row of normal emission, (ydim - 1) // 2 by default.
+    rows, cols : tuple of int, optional
+        Half open (start, stop) window the input images are cut to, as
+        read by SPEFile.read_roi. The whole frame by default.
+
+    """
+
+    def __init__(self, calibration, ydim, ypixsize, fobj, k_grid=None,
+                 energy_grid=None, center=None, rows=None, cols=None):
+        if center is None:
+            center = (ydim - 1) // 2
+        (r0, r1, _) = slice(*(rows or (None,))).indices(ydim)
+        (c0, c1, _) = slice(*(cols or (None,))).indices(calibration.xdim)
+        wavelength = np.asarray(calibration.wavelength[c0:c1])
+        xdim = wavelength.size
+        ny = r1 - r0
+        if ny < 2 or xdim < 2:
+            raise Exception("Remapping needs at least 2 x 2 pixels")
+        if energy_grid is None:
+            energy = calibration.energy[c0:c1]
+            energy_grid = (float(energy.min()), float(energy.max()), xdim)
+        if k_grid is None:
+            # the k range of a row shrinks with wavelength, keep the part
+            # seen at every wavelength of the window
+            k_scale = 2 * math.pi * 1000 / float(wavelength.max())
+            k_grid = (k_scale * ypixsize * (r0 - center) / fobj,
+                      k_scale * ypixsize * (r1 - 1 - center) / fobj, ny)
+        self.shape = (ny, xdim)
+        self.k_axis = np.linspace(*k_grid)
+        self.energy_axis = np.linspace(*energy_grid)
+        self.k_axis.setflags(write=False)
+        self.energy_axis.setflags(write=False)
+        # rows are counted within the window from here on
+        ydim = ny
+        center = center - r0
+
+        # fractional detector column of every output energy
+        out_wavelength = spe_calibration.HC_EV_NM / self.energy_axis
+        pixels = np.arange(xdim, dtype=np.float64)
+        if wavelength[-1] < wavelength[0]:
+            xf = np.interp(out_wavelength, wavelength[::-1], pixels[::-1],
+                           left=np.nan, right=np.nan)
+        else:
+            xf = np.interp(out_wavelength, wavelength, pixels,
+                           left=np.nan, right=np.nan)
+        # fractional detector row of every output (k, E)
+        sin_angle = (self.k_axis[:, np.newaxis] * out_wavelength[np.newaxis]
+                     / (2 * math.pi * 1000))
+        yf = center + sin_angle * fobj / ypixsize
+        xf = np.broadcast_to(xf[np.newaxis], yf.shape)
+
+        valid = ((xf >= 0) & (xf <= xdim - 1) & (yf >= 0) & (yf <= ydim - 1))
+        out_index = np.flatnonzero(valid)
+        xf = xf.ravel()[out_index]
+        yf = yf.ravel()[out_index]
+        x0 = np.minimum(np.floor(xf).astype(np.int64), xdim - 2)
+        y0 = np.minimum(np.floor(yf).astype(np.int64), ydim - 2)
+        wx = xf - x0
+        wy = yf - y0
+        rows = np.tile(out_index, 4)
+        cols = np.concatenate([y0 * xdim + x0, y0 * xdim + x0 + 1,
+                               (y0 + 1) * xdim + x0,
+                               (y0 + 1) * xdim + x0 + 1])
+        weights = np.concatenate([(1 - wy) * (1 - wx), (1 - wy) * wx,
+                                  wy * (1 - wx), wy * wx])
+        self.operator = scipy.sparse.csr_matrix(
+            (weights.astype(np.float32), (rows, cols)),
+            shape=(self.k_axis.size * self.energy_axis.size, ydim * xdim))
+
+    def __call__(self, stack):
+        """Remaps a (frames, y, x) stack or (y, x) image.
+
+        Returns
+        -------
+        ndarray
+            float32 (frames, k, E) or (k, E), zero outside the detector.
+
+        """
+        stack = np.asarray(stack, dtype=np.float32)
+        single = stack.ndim == 2
+        if single:
+            stack = stack[np.newaxis]
+        if stack.shape[1:] != self.shape:
+            raise Exception("Image shape does not match the remapper")
+        flat = stack.reshape(stack.shape[0], -1)
+        remapped = (self.operator @ flat.T).T
+        remapped = np.ascontiguousarray(remapped).reshape(
+            stack.shape[0], self.k_axis.size, self.energy_axis.size)
+        return remapped[0] if single else remapped
+
+
+@functools.lru_cache(maxsize=16)
+def get_remapper(coeff, order, xdim, ydim, ypixsize, fobj, k_grid=None,
+                 energy_grid=None, center=None, rows=None, cols=None):
+    """Returns the shared KSpaceRemapper for a geometry.
+
+    Parameters
+    ----------
+    coeff, order, xdim
+        The SPE calibration, see spe_calibration.get_calibration.
+
+    See KSpaceRemapper for the other parameters, the grids and windows
+    must be tuples.
+
+    """
+    calibration = spe_calibration.get_calibration(coeff, order, xdim)
+    return KSpaceRemapper(calibration, ydim, ypixsize, fobj, k_grid,
+                          energy_grid, center, rows, cols)
+
+
+def remapper_for(spe, ypixsize=20, fobj=4000, k_grid=None, energy_grid=None,
+                 center=None, rows=None, cols=None):
+    """Returns the shared KSpaceRemapper for an open SPEFile.
+
+    The default pixel size and focal length are those of the far field
+    setup used by spe2pngFFNew.
+
+    """
+    return get_remapper(spe.polynom_coeff, spe.polynom_order, spe.xdim,
+                        spe.ydim, ypixsize, fobj, k_grid, energy_grid, center,
+                        rows, cols)
@@ -0,0 +1,450 @@
+"""SPE Lamp Calibration
+
+This module fits the pixel to wavelength polynomial of a grating and
+centre wavelength setting from a neon/argon reference lamp SPE file, and
+re-calibrates existing SPE files and archives with it.
+
+The lines of the lamp spectrum are found all at once, as the pixels that
+are the maximum of their neighbourhood and stand well above the median
+filtered baseline, and refined to sub-pixel accuracy. The calibration in
+the lamp's header is only trusted to within a few nm and a few percent of
+dispersion: every shift, stretch and bend of it in that range is scored
+by how closely the lines land on a line of LINES, and the best one is
+refined by matching the lines and fitting the polynomial over a region
+growing from the centre of the detector outwards. Fits with a large
+residual or too few matched lines are rejected before they are kept.
+
+Fits are kept per (grating, centre) window in the spe_stitch.WindowCache.
+Re-calibration only rewrites the calibration fields of the SPE headers (or
+the header chunks of an archive) and appends the old coefficients of every
+file to a JSON lines log, so it can be undone.
+"""
+
+import json
+import os
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import spereadNew as sperd
+import spe_archive
+import spe_stitch
+
+RECALIBRATION_LOG = os.path.join(os.path.expanduser('~'), '.quinlab',
+                                 'recalibration.jsonl')
+
+# strong Ne I and Ar I lamp lines, air wavelengths in nm
+NEON_LINES = (
+    585.2488, 588.1895, 594.4834, 597.5534, 602.9997, 607.4338, 609.6163,
+    614.3063, 616.3594, 621.7281, 626.6495, 630.4789, 633.4428, 638.2991,
+    640.2248, 650.6528, 653.2882, 659.8953, 667.8276, 671.7043, 692.9467,
+    703.2413, 717.3938, 724.5167, 743.8899, 747.2438, 748.8871, 753.5774,
+    754.4044, 837.7608, 849.5360, 865.4383, 878.0621, 885.3867)
+ARGON_LINES = (
+    696.5431, 706.7218, 714.7042, 727.2936, 738.3980, 750.3869, 751.4652,
+    763.5106, 772.3761, 772.4207, 794.8176, 800.6157, 801.4786, 810.3693,
+    811.5311, 826.4522, 840.8210, 842.4648, 852.1442, 866.7944, 912.2967,
+    922.4499, 965.7786)
+LINES = np.array(sorted(NEON_LINES + ARGON_LINES))
+
+
+def find_lines(spectrum, window=7, snr=5.0, baseline=51):
+    """Returns the sub-pixel positions and heights of the emission lines
+    of a spectrum.
+
+    Parameters
+    ----------
+    spectrum : ndarray
+        The lamp spectrum.
+    window : int
+        A line is the maximum of the window pixels around it.
+    snr : float
+        Smallest line height over the baseline, in units of the noise
+        (the scaled median absolute deviation of the baseline subtracted
+        spectrum).
+    baseline : int
+        Width in pixels of the median filter giving the baseline.
+
+    Returns
+    -------
+    tuple
+        (float pixel positions, heights over the baseline), in pixel order.
+
+    """
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    half = baseline // 2
+    padded = np.pad(spectrum, half, mode='edge')
+    residual = spectrum - np.median(sliding_window_view(padded,
+                                                        2 * half + 1),
+                                    axis=1)
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+    half = window // 2
+    padded = np.pad(residual, half, mode='constant',
+                    constant_values=-np.inf)
+    local_max = sliding_window_view(padded, 2 * half + 1).max(axis=1)
+    # the first pixel of a flat top only, away from the edges
+    left = np.concatenate(([np.inf], residual[:-1]))
+    peaks = np.flatnonzero((residual >= local_max) & (residual > left)
+                           & (residual > snr * noise))
+    peaks = peaks[(peaks > 0) & (peaks < spectrum.size - 1)]
+    y0 = residual[peaks - 1]
+    y1 = residual[peaks]
+    y2 = residual[peaks + 1]
+    denominator = y0 - 2 * y1 + y2
+    offset = np.where(denominator < 0, 0.5 * (y0 - y2)
+                      / np.where(denominator < 0, denominator, -1), 0)
+    return peaks + np.clip(offset, -0.5, 0.5), y1
+
+
+def match_lines(pixels, coeff, order, xdim, lines=LINES, tolerance=0.3,
+                search=5.0, stretch=0.03, curvature=1.5, iterations=5):
+    """Matches line pixels to reference wavelengths and fits the
+    calibration polynomial.
+
+    Every shift, stretch and bend of the approximate calibration within
+    the search limits is scored by how closely the lines land on
+    reference lines. The best one is refined by matching and fitting over
+    a region growing from the centre of the detector to its edges, so the
+    lines far from the centre, where an error of the approximate
+    calibration shows most, are only matched once the central ones have
+    fixed the fit.
+
+    Parameters
+    ----------
+    pixels : ndarray
+        Line positions in pixels, see find_lines.
+    coeff : sequence of float
+        Approximate calibration polynomial, lowest order first.
+    order : int
+        Order of the fitted polynomial.
+    xdim : int
+        Number of pixels.
+    lines : ndarray
+        Reference wavelengths in nm.
+    tolerance : float
+        Largest distance in nm of a matched line from its reference.
+    search : float
+        Largest error in nm of the approximate calibration at the centre
+        pixel.
+    stretch : float
+        Largest relative error of the approximate dispersion.
+    curvature : float
+        Largest error in nm at the detector edges of the quadratic term
+        of the approximate calibration.
+    iterations : int
+        Rounds of matching and fitting over the whole detector.
+
+    Returns
+    -------
+    dict
+        'coeff' (6 polynomial coefficients), 'order', 'rms' residual in
+        nm, 'rms_pixels' the same in pixels, the matched 'pixels',
+        'wavelengths' and 'residuals', the 'fraction' of the lines that
+        matched, and the 'span' (first, last) of the matched pixels,
+        outside which the fit is extrapolated.
+
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    lines = np.sort(np.asarray(lines, dtype=np.float64))
+    coeff = np.asarray(coeff, dtype=np.float64)
+    if pixels.size < order + 2:
+        raise Exception("Only %d lamp lines found, %d needed"
+                        % (pixels.size, order + 2))
+    predicted = np.polynomial.polynomial.polyval(pixels, coeff)
+    middle = (xdim - 1) / 2
+    centre = np.polynomial.polynomial.polyval(middle, coeff)
+    # score every (bend, stretch, shift) of the approximate calibration at
+    # once, closer landings scoring higher
+    step = tolerance / 4
+    shifts = np.arange(-search, search + step, step)
+    scales = 1 + np.linspace(-stretch, stretch,
+                             2 * int(np.ceil(stretch / 0.0025)) + 1)
+    bends = np.linspace(-curvature, curvature,
+                        2 * int(np.ceil(curvature / (2 * step))) + 1)
+    bend = ((pixels - middle) / middle)**2 - 1 / 3
+    trial = (centre + shifts[np.newaxis, np.newaxis, :, np.newaxis]
+             + scales[np.newaxis, :, np.newaxis, np.newaxis]
+             * (predicted - centre)
+             + bends[:, np.newaxis, np.newaxis, np.newaxis] * bend)
+    distance = _line_distance(trial, lines)
+    score = np.maximum(1 - (distance / tolerance)**2, 0).sum(axis=-1)
+    best = np.unravel_index(np.argmax(score), score.shape)
+    wavelength = trial[best]
+
+    # match the central lines first, then grow the region to the edges
+    offset = np.abs(pixels - middle) / middle
+    for region in [0.5, 0.75] + [1.0] * max(1, int(iterations)):
+        (matched, reference) = _assign(
+            np.where(offset <= region, wavelength, np.nan), lines, tolerance)
+        degree = min(order, matched.size - 2)
+        if degree < 1:
+            if region < 1:
+                continue
+            raise Exception("Only %d lamp lines matched, %d needed"
+                            % (matched.size, order + 2))
+        fit = _robust_fit(pixels[matched], reference, degree, tolerance)
+        wavelength = np.polynomial.polynomial.polyval(pixels, fit)
+    (matched, reference) = _assign(wavelength, lines, tolerance)
+    if matched.size < order + 2:
+        raise Exception("Only %d lamp lines matched, %d needed"
+                        % (matched.size, order + 2))
+    fit = _robust_fit(pixels[matched], reference, order, tolerance)
+    wavelength = np.polynomial.polynomial.polyval(pixels, fit)
+    residuals = reference - wavelength[matched]
+    rms = float(np.sqrt(np.mean(residuals**2)))
+    dispersion = abs(np.polynomial.polynomial.polyval(
+        middle, np.polynomial.polynomial.polyder(fit)))
+    return {
+        'coeff': tuple(np.concatenate((fit, np.zeros(6 - fit.size)))),
+        'order': int(order),
+        'rms': rms,
+        'rms_pixels': rms / dispersion if dispersion > 0 else np.inf,
+        'pixels': pixels[matched],
+        'wavelengths': reference,
+        'residuals': residuals,
+        'fraction': matched.size / pixels.size,
+        'span': (float(pixels[matched].min()), float(pixels[matched].max())),
+        }
+
+
+def calibrate_lamp(spe_filename, order=2, coeff=None, rows=None,
+                   lines=LINES, window=7, snr=5.0, max_rms=0.25,
+                   min_fraction=0.5, **options):
+    """Fits the calibration polynomial of a lamp SPE file.
+
+    Parameters
+    ----------
+    spe_filename : str
+        The neon/argon lamp taken with the grating and centre to calibrate.
+    order : int
+        Order of the fitted polynomial, at most 5. Higher orders only pay
+        off when the matched lines span most of the detector, see 'span'.
+    coeff : sequence of float, optional
+        Approximate calibration, the one in the header by default.
+    rows : tuple of int, optional
+        (start, stop) rows summed into the spectrum, all by default.
+    lines : ndarray
+        Reference wavelengths in nm.
+    window, snr
+        See find_lines.
+    max_rms : float
+        Largest accepted rms residual of the fit in pixels.
+    min_fraction : float
+        Smallest accepted fraction of the lines found that matched a
+        reference line.
+    **options
+        tolerance, search, stretch, curvature and iterations of
+        match_lines.
+
+    Returns
+    -------
+    dict
+        See match_lines, plus 'xdim'. A fit outside either limit raises
+        an exception instead.
+
+    """
+    if not 1 <= order <= 5:
+        raise Exception("Calibration order must be from 1 to 5")
+    with sperd.SPEFile(spe_filename) as spe:
+        spectrum = spe.read_roi(rows=rows).mean(axis=0, dtype=np.float64)
+        spectrum = spectrum.sum(axis=0)
+        if coeff is None:
+            coeff = spe.calibration.coeff[:spe.calibration.order + 1]
+        xdim = spe.xdim
+    (pixels, _) = find_lines(spectrum, window, snr)
+    result = match_lines(pixels, coeff, order, xdim, lines, **options)
+    if result['rms_pixels'] > max_rms:
+        raise Exception("Lamp fit of %s rejected: rms %.3f pixels"
+                        % (spe_filename, result['rms_pixels']))
+    if result['fraction'] < min_fraction:
+        raise Exception("Lamp fit of %s rejected: %d of %d lines matched"
+                        % (spe_filename, result['pixels'].size, pixels.size))
+    result['xdim'] = xdim
+    return result
+
+
+def calibrate_window(spe_filename, cache=None, grating=None, centre=None,
+                     **options):
+    """Fits a lamp file and keeps the result as the calibration of its
+    (grating, centre) window. A fit rejected by calibrate_lamp raises
+    before anything is cached.
+
+    Parameters
+    ----------
+    spe_filename : str
+        The lamp file.
+    cache : spe_stitch.WindowCache, optional
+        The window cache, the default one otherwise.
+    grating, centre : float, optional
+        The window, from the header by default.
+    **options
+        See calibrate_lamp.
+
+    Returns
+    -------
+    dict
+        See calibrate_lamp.
+
+    """
+    cache = cache or spe_stitch.WindowCache()
+    header = sperd.read_header(spe_filename)
+    (grating, centre) = _window(header, grating, centre)
+    result = calibrate_lamp(spe_filename, **options)
+    cache.record_calibration(grating, centre, result['coeff'],
+                             result['order'], result['xdim'], source='lamp')
+    return result
+
+
+def recalibrate_files(filenames, coeff=None, order=None, cache=None,
+                      grating=None, centre=None, log=RECALIBRATION_LOG):
+    """Rewrites the calibration of SPE files in place.
+
+    Only the polynomial order and coefficients of the headers are
+    written, the pixel data is left untouched.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files to re-calibrate.
+    coeff : sequence of float, optional
+        The new polynomial for every file, with its order.
+    order : int, optional
+        Order of coeff.
+    cache : spe_stitch.WindowCache, optional
+        Without coeff, every file gets the lamp calibration cached for its
+        window (from its header, or grating and centre if given), files
+        without one are skipped.
+    grating, centre : float, optional
+        The window of every file.
+    log : str
+        JSON lines file the old and new calibration of every file is
+        appended to.
+
+    Returns
+    -------
+    list of str
+        The files re-calibrated.
+
+    """
+    if coeff is None and cache is None:
+        cache = spe_stitch.WindowCache()
+    done = []
+    for filename in filenames:
+        header = sperd.read_header(filename)
+        new = _new_calibration(header, coeff, order, cache, grating, centre)
+        if new is None:
+            continue
+        # log first, so the old calibration is never lost
+        _append_log(log, [_record(os.path.abspath(filename), None, header,
+                                  new)])
+        sperd.write_calibration(filename, new[0], new[1])
+        done.append(filename)
+    return done
+
+
+def recalibrate_archive(archive_filename, coeff=None, order=None, cache=None,
+                        grating=None, centre=None, log=RECALIBRATION_LOG):
+    """Rewrites the calibration of the files of an SPE archive.
+
+    Only the header chunks and metadata of the archive are replaced, see
+    spe_archive.update_headers, the frame chunks are left untouched.
+    Parameters as recalibrate_files.
+
+    Returns
+    -------
+    list of str
+        The paths of the archived files re-calibrated.
+
+    """
+    if coeff is None and cache is None:
+        cache = spe_stitch.WindowCache()
+    headers = {}
+    records = []
+    with spe_archive.SPEArchive(archive_filename) as archive:
+        for index, path in enumerate(archive.columns['path']):
+            data = archive.header_bytes(index)
+            header = sperd.parse_header(data)
+            new = _new_calibration(header, coeff, order, cache, grating,
+                                   centre)
+            if new is None:
+                continue
+            headers[index] = sperd.patch_calibration(data, new[0], new[1])
+            records.append(_record(path, os.path.abspath(archive_filename),
+                                   header, new))
+    if headers:
+        _append_log(log, records)
+        spe_archive.update_headers(archive_filename, headers)
+    return [record['path'] for record in records]
+
+
+def _line_distance(wavelength, lines):
+    # distance of every wavelength to its nearest reference line
+    right = np.clip(np.searchsorted(lines, wavelength), 1, lines.size - 1)
+    return np.minimum(np.abs(wavelength - lines[right - 1]),
+                      np.abs(wavelength - lines[right]))
+
+
+def _assign(wavelength, lines, tolerance):
+    # (indices into wavelength, reference wavelengths) of the closest line
+    # within tolerance, each reference line used at most once
+    right = np.clip(np.searchsorted(lines, wavelength), 1, lines.size - 1)
+    nearest = np.where(np.abs(wavelength - lines[right - 1])
+                       <= np.abs(wavelength - lines[right]), right - 1, right)
+    distance = np.abs(wavelength - lines[nearest])
+    candidates = np.flatnonzero(distance < tolerance)
+    candidates = candidates[np.lexsort((distance[candidates],
+                                        nearest[candidates]))]
+    (_, first) = np.unique(nearest[candidates], return_index=True)
+    matched = np.sort(candidates[first])
+    return matched, lines[nearest[matched]]
+
+
+def _robust_fit(pixels, reference, order, tolerance):
+    # polynomial fit, refitted without the gross outliers
+    fit = np.polynomial.polynomial.polyfit(pixels, reference, order)
+    residuals = reference - np.polynomial.polynomial.polyval(pixels, fit)
+    rms = np.sqrt(np.mean(residuals**2))
+    keep = np.abs(residuals) <= max(3 * rms, tolerance / 10)
+    if keep.sum() >= order + 2 and not keep.all():
+        fit = np.polynomial.polynomial.polyfit(pixels[keep], reference[keep],
+                                               order)
+    return fit
+
+
+def _window(header, grating, centre):
+    grating = header['grating'] if grating is None else grating
+    centre = header['center_wavelength'] if centre is None else centre
+    if not grating or not centre:
+        raise Exception("The grating and centre wavelength are not in the "
+                        "SPE header, give them explicitly")
+    return grating, centre
+
+
+def _new_calibration(header, coeff, order, cache, grating, centre):
+    # (coeff, order) to write, None if the window has no lamp calibration
+    if coeff is not None:
+        if order is None:
+            order = len(coeff) - 1
+        return tuple(float(c) for c in coeff), int(order)
+    (grating, centre) = _window(header, grating, centre)
+    window = cache.get(grating, centre)
+    if (window is None or str(window.get('source')) != 'lamp'
+            or int(window['xdim']) != header['xdim']):
+        return None
+    return tuple(float(c) for c in window['coeff']), int(window['order'])
+
+
+def _record(path, archive, header, new):
+    return {'path': path, 'archive': archive, 'time': time.time(),
+            'old_coeff': list(header['polynom_coeff']),
+            'old_order': header['polynom_order'],
+            'new_coeff': list(new[0]), 'new_order': new[1]}
+
+
+def _append_log(log, records):
+    if not records or log is None:
+        return
+    directory = os.path.dirname(os.path.abspath(log))
+    os.makedirs(directory, exist_ok=True)
+    with open(log, 'a') as file:
+        for record in records:
+            file.write(json.dumps(record) + '\n')
@@ -0,0 +1,107 @@
+"""SPE Conversion Manifest
+
+This module records which outputs a converter produced from which SPE
+files, so a conversion run can skip every file whose outputs are still
+up to date. An output is stale when its source file changed (mtime or
+size), when the conversion parameters changed (background file, display
+limits, renderer version, ...) or when an output file has gone missing or
+been overwritten by something else.
+
+The manifest is a JSON file next to the outputs and is replaced
+atomically, so an interrupted run never leaves a corrupt manifest.
+"""
+
+import json
+import os
+import tempfile
+
+MANIFEST_VERSION = 1
+
+
+def file_stamp(filename):
+    """Returns (absolute path, mtime_ns, size) of a file or None."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+
+
+class ConversionManifest:
+    """The outputs one converter produced in one directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the converted outputs.
+    converter : str
+        Name of the converter, each converter keeps its own manifest.
+
+    """
+
+    def __init__(self, directory, converter):
+        self._filename = os.path.join(directory or '.',
+                                      '.%s_manifest.json' % converter)
+        self._entries = {}
+        try:
+            with open(self._filename, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self._entries = manifest['entries']
+        except (OSError, ValueError, KeyError):
+            self._entries = {}
+
+    def is_stale(self, source, params):
+        """Returns True if the outputs of source must be rebuilt.
+
+        Parameters
+        ----------
+        source : str
+            The SPE file.
+        params : dict
+            JSON serialisable conversion parameters, including the
+            background stamp and renderer version.
+
+        """
+        entry = self._entries.get(os.path.abspath(source))
+        if entry is None:
+            return True
+        stat = file_stamp(source)
+        if stat is None or entry['source'] != stat[1:]:
+            return True
+        if entry['params'] != _normalise(params):
+            return True
+        for output, mtime_ns in entry['outputs']:
+            stat = file_stamp(output)
+            if stat is None or stat[1] != mtime_ns:
+                return True
+        return False
+
+    def record(self, source, outputs, params):
+        """Records the outputs produced from source with params."""
+        stat = file_stamp(source)
+        if stat is None:
+            return
+        self._entries[stat[0]] = {
+            'source': stat[1:],
+            'params': _normalise(params),
+            'outputs': [file_stamp(f)[:2] for f in outputs],
+            }
+
+    def save(self):
+        """Atomically replaces the manifest file."""
+        directory = os.path.dirname(os.path.abspath(self._filename))
+        handle, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as file:
+                json.dump({'version': MANIFEST_VERSION,
+                           'entries': self._entries}, file)
+            os.replace(tmp_name, self._filename)
+        except Exception:
+            os.remove(tmp_name)
+            raise
+
+
+def _normalise(params):
+    # round trip through JSON so tuples and numpy scalars compare equal
+    return json.loads(json.dumps(params, default=float))
@@ -0,0 +1,328 @@
+"""SPE Batch Peak Fitting
+
+This module fits single Lorentzian, Gaussian or pseudo-Voigt peaks on a
+constant offset to many spectra at once. The spectra are stacked into one
+(spectra, points) array, initial guesses come from the maximum and the
+half maximum crossings of every spectrum, and Levenberg-Marquardt steps
+with analytic Jacobians are taken for the whole batch with batched linear
+solves, each spectrum keeping its own damping. The pseudo-Voigt mixing is
+held on 0 or 1 while the fit pushes against that bound, so peaks of pure
+Lorentzian or Gaussian shape converge as fast as the other models.
+
+Results are returned as columns, one entry per spectrum, so that a series
+of thousands of spectra is fitted in a single call.
+"""
+
+import numpy as np
+import spereadNew as sperd
+
+# 4 * ln(2), the Gaussian exp(-FOUR_LN2 * (x - c)**2 / fwhm**2)
+FOUR_LN2 = 4 * np.log(2)
+
+MODELS = ('lorentzian', 'gaussian', 'pseudo_voigt')
+
+# parameter columns of every model
+PARAMETERS = {
+    'lorentzian': ('amplitude', 'center', 'fwhm', 'offset'),
+    'gaussian': ('amplitude', 'center', 'fwhm', 'offset'),
+    'pseudo_voigt': ('amplitude', 'center', 'fwhm', 'offset', 'eta'),
+    }
+
+
+def _lorentzian(x, center, fwhm, jacobian=True):
+    # unit height profile and its derivatives by center and fwhm
+    d = x - center
+    d2 = d * d
+    g = (fwhm / 2)**2
+    inverse = 1 / (d2 + g)
+    profile = g * inverse
+    if not jacobian:
+        return profile, None, None
+    inverse *= profile
+    return (profile, 2 * d * inverse, d2 * inverse * (2 / fwhm))
+
+
+def _gaussian(x, center, fwhm, jacobian=True):
+    d = x - center
+    scale = FOUR_LN2 / fwhm**2
+    d2 = d * d
+    profile = np.exp(-scale * d2)
+    if not jacobian:
+        return profile, None, None
+    d *= profile
+    d *= 2 * scale
+    return (profile, d, d2 * profile * (2 * scale / fwhm))
+
+
+def evaluate(model, x, params, jacobian=True):
+    """Returns the model and its Jacobian for a batch of parameters.
+
+    Parameters
+    ----------
+    model : str
+        One of MODELS.
+    x : ndarray
+        (points,) or (spectra, points) axis.
+    params : ndarray
+        (spectra, parameters) in the order of PARAMETERS[model].
+    jacobian : bool
+        Also compute the Jacobian, None is returned in its place if not.
+
+    Returns
+    -------
+    tuple of ndarray
+        (spectra, points) model values and (spectra, parameters, points)
+        Jacobian.
+
+    """
+    amp = params[:, 0:1]
+    center = params[:, 1:2]
+    fwhm = params[:, 2:3]
+    offset = params[:, 3:4]
+    if model == 'lorentzian':
+        profile, d_center, d_fwhm = _lorentzian(x, center, fwhm, jacobian)
+    elif model == 'gaussian':
+        profile, d_center, d_fwhm = _gaussian(x, center, fwhm, jacobian)
+    elif model == 'pseudo_voigt':
+        eta = params[:, 4:5]
+        lor = _lorentzian(x, center, fwhm, jacobian)
+        gau = _gaussian(x, center, fwhm, jacobian)
+        profile = eta * lor[0] + (1 - eta) * gau[0]
+        if jacobian:
+            d_center = eta * lor[1] + (1 - eta) * gau[1]
+            d_fwhm = eta * lor[2] + (1 - eta) * gau[2]
+    else:
+        raise Exception("Invalid peak model")
+    values = amp * profile + offset
+    if not jacobian:
+        return values, None
+    jac = np.empty((values.shape[0], params.shape[1], values.shape[1]))
+    jac[:, 0] = profile
+    np.multiply(amp, d_center, out=jac[:, 1])
+    np.multiply(amp, d_fwhm, out=jac[:, 2])
+    jac[:, 3] = 1
+    if model == 'pseudo_voigt':
+        np.multiply(amp, lor[0] - gau[0], out=jac[:, 4])
+    return values, jac
+
+
+def initial_guess(x, spectra, model='lorentzian'):
+    """Returns (spectra, parameters) starting values for fit_peaks.
+
+    The offset is the minimum, the amplitude and center come from the
+    maximum and the width from the half maximum crossings either side of
+    it.
+
+    """
+    spectra = np.asarray(spectra, dtype=np.float64)
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), spectra.shape)
+    rows = np.arange(spectra.shape[0])
+    peak = np.argmax(spectra, axis=1)
+    offset = spectra.min(axis=1)
+    amp = spectra[rows, peak] - offset
+    below = spectra < (offset + amp / 2)[:, np.newaxis]
+    index = np.arange(spectra.shape[1])
+    # last point below half maximum left of the peak, first one right
+    left = np.where(below & (index < peak[:, np.newaxis]), index, -1).max(1)
+    right = np.where(below & (index > peak[:, np.newaxis]), index,
+                     spectra.shape[1]).min(axis=1)
+    left = np.clip(left, 0, spectra.shape[1] - 1)
+    right = np.clip(right, 0, spectra.shape[1] - 1)
+    step = np.abs(x[:, 1] - x[:, 0])
+    fwhm = np.maximum(np.abs(x[rows, right] - x[rows, left]), step)
+    columns = [amp, x[rows, peak], fwhm, offset]
+    if model == 'pseudo_voigt':
+        columns.append(np.full(amp.shape, 0.5))
+    return np.stack(columns, axis=1)
+
+
+def fit_peaks(x, spectra, model='lorentzian', p0=None, max_iter=100,
+              tol=1e-10, gtol=1e-6):
+    """Fits one peak to every spectrum of a batch.
+
+    Parameters
+    ----------
+    x : ndarray
+        (points,) axis shared by all spectra or (spectra, points).
+    spectra : ndarray
+        (spectra, points) or a single (points,) spectrum.
+    model : str
+        'lorentzian', 'gaussian' or 'pseudo_voigt'. Widths are full
+        widths at half maximum for every model.
+    p0 : ndarray, optional
+        (spectra, parameters) starting values, see initial_guess.
+    max_iter : int
+        Largest number of Levenberg-Marquardt steps.
+    tol : float
+        A spectrum has converged when a step lowers its sum of squares
+        by less than this fraction, or when no step lowers it any more
+        and its gradient is negligible, see gtol.
+    gtol : float
+        Largest cosine between the residual and a column of the Jacobian
+        of a converged fit. A fit that no step lowers with a larger
+        gradient has stalled, and is not converged.
+
+    Returns
+    -------
+    dict
+        Arrays with one entry per spectrum: the parameters of
+        PARAMETERS[model], their standard errors as '<name>_err', the
+        quality factor 'q' = center / fwhm and its error, 'rms' residual,
+        'iterations', 'converged' and 'stalled'.
+
+    """
+    if model not in MODELS:
+        raise Exception("Invalid peak model")
+    spectra = np.asarray(spectra, dtype=np.float64)
+    if spectra.ndim == 1:
+        spectra = spectra[np.newaxis]
+    x = np.asarray(x, dtype=np.float64)
+    # a shared axis stays a single broadcast row
+    shared = x.ndim == 1
+    if shared:
+        x = x[np.newaxis]
+    params = (initial_guess(x, spectra, model) if p0 is None
+              else np.array(p0, dtype=np.float64))
+    n_spectra, n_points = spectra.shape
+    n_params = params.shape[1]
+    damping = np.full(n_spectra, 1e-3)
+    iterations = np.zeros(n_spectra, dtype=np.int64)
+    converged = np.zeros(n_spectra, dtype=bool)
+    stalled = np.zeros(n_spectra, dtype=bool)
+    accepted = np.zeros(n_spectra, dtype=bool)
+    values, _ = evaluate(model, x, params, jacobian=False)
+    cost = ((spectra - values)**2).sum(axis=1)
+    active = np.arange(n_spectra)
+    identity = np.eye(n_params)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        xa = x if shared else x[active]
+        ya = spectra[active]
+        pa = params[active]
+        values, jac = evaluate(model, xa, pa)
+        residual = ya - values
+        jtj = jac @ jac.transpose(0, 2, 1)
+        gradient = (jac @ residual[..., np.newaxis])[..., 0]
+        diagonal = np.einsum('npp->np', jtj)
+        free = _free(model, pa, gradient)
+        # parameters held on a bound drop out of the step
+        jtj *= free[:, :, np.newaxis] & free[:, np.newaxis, :]
+        gradient *= free
+        held = ~free[..., np.newaxis] * identity
+        lhs = jtj + (damping[active, np.newaxis]
+                     * np.maximum(diagonal, 1e-30))[..., np.newaxis] \
+            * identity + held
+        try:
+            step = np.linalg.solve(lhs, gradient[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0]
+                             for a, b in zip(lhs, gradient)])
+        trial = _constrain(model, pa + step)
+        trial_values, _ = evaluate(model, xa, trial, jacobian=False)
+        trial_cost = ((ya - trial_values)**2).sum(axis=1)
+        old_cost = cost[active]
+        better = trial_cost < old_cost
+        better &= np.isfinite(trial_cost)
+        params[active[better]] = trial[better]
+        cost[active[better]] = trial_cost[better]
+        # at the optimum rounding stops any step from helping, which the
+        # gradient (the largest cosine between the residual and a
+        # Jacobian column) or a tiny nearly undamped step tells apart
+        # from a fit stuck away from it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = np.where(gradient == 0, 0, np.abs(gradient) / np.sqrt(
+                diagonal * old_cost[:, np.newaxis])).max(axis=1)
+        relative = np.max(np.abs(step) / (np.abs(pa) + 1e-12), axis=1)
+        flat = (cosine <= gtol) | ((relative <= 1e-10)
+                                   & (damping[active] <= 1))
+        damping[active] = np.where(better, damping[active] / 10,
+                                   damping[active] * 10)
+        accepted[active[better]] = True
+        iterations[active] += 1
+        small = better & (old_cost - trial_cost <= tol * old_cost)
+        done = small | (~better & accepted[active] & flat)
+        stuck = ~done & (damping[active] > 1e12)
+        converged[active[done]] = True
+        stalled[active[stuck]] = True
+        active = active[~(done | stuck)]
+    result = _results(model, x, spectra, params, cost, iterations, converged)
+    result['stalled'] = stalled
+    return result
+
+
+def spectra_from_spe(spe, rows=None, cols=None, frames=None):
+    """Returns the axis and row summed spectra of an SPE file.
+
+    Parameters
+    ----------
+    spe : SPEFile or str
+        The open SPE file or its file name.
+    rows, cols : tuple of int, optional
+        Half open (start, stop) region summed over rows.
+    frames : int or slice, optional
+        Frames to read, all by default.
+
+    Returns
+    -------
+    tuple of ndarray
+        (wavelength axis, float64 (frames, points) spectra).
+
+    """
+    if isinstance(spe, str):
+        with sperd.SPEFile(spe) as spe_file:
+            return spectra_from_spe(spe_file, rows, cols, frames)
+    roi = spe.read_roi(frames, rows, cols)
+    return spe.roi_xaxis(cols), roi.sum(axis=1, dtype=np.float64)
+
+
+def _free(model, params, gradient):
+    # (spectra, parameters) mask of the parameters free to move, the Voigt
+    # mixing is held on a bound the descent direction points beyond
+    free = np.ones(params.shape, dtype=bool)
+    if model == 'pseudo_voigt':
+        eta = params[:, 4]
+        free[:, 4] = ~(((eta <= 0) & (gradient[:, 4] < 0))
+                       | ((eta >= 1) & (gradient[:, 4] > 0)))
+    return free
+
+
+def _constrain(model, params):
+    # widths stay positive and the Voigt mixing within [0, 1]
+    params[:, 2] = np.abs(params[:, 2])
+    if model == 'pseudo_voigt':
+        params[:, 4] = np.clip(params[:, 4], 0, 1)
+    return params
+
+
+def _results(model, x, spectra, params, cost, iterations, converged):
+    n_points = spectra.shape[1]
+    n_params = params.shape[1]
+    _, jac = evaluate(model, x, params)
+    jtj = jac @ jac.transpose(0, 2, 1)
+    dof = max(n_points - n_params, 1)
+    variance = cost / dof
+    covariance = np.full(jtj.shape, np.nan)
+    invertible = np.linalg.matrix_rank(jtj) == n_params
+    if invertible.any():
+        covariance[invertible] = np.linalg.inv(jtj[invertible])
+    covariance *= variance[:, np.newaxis, np.newaxis]
+    errors = np.sqrt(np.abs(np.einsum('npp->np', covariance)))
+    result = {}
+    for i, name in enumerate(PARAMETERS[model]):
+        result[name] = params[:, i]
+        result[name + '_err'] = errors[:, i]
+    center = params[:, 1]
+    fwhm = params[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.abs(center) / fwhm
+        # first order propagation including the center/width covariance
+        rel = (covariance[:, 1, 1] / center**2
+               + covariance[:, 2, 2] / fwhm**2
+               - 2 * covariance[:, 1, 2] / (center * fwhm))
+        result['q'] = q
+        result['q_err'] = q * np.sqrt(np.abs(rel))
+    result['rms'] = np.sqrt(cost / n_points)
+    result['iterations'] = iterations
+    result['converged'] = converged
+    return result
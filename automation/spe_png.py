@@ -0,0 +1,171 @@
+"""SPE PNG Renderer
+
+This module writes colour-mapped previews of spectral images straight to
+PNG without going through matplotlib. The colormaps are the matplotlib
+``jet`` and ``gray`` maps, sampled to the same 256 entry lookup tables,
+and the scaling follows ``matplotlib.colors.Normalize`` so the pixels
+match ``imsave``/``imshow`` for the same ``vmin`` and ``vmax``.
+"""
+
+import functools
+import struct
+import zlib
+import numpy as np
+
+# matplotlib's segment data, (x, y0, y1) per channel
+_SEGMENTS = {
+    'jet': (((0., 0, 0), (0.35, 0, 0), (0.66, 1, 1), (0.89, 1, 1),
+             (1, 0.5, 0.5)),
+            ((0., 0, 0), (0.125, 0, 0), (0.375, 1, 1), (0.64, 1, 1),
+             (0.91, 0, 0), (1, 0, 0)),
+            ((0., 0.5, 0.5), (0.11, 1, 1), (0.34, 1, 1), (0.65, 0, 0),
+             (1, 0, 0))),
+    'gray': (((0., 0, 0), (1., 1, 1)),
+             ((0., 0, 0), (1., 1, 1)),
+             ((0., 0, 0), (1., 1, 1))),
+    }
+
+LUT_SIZE = 256
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(cmap='jet'):
+    """Returns the (256, 3) uint8 lookup table of a colormap.
+
+    Parameters
+    ----------
+    cmap : str
+        'jet' or 'gray'.
+
+    """
+    if cmap not in _SEGMENTS:
+        raise Exception("Invalid colormap")
+    xind = (LUT_SIZE - 1) * np.linspace(0, 1, LUT_SIZE)
+    lut = np.empty((LUT_SIZE, 3))
+    for channel, segments in enumerate(_SEGMENTS[cmap]):
+        adata = np.array(segments, dtype=float)
+        x = adata[:, 0] * (LUT_SIZE - 1)
+        y0 = adata[:, 1]
+        y1 = adata[:, 2]
+        ind = np.searchsorted(x, xind)[1:-1]
+        distance = (xind[1:-1] - x[ind - 1]) / (x[ind] - x[ind - 1])
+        lut[1:-1, channel] = distance * (y0[ind] - y1[ind - 1]) + y1[ind - 1]
+        lut[0, channel] = y1[0]
+        lut[-1, channel] = y0[-1]
+    lut = (np.clip(lut, 0.0, 1.0) * 255).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def scale_image(image, vmin=None, vmax=None):
+    """Scales an image to [0, 1] exactly as matplotlib's Normalize does.
+
+    The image is clipped by the colormap lookup, not here. A missing
+    vmin or vmax is taken from the image.
+
+    Returns
+    -------
+    ndarray
+        float32 for images of 16 bit or less, float64 otherwise.
+
+    """
+    work = np.array(image, dtype=_norm_dtype(image))
+    if vmin is None:
+        vmin = np.nanmin(work)
+    if vmax is None:
+        vmax = np.nanmax(work)
+    # Normalize stores the limits as python floats and applies them as
+    # float64 scalars, whatever the image dtype
+    vmin = np.float64(float(vmin))
+    vmax = np.float64(float(vmax))
+    if vmin == vmax:
+        work.fill(0)
+    else:
+        work -= vmin
+        work /= (vmax - vmin)
+    return work
+
+
+def colormap_indices(image, vmin=None, vmax=None):
+    """Returns the uint8 lookup table index of every pixel and a nan mask."""
+    work = scale_image(image, vmin, vmax)
+    work *= LUT_SIZE
+    bad = np.isnan(work)
+    work[bad] = 0
+    np.clip(work, 0, LUT_SIZE - 1, out=work)
+    return work.astype(np.uint8), bad
+
+
+def render_png(filename, image, cmap='jet', vmin=None, vmax=None,
+               bit16=False, compression=1):
+    """Writes a 2D image to a colour-mapped (or 16 bit gray) PNG file.
+
+    Parameters
+    ----------
+    filename : str
+        The PNG file to write.
+    image : ndarray
+        2D image, row 0 is the top of the picture.
+    cmap : str
+        'jet' or 'gray', ignored for 16 bit output.
+    vmin, vmax : float, optional
+        Display limits, taken from the image when not given.
+    bit16 : bool
+        Write 16 bit grayscale instead of 8 bit RGB.
+    compression : int
+        zlib compression level.
+
+    """
+    if bit16:
+        work = scale_image(image, vmin, vmax)
+        work = np.nan_to_num(work, nan=0.0)
+        np.clip(work, 0.0, 1.0, out=work)
+        pixels = np.rint(work * 65535).astype(np.uint16)
+    else:
+        indices, bad = colormap_indices(image, vmin, vmax)
+        pixels = colormap_lut(cmap)[indices]
+        pixels[bad] = 0
+    write_png(filename, pixels, compression)
+
+
+def write_png(filename, pixels, compression=1):
+    """Writes uint8 RGB (h, w, 3), uint8 gray or uint16 gray pixels."""
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 3 and pixels.shape[2] == 3:
+        color_type = 2
+    elif pixels.ndim == 2:
+        color_type = 0
+    else:
+        raise Exception("Invalid PNG pixel shape")
+    if pixels.dtype == np.uint16:
+        bit_depth = 16
+        data = pixels.astype('>u2').view(np.uint8)
+    elif pixels.dtype == np.uint8:
+        bit_depth = 8
+        data = pixels
+    else:
+        raise Exception("Invalid PNG pixel datatype")
+    height, width = pixels.shape[:2]
+    raw = np.zeros((height, 1 + data[0].size), dtype=np.uint8)
+    raw[:, 1:] = data.reshape(height, -1)
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, color_type,
+                         0, 0, 0)
+    with open(filename, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(_chunk(b'IHDR', header))
+        file.write(_chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)))
+        file.write(_chunk(b'IEND', b''))
+
+
+def _chunk(tag, body):
+    # length, tag, body, crc of tag and body
+    return (struct.pack('>I', len(body)) + tag + body
+            + struct.pack('>I', zlib.crc32(tag + body) & 0xffffffff))
+
+
+def _norm_dtype(image):
+    # the working dtype matplotlib's Normalize uses for image
+    dtype = np.asarray(image).dtype
+    if np.issubdtype(dtype, np.integer) or dtype == np.bool_:
+        dtype = np.promote_types(dtype, np.float32)
+    return dtype
@@ -0,0 +1,178 @@
+"""SPE Frame Stack Reducer
+
+This module combines the frames of multi-frame (kinetics) SPE files into
+single images without ever holding the whole file in memory.
+
+Mean, sum and variance are accumulated online from chunks of frames with
+the parallel form of Welford's algorithm, the sigma-clipped mean takes a
+second streaming pass, and the exact median is computed band by band of
+rows so that only ``max_bytes`` of frame data are resident at a time.
+"""
+
+import numpy as np
+import spereadNew as sperd
+import spe_background
+
+# fewest frames a correction stage is given at once, the stack test of
+# spe_cosmic.find_cosmic_rays needs three
+CONTEXT_FRAMES = 3
+
+
+class FrameStackReducer:
+    """Online mean, sum and variance of a stream of equally sized frames.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The (y, x) shape of every frame.
+
+    """
+
+    def __init__(self, shape):
+        self.count = 0
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+
+    def add(self, frames):
+        """Adds a (frames, y, x) chunk or a single (y, x) frame."""
+        frames = np.asarray(frames, dtype=np.float64)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        n_b = frames.shape[0]
+        if n_b == 0:
+            return
+        mean_b = frames.mean(axis=0)
+        m2_b = ((frames - mean_b)**2).sum(axis=0)
+        n_a = self.count
+        n = n_a + n_b
+        delta = mean_b - self._mean
+        self._mean += delta * (n_b / n)
+        self._m2 += m2_b + delta**2 * (n_a * n_b / n)
+        self.count = n
+
+    @property
+    def mean(self):
+        return self._mean.copy()
+
+    @property
+    def sum(self):
+        return self._mean * self.count
+
+    @property
+    def variance(self):
+        """Sample variance (ddof=1), zero for fewer than two frames."""
+        if self.count < 2:
+            return np.zeros_like(self._m2)
+        return self._m2 / (self.count - 1)
+
+
+def reduce_frames(spe, sigma=None, median=False, background=None,
+                  correction=None, chunk_frames=16, readahead=2,
+                  max_bytes=256 * 2**20):
+    """Reduces every frame of an SPE file to single images.
+
+    Parameters
+    ----------
+    spe : SPEFile or str
+        The open SPE file or its file name.
+    sigma : float, optional
+        Also compute the mean of the frames within sigma standard
+        deviations of the per pixel mean, in a second pass.
+    median : bool
+        Also compute the exact per pixel median, in row bands.
+    background : BackgroundEngine, optional
+        Subtract the matching master dark from every frame.
+    correction : callable, optional
+        Correction stage such as spe_cosmic.CosmicRayFilter, called as
+        correction(chunk, spe, context, count) on every dark subtracted
+        float32 chunk of at least CONTEXT_FRAMES frames (fewer only if
+        the file has fewer). A short last chunk is preceded by context
+        frames of the chunk before it, which are not kept. count is
+        False on the repeated passes of sigma and median. For the median
+        it is called on row bands of all frames, which per detector
+        masks only match when a band spans the whole frame.
+    chunk_frames, readahead : int
+        Streaming parameters, see SPEFile.iter_chunks.
+    max_bytes : int
+        Largest block of frame data held for the median.
+
+    Returns
+    -------
+    dict
+        'count', 'mean', 'sum', 'variance' and, when requested,
+        'sigma_clipped_mean' and 'median' float64 (y, x) images, plus
+        'background' telling whether a dark was subtracted.
+
+    """
+    if isinstance(spe, str):
+        with sperd.SPEFile(spe) as spe_file:
+            return reduce_frames(spe_file, sigma, median, background,
+                                 correction, chunk_frames, readahead,
+                                 max_bytes)
+    key = spe_background.dark_key(spe) if background is not None else None
+    if correction is not None:
+        chunk_frames = max(chunk_frames, CONTEXT_FRAMES)
+
+    def chunks(count=True):
+        previous = None
+        for start, chunk in spe.iter_chunks(chunk_frames, readahead):
+            chunk = chunk.astype(np.float32)
+            if key is not None:
+                background.subtract(chunk, key)
+            if correction is not None:
+                # the same stack test for every frame, the last chunk too
+                context = 0
+                if previous is not None and chunk.shape[0] < chunk_frames:
+                    context = min(chunk_frames - chunk.shape[0],
+                                  previous.shape[0])
+                    stack = np.concatenate((previous[-context:], chunk))
+                else:
+                    stack = chunk
+                previous = chunk.copy()
+                correction(stack, spe, context, count)
+                chunk = stack[context:]
+            yield chunk
+
+    reducer = FrameStackReducer((spe.ydim, spe.xdim))
+    for chunk in chunks():
+        reducer.add(chunk)
+    result = {
+        'count': reducer.count,
+        'mean': reducer.mean,
+        'sum': reducer.sum,
+        'variance': reducer.variance,
+        'background': key is not None
+                      and background.master(key) is not None,
+        }
+    if sigma is not None:
+        center = result['mean']
+        limit = sigma * np.sqrt(result['variance'])
+        total = np.zeros_like(center)
+        count = np.zeros(center.shape, dtype=np.int64)
+        for chunk in chunks(count=False):
+            keep = np.abs(chunk - center) <= limit
+            total += np.where(keep, chunk, 0).sum(axis=0)
+            count += keep.sum(axis=0)
+        result['sigma_clipped_mean'] = np.where(
+            count > 0, total / np.maximum(count, 1), center)
+    if median:
+        result['median'] = _median(spe, background, key, correction,
+                                   max_bytes)
+    return result
+
+
+def _median(spe, background, key, correction, max_bytes):
+    # exact median over frames, one band of rows at a time
+    row_bytes = 4 * spe.num_frames * spe.xdim
+    band = max(1, int(max_bytes // max(row_bytes, 1)))
+    master = background.master(key) if key is not None else None
+    median = np.empty((spe.ydim, spe.xdim), dtype=np.float64)
+    for y0 in range(0, spe.ydim, band):
+        y1 = min(spe.ydim, y0 + band)
+        block = np.array(spe.data[:, y0:y1, :], dtype=np.float32)
+        if master is not None and master.shape == (spe.ydim, spe.xdim):
+            block -= master[y0:y1]
+        if correction is not None:
+            correction(block, spe, 0, False)
+        median[y0:y1] = np.median(block, axis=0)
+    return median
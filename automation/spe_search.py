@@ -0,0 +1,237 @@
+"""SPE Spectral Similarity Search
+
+This module indexes every spectrum of an SPE archive (or a list of SPE
+files) so that the acquisitions most similar to a query spectrum can be
+found in milliseconds.
+
+Every file is reduced to one spectrum (the mean over frames of the rows
+summed), resampled onto a common wavelength grid, baseline subtracted
+and scaled to unit length, so that the distance between two vectors only
+depends on the shape of the spectra. The vectors are projected onto their
+leading principal components and put in a KD-tree, which is pickled to
+disk together with the projection, the vectors themselves, the file paths
+and the scan parameters. The tree finds the candidates and the vectors
+give their exact cosine similarity to the query.
+"""
+
+import os
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+import spereadNew as sperd
+import spe_archive
+import spe_calibration
+import spe_decompose
+import scan_params
+
+SEARCH_VERSION = 2
+
+# scan parameters returned with every match
+PARAMS = ('name', 'od', 'wavelength', 'power', 'voltage', 'zaber')
+
+
+def normalise(wavelength, spectrum, grid):
+    """Returns a spectrum resampled on grid, baseline subtracted and
+    scaled to unit length.
+
+    The baseline is the median of the spectrum and the grid is zero where
+    the spectrum was not measured. Several spectra can be given as a
+    (spectra, points) array sharing one wavelength axis.
+
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    single = spectrum.ndim == 1
+    spectra = np.atleast_2d(spectrum)
+    if wavelength[-1] < wavelength[0]:
+        wavelength = wavelength[::-1]
+        spectra = spectra[:, ::-1]
+    spectra = spectra - np.median(spectra, axis=1, keepdims=True)
+    vectors = np.array([np.interp(grid, wavelength, s, left=0, right=0)
+                        for s in spectra])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1)
+    return vectors[0] if single else vectors
+
+
+def build_index(source, filename, grid=None, dims=32, rows=None,
+                batch_size=512):
+    """Builds the similarity index of an archive or a list of SPE files.
+
+    Parameters
+    ----------
+    source : SPEArchive or list of str
+        The spectra to index.
+    filename : str
+        The index file to write.
+    grid : tuple, optional
+        (start, stop, points) common wavelength grid in nm, by default
+        the range covered by all files at the finest pixel count.
+    dims : int
+        Number of principal components kept per vector.
+    rows : tuple of int, optional
+        (start, stop) rows summed into the spectrum, all by default.
+    batch_size : int
+        Spectra per principal component update.
+
+    Returns
+    -------
+    SpectralIndex
+        The new index.
+
+    """
+    entries = list(_entries(source))
+    if not entries:
+        raise Exception("No spectra to index")
+    if grid is None:
+        low = min(float(np.min(e['axis'])) for e in entries)
+        high = max(float(np.max(e['axis'])) for e in entries)
+        grid = (low, high, max(e['axis'].size for e in entries))
+    grid_axis = np.linspace(*grid)
+    vectors = np.empty((len(entries), grid_axis.size), dtype=np.float32)
+    for i, entry in enumerate(entries):
+        spectrum = _read_spectrum(source, entry, rows)
+        vectors[i] = normalise(entry['axis'], spectrum, grid_axis)
+    dims = min(dims, len(entries), grid_axis.size)
+    batch_size = max(batch_size, dims)
+    pca = spe_decompose.IncrementalPCA(dims)
+    for start in range(0, len(entries), batch_size):
+        pca.partial_fit(vectors[start:start + batch_size])
+    projected = np.vstack([pca.transform(vectors[start:start + batch_size])
+                           for start in range(0, len(entries), batch_size)])
+    state = {
+        'version': SEARCH_VERSION,
+        'grid': tuple(float(g) for g in grid[:2]) + (int(grid[2]),),
+        'mean': pca.mean,
+        'components': pca.components,
+        'tree': cKDTree(projected),
+        'vectors': vectors,
+        'paths': [entry['path'] for entry in entries],
+        'params': [{name: entry['params'][name] for name in PARAMS}
+                   for entry in entries],
+        'rows': rows,
+        }
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'wb') as file:
+        pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, filename)
+    return SpectralIndex(filename)
+
+
+class SpectralIndex:
+    """Nearest neighbour search over indexed spectra.
+
+    Parameters
+    ----------
+    filename : str
+        The index written by build_index.
+
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            state = pickle.load(file)
+        if state['version'] > SEARCH_VERSION:
+            raise Exception("Spectral index %s is of a newer version"
+                            % filename)
+        if state['version'] < SEARCH_VERSION:
+            raise Exception("Spectral index %s is of an older version, "
+                            "rebuild it" % filename)
+        self._state = state
+        self.grid = np.linspace(*state['grid'])
+        self._mean = state['mean']
+        self._components = state['components']
+        self._tree = state['tree']
+        self._vectors = state['vectors']
+
+    def __len__(self):
+        return len(self._state['paths'])
+
+    def project(self, wavelength, spectrum):
+        """Returns the index vector(s) of one or more spectra."""
+        vectors = normalise(wavelength, spectrum, self.grid)
+        return (vectors - self._mean) @ self._components.T
+
+    def query(self, wavelength, spectrum, k=10):
+        """Returns the k indexed spectra most similar to a spectrum.
+
+        Parameters
+        ----------
+        wavelength : ndarray
+            Wavelength axis of the spectrum in nm.
+        spectrum : ndarray
+            The query spectrum.
+        k : int
+            Number of matches.
+
+        Returns
+        -------
+        list of dict
+            The k nearest matches in the principal component space, most
+            similar first: 'path', 'distance' (between the projected
+            vectors, a lower bound of the full distance), 'similarity'
+            (the cosine similarity of the full vectors, 1 for equal
+            shapes, -1 for opposite ones) and the scan parameters of
+            PARAMS.
+
+        """
+        k = min(int(k), len(self))
+        vector = normalise(wavelength, spectrum, self.grid)
+        distance, index = self._tree.query(
+            (vector - self._mean) @ self._components.T, k)
+        distance = np.atleast_1d(distance)
+        index = np.atleast_1d(index)
+        similarity = self._vectors[index] @ vector
+        matches = []
+        for j in np.argsort(-similarity, kind='stable'):
+            i = index[j]
+            match = {'path': self._state['paths'][i],
+                     'distance': float(distance[j]),
+                     'similarity': float(similarity[j])}
+            match.update(self._state['params'][i])
+            matches.append(match)
+        return matches
+
+    def query_file(self, spe_filename, k=10):
+        """Returns the k indexed spectra most similar to an SPE file,
+        reduced in the same way as the indexed ones."""
+        with sperd.SPEFile(spe_filename) as spe:
+            spectrum = _file_spectrum(spe, self._state['rows'])
+            wavelength = np.array(spe.xaxis)
+        return self.query(wavelength, spectrum, k)
+
+
+def _entries(source):
+    # path, archive index, wavelength axis and scan parameters of every file
+    if isinstance(source, spe_archive.SPEArchive):
+        columns = source.columns
+        for i, path in enumerate(columns['path']):
+            params = {name: columns[name][i] for name in PARAMS}
+            params = {name: (value if isinstance(value, str) else None
+                             if np.isnan(value) else float(value))
+                      for name, value in params.items()}
+            yield {'path': path, 'index': i, 'axis': source.xaxis(i),
+                   'params': params}
+        return
+    for path in source:
+        header = sperd.read_header(path)
+        axis = spe_calibration.get_calibration(
+            header['polynom_coeff'], header['polynom_order'],
+            header['xdim']).wavelength
+        yield {'path': os.path.abspath(path), 'index': None, 'axis': axis,
+               'params': scan_params.parse_scan_filename(path)}
+
+
+def _read_spectrum(source, entry, rows):
+    if isinstance(source, spe_archive.SPEArchive):
+        stack = source.read_file(entry['index'])
+        if rows is not None:
+            stack = stack[:, rows[0]:rows[1]]
+        return stack.sum(axis=1, dtype=np.float64).mean(axis=0)
+    with sperd.SPEFile(entry['path']) as spe:
+        return _file_spectrum(spe, rows)
+
+
+def _file_spectrum(spe, rows):
+    roi = spe.read_roi(rows=rows)
+    return roi.sum(axis=1, dtype=np.float64).mean(axis=0)
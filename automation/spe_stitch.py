@@ -0,0 +1,476 @@
+"""SPE Spectral Stitching
+
+This module takes broadband spectra window by window and merges them.
+
+plan_windows works out the centre wavelengths needed to cover a range with
+a given overlap between neighbouring windows, acquire_windows takes one
+SPE file per centre through LightField, and stitch merges the windows onto
+a common wavelength grid. Every window is divided by the responsivity of
+its (grating, centre) setting, scaled to match its neighbours in the
+overlaps, and blended in with weights that fall linearly to zero at the
+window edges, so no step is left where one window hands over to the next.
+
+The calibration and responsivity of every (grating, centre) setting are
+kept in a WindowCache, which also provides the window widths the planning
+needs once a grating has been used.
+"""
+
+import glob
+import os
+import numpy as np
+import spereadNew as sperd
+import spe_background
+import spe_calibration
+
+WINDOW_CACHE = os.path.join(os.path.expanduser('~'), '.quinlab',
+                            'window_cache')
+
+# approximate window width in nm of each grating (g/mm) on the 1340 pixel
+# detector, used until a calibration of the grating is cached
+NOMINAL_WIDTH = {300: 170.0, 1200: 40.0, 1800: 25.0}
+
+# second radiation constant in nm K
+_C2 = 1.438777e7
+
+
+class WindowCache:
+    """Calibration and responsivity of every (grating, centre) window.
+
+    Each window is one npz file in the cache directory holding its
+    calibration polynomial, where it came from ('header' for the one
+    LightField wrote, 'lamp' for a reference lamp fit) and, once measured,
+    its responsivity per pixel. A lamp calibration is never replaced by a
+    header one.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory of the window files.
+
+    """
+
+    def __init__(self, cache_dir=WINDOW_CACHE):
+        self._cache_dir = cache_dir
+        self._windows = None
+
+    def _filename(self, grating, centre):
+        return os.path.join(self._cache_dir, 'g%d_c%.2f.npz'
+                            % (round(grating), centre))
+
+    def _load(self):
+        if self._windows is None:
+            self._windows = {}
+            for filename in glob.glob(os.path.join(self._cache_dir,
+                                                   'g*_c*.npz')):
+                with np.load(filename) as data:
+                    window = {name: data[name] for name in data.files}
+                key = (int(window['grating']), float(window['centre']))
+                self._windows[key] = window
+        return self._windows
+
+    def get(self, grating, centre):
+        """Returns the window dict ('grating', 'centre', 'coeff', 'order',
+        'xdim', 'source' and, if measured, 'responsivity') or None."""
+        return self._load().get((int(round(grating)),
+                                 round(float(centre), 2)))
+
+    def windows(self, grating):
+        """Returns the cached windows of a grating sorted by centre."""
+        return [window for key, window in sorted(self._load().items())
+                if key[0] == int(round(grating))]
+
+    def wavelength(self, grating, centre):
+        """Returns the cached wavelength axis of a window or None."""
+        window = self.get(grating, centre)
+        if window is None:
+            return None
+        return spe_calibration.get_calibration(
+            tuple(float(c) for c in window['coeff']), int(window['order']),
+            int(window['xdim'])).wavelength
+
+    def window_width(self, grating, centre):
+        """Returns the width in nm of the window of a grating at a centre,
+        from the cached window of the closest centre if there is one."""
+        windows = self.windows(grating)
+        if not windows:
+            return _nominal_width(grating)
+        window = min(windows, key=lambda w: abs(float(w['centre']) - centre))
+        wavelength = self.wavelength(grating, float(window['centre']))
+        return float(abs(wavelength[-1] - wavelength[0]))
+
+    def record_calibration(self, grating, centre, coeff, order, xdim,
+                           source='header'):
+        """Stores the calibration of a window, keeping its responsivity if
+        the pixel count is unchanged."""
+        window = dict(self.get(grating, centre) or {})
+        if 'xdim' in window and int(window['xdim']) == xdim:
+            if source == 'header' and str(window.get('source')) == 'lamp':
+                return
+        else:
+            window.pop('responsivity', None)
+        window.update(grating=int(round(grating)),
+                      centre=round(float(centre), 2),
+                      coeff=np.asarray(coeff, dtype=np.float64),
+                      order=int(order), xdim=int(xdim), source=source)
+        self._save(window)
+
+    def record_spe(self, spe_filename, grating=None, centre=None):
+        """Stores the calibration of a window from one of its SPE files,
+        taking the grating and centre from the header if not given."""
+        header = sperd.read_header(spe_filename)
+        grating = header['grating'] if grating is None else grating
+        centre = header['center_wavelength'] if centre is None else centre
+        self.record_calibration(grating, centre, header['polynom_coeff'],
+                                header['polynom_order'], header['xdim'])
+
+    def record_responsivity(self, grating, centre, responsivity):
+        """Stores the relative responsivity per pixel of a calibrated
+        window."""
+        window = self.get(grating, centre)
+        if window is None:
+            raise Exception("Window %d g/mm at %.2f nm is not calibrated"
+                            % (grating, centre))
+        responsivity = np.asarray(responsivity, dtype=np.float64)
+        if responsivity.shape != (int(window['xdim']),):
+            raise Exception("Responsivity does not match the window")
+        window = dict(window, responsivity=responsivity)
+        self._save(window)
+
+    def _save(self, window):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        filename = self._filename(window['grating'], window['centre'])
+        tmp_name = filename + '.tmp.npz'
+        np.savez(tmp_name, **window)
+        os.replace(tmp_name, filename)
+        self._load()[(window['grating'], window['centre'])] = window
+
+
+def plan_windows(wl_min, wl_max, grating, overlap=0.2, cache=None):
+    """Returns the centre wavelengths of the windows covering a range.
+
+    Parameters
+    ----------
+    wl_min, wl_max : float
+        The range in nm.
+    grating : int
+        The grating in g/mm.
+    overlap : float
+        Smallest overlap of neighbouring windows, as a fraction of the
+        window width.
+    cache : WindowCache, optional
+        Source of the window widths, NOMINAL_WIDTH otherwise.
+
+    Returns
+    -------
+    ndarray
+        The centres in nm, evenly spaced from the window starting at
+        wl_min to the window ending at wl_max.
+
+    """
+    if not 0 <= overlap < 1:
+        raise Exception("Overlap must be at least 0 and below 1")
+    (wl_min, wl_max) = sorted((wl_min, wl_max))
+
+    def width(centre):
+        if cache is None:
+            return _nominal_width(grating)
+        return cache.window_width(grating, centre)
+
+    first = wl_min + width(wl_min) / 2
+    if first + width(first) / 2 >= wl_max:
+        return np.array([(wl_min + wl_max) / 2])
+    # step windows forward to count them, then spread them evenly
+    centres = [first]
+    while centres[-1] + width(centres[-1]) / 2 < wl_max:
+        centres.append(centres[-1] + width(centres[-1]) * (1 - overlap))
+    last = wl_max - width(wl_max) / 2
+    return np.linspace(first, max(last, first), len(centres))
+
+
+def acquire_windows(lf, centres, grating, directory, filename, timeout=60,
+                    cache=None):
+    """Takes one SPE file per window through LightField.
+
+    Parameters
+    ----------
+    lf : pylightfield.LightField
+        The LightField connection, exposure and frames already set.
+    centres : sequence of float
+        Centre wavelengths in nm, see plan_windows.
+    grating : int
+        The grating in g/mm.
+    directory : str
+        The directory LightField saves to.
+    filename : str
+        Base name of the files, the centre is appended to it.
+    timeout : int
+        Acquisition timeout in seconds.
+    cache : WindowCache, optional
+        Records the calibration of every window.
+
+    Returns
+    -------
+    list of str
+        The SPE file of every window.
+
+    """
+    lf.set_directory(directory.rstrip("\\"))
+    lf.set_grating(grating)
+    spe_filenames = []
+    for centre in centres:
+        lf.set_centerwavelength(float(centre))
+        lf.set_filename("%s_%.2fnm" % (filename, centre))
+        lf.acquire(timeout)
+        newest_spe = max(glob.iglob(os.path.join(directory, '*.spe')),
+                         key=os.path.getctime)
+        if cache is not None:
+            cache.record_spe(newest_spe, grating, centre)
+        spe_filenames.append(newest_spe)
+    return spe_filenames
+
+
+def stitch(windows, step=None, trim=0, reference=None):
+    """Merges spectral windows onto a common wavelength grid.
+
+    Parameters
+    ----------
+    windows : list of tuple
+        (wavelength, spectrum) or (wavelength, spectrum, responsivity) of
+        every window.
+    step : float, optional
+        Grid step in nm, by default the finest pixel spacing.
+    trim : int
+        Pixels dropped at both edges of every window.
+    reference : int, optional
+        Window whose intensity the others are scaled to, by default the
+        one with the largest mean signal.
+
+    Returns
+    -------
+    dict
+        'wavelength' and 'spectrum' of the merged spectrum (NaN in gaps
+        between windows), 'scales' applied to every window, in the order
+        given, and 'overlap' points shared by every pair of neighbours.
+
+    """
+    if not windows:
+        raise Exception("No windows to stitch")
+    axes = []
+    spectra = []
+    for window in windows:
+        wavelength = np.asarray(window[0], dtype=np.float64)
+        spectrum = np.asarray(window[1], dtype=np.float64)
+        if len(window) > 2 and window[2] is not None:
+            spectrum = spectrum / np.where(window[2] > 0, window[2], np.nan)
+        if wavelength[-1] < wavelength[0]:
+            wavelength = wavelength[::-1]
+            spectrum = spectrum[::-1]
+        if trim:
+            wavelength = wavelength[trim:-trim]
+            spectrum = spectrum[trim:-trim]
+        axes.append(wavelength)
+        spectra.append(spectrum)
+    order = np.argsort([axis[0] for axis in axes])
+    if step is None:
+        step = min(float(np.median(np.diff(axis))) for axis in axes)
+    low = min(axis[0] for axis in axes)
+    high = max(axis[-1] for axis in axes)
+    grid = low + step * np.arange(int(np.floor((high - low) / step)) + 1)
+
+    # (windows, grid) resampled spectra, NaN outside each window, and
+    # blending weights rising linearly from the window edges
+    resampled = np.full((len(windows), grid.size), np.nan)
+    weights = np.zeros((len(windows), grid.size))
+    for row, i in enumerate(order):
+        axis = axes[i]
+        inside = (grid >= axis[0]) & (grid <= axis[-1])
+        resampled[row, inside] = np.interp(grid[inside], axis, spectra[i])
+        weights[row, inside] = np.minimum(grid[inside] - axis[0],
+                                          axis[-1] - grid[inside])
+    weights[np.isnan(resampled)] = 0
+
+    # least squares scale of every window onto its lower neighbour
+    lower = resampled[:-1]
+    upper = resampled[1:]
+    shared = np.isfinite(lower) & np.isfinite(upper)
+    overlap = shared.sum(axis=1)
+    numerator = np.where(shared, lower * upper, 0).sum(axis=1)
+    denominator = np.where(shared, upper * upper, 0).sum(axis=1)
+    ratios = np.where((overlap > 0) & (denominator > 0),
+                      numerator / np.where(denominator > 0, denominator, 1),
+                      1.0)
+    ratios = np.where(ratios > 0, ratios, 1.0)
+    scales = np.concatenate(([1.0], np.cumprod(ratios)))
+    if reference is None:
+        signal = [np.nanmean(spectra[i]) for i in order]
+        ref = int(np.argmax(signal))
+    else:
+        ref = int(np.flatnonzero(order == reference)[0])
+    scales /= scales[ref]
+
+    scaled = np.nan_to_num(resampled) * scales[:, np.newaxis]
+    total = weights.sum(axis=0)
+    merged = np.full(grid.size, np.nan)
+    covered = total > 0
+    merged[covered] = ((scaled * weights).sum(axis=0)[covered]
+                       / total[covered])
+    # single points exactly on a window edge have zero weight
+    edge = ~covered & np.isfinite(resampled).any(axis=0)
+    merged[edge] = np.nanmean(np.where(np.isfinite(resampled), scaled,
+                                       np.nan)[:, edge], axis=0)
+    unordered = np.empty(len(windows))
+    unordered[order] = scales
+    return {'wavelength': grid, 'spectrum': merged, 'scales': unordered,
+            'overlap': overlap}
+
+
+def stitch_files(spe_filenames, cache=None, rows=None, background=None,
+                 step=None, trim=0, reference=None, grating=None,
+                 centres=None):
+    """Merges the SPE files of a stitching run.
+
+    Every file is reduced to the mean over frames of the summed rows,
+    minus its master dark if a background engine is given, and divided by
+    the cached responsivity of its window if there is one. A cached lamp
+    calibration of the window replaces the calibration of the header.
+
+    Parameters
+    ----------
+    spe_filenames : list of str
+        One file per window.
+    cache : WindowCache, optional
+        Responsivity of the windows.
+    rows : tuple of int, optional
+        (start, stop) rows summed, all by default.
+    background : spe_background.BackgroundEngine, optional
+        Master darks subtracted from every file.
+    step, trim, reference
+        See stitch.
+    grating : int, optional
+        The grating of the run, from the headers by default.
+    centres : sequence of float, optional
+        The centre of every file, from the headers by default.
+
+    Returns
+    -------
+    dict
+        See stitch.
+
+    """
+    windows = []
+    for i, spe_filename in enumerate(spe_filenames):
+        with sperd.SPEFile(spe_filename) as spe:
+            roi = spe.read_roi(rows=rows)
+            image = roi.mean(axis=0, dtype=np.float64)
+            if background is not None:
+                master = background.master(spe_background.dark_key(spe))
+                if master is not None and master.shape == (spe.ydim,
+                                                           spe.xdim):
+                    (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+                    image -= master[r0:r1]
+            wavelength = np.array(spe.xaxis)
+        header = sperd.read_header(spe_filename)
+        window = None
+        if cache is not None:
+            window = cache.get(
+                header['grating'] if grating is None else grating,
+                header['center_wavelength'] if centres is None
+                else centres[i])
+        responsivity = None
+        if window is not None and 'responsivity' in window:
+            responsivity = window['responsivity']
+        if (window is not None and str(window.get('source')) == 'lamp'
+                and int(window['xdim']) == wavelength.size):
+            wavelength = cache.wavelength(window['grating'], window['centre'])
+        windows.append((wavelength, image.sum(axis=0), responsivity))
+    return stitch(windows, step, trim, reference)
+
+
+def blackbody(wavelength, temperature):
+    """Returns the Planck spectrum of a temperature (K) in relative units,
+    the reference of a tungsten halogen lamp for measure_responsivity."""
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    spectrum = 1 / (wavelength**5 * np.expm1(_C2 / (wavelength
+                                                    * temperature)))
+    return spectrum / spectrum.max()
+
+
+def measure_responsivity(spe_filename, reference, cache, grating=None,
+                         centre=None, rows=None, background=None):
+    """Measures the responsivity of a window from a reference lamp.
+
+    Parameters
+    ----------
+    spe_filename : str
+        The lamp taken in the window.
+    reference : callable or tuple
+        True lamp spectrum, reference(wavelength) or (wavelength,
+        spectrum), e.g. lambda wl: blackbody(wl, 3000).
+    cache : WindowCache
+        The cache the window and its responsivity are recorded in.
+    grating, centre : float, optional
+        The window, from the header by default.
+    rows, background
+        See stitch_files.
+
+    Returns
+    -------
+    ndarray
+        The responsivity per pixel, scaled to a median of 1.
+
+    """
+    header = sperd.read_header(spe_filename)
+    grating = header['grating'] if grating is None else grating
+    centre = header['center_wavelength'] if centre is None else centre
+    cache.record_spe(spe_filename, grating, centre)
+    with sperd.SPEFile(spe_filename) as spe:
+        image = spe.read_roi(rows=rows).mean(axis=0, dtype=np.float64)
+        if background is not None:
+            master = background.master(spe_background.dark_key(spe))
+            if master is not None and master.shape == (spe.ydim, spe.xdim):
+                (r0, r1, _) = slice(*(rows or (None,))).indices(spe.ydim)
+                image -= master[r0:r1]
+        wavelength = np.array(spe.xaxis)
+    if callable(reference):
+        true = reference(wavelength)
+    else:
+        order = np.argsort(reference[0])
+        true = np.interp(wavelength, np.asarray(reference[0])[order],
+                         np.asarray(reference[1])[order])
+    responsivity = image.sum(axis=0) / np.where(true > 0, true, np.nan)
+    responsivity = np.nan_to_num(responsivity / np.nanmedian(responsivity))
+    cache.record_responsivity(grating, centre, responsivity)
+    return responsivity
+
+
+def stitched_acquisition(lf, wl_min, wl_max, grating, directory, filename,
+                         overlap=0.2, cache=None, timeout=60, rows=None,
+                         background=None, output=None):
+    """Plans, acquires and merges a broadband spectrum.
+
+    Returns
+    -------
+    dict
+        See stitch, plus the 'files' taken. The merged spectrum is also
+        saved as two columns to output if given.
+
+    """
+    if cache is None:
+        cache = WindowCache()
+    centres = plan_windows(wl_min, wl_max, grating, overlap, cache)
+    spe_filenames = acquire_windows(lf, centres, grating, directory,
+                                    filename, timeout, cache)
+    result = stitch_files(spe_filenames, cache, rows, background,
+                          grating=grating, centres=centres)
+    result['files'] = spe_filenames
+    if output is not None:
+        np.savetxt(output, np.column_stack((result['wavelength'],
+                                            result['spectrum'])),
+                   delimiter=',', header='wavelength_nm,intensity')
+    return result
+
+
+def _nominal_width(grating):
+    if int(round(grating)) not in NOMINAL_WIDTH:
+        raise Exception("No window width known for %d g/mm" % grating)
+    return NOMINAL_WIDTH[int(round(grating))]
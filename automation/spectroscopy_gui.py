@@ -6,10 +6,12 @@ from lightfield_control_panel import LightFieldControlPanel
 from zaber_linear_actuator import ZaberLinearActuator
 from zaber_control_panel import ZaberControlPanel
 import spe2pngraw
+import spe_background
+import spe_cube
 import _thread
 import glob
 import os
-from time import sleep
+from time import sleep, strftime
 
 
 class SpectroscopyGUI(wx.Frame):
@@ -27,6 +29,7 @@ class SpectroscopyGUI(wx.Frame):
         self._zaber_init = False
         self._lcvr_swp = True
         self._zaber_swp = True
+        self._background = spe_background.BackgroundEngine()
 
         main_panel = wx.Panel(self)
         main_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -431,6 +434,24 @@ class SpectroscopyGUI(wx.Frame):
 
     def _automation(self, channel):
         self._lf.set_directory(self._filedir.rstrip("\\"))
+        darks = glob.glob(self._filedir + 'back*.spe')
+        if darks:
+            try:
+                self._background.add_darks(darks)
+            except Exception as err:
+                print('ERROR function _automation: %s\n' % err)
+                # scan on without subtracting a dark
+                self._background = spe_background.BackgroundEngine()
+        # every acquisition of the scan is also appended to one cube, a new
+        # one per run so reruns under the same name never mix
+        cube_base = (self._filedir + (self._truefilename or "scan") + "_"
+                     + strftime("%Y%m%d-%H%M%S"))
+        cube_filename = cube_base + ".cube"
+        run = 1
+        while os.path.exists(cube_filename + ".json"):
+            run += 1
+            cube_filename = "%s_%d.cube" % (cube_base, run)
+        cube = None
         start_volt = self.get_start_volt()
         if self._lcvr_swp is True:
             end_volt = self.get_end_volt()
@@ -482,7 +503,14 @@ class SpectroscopyGUI(wx.Frame):
                 self._lf.acquire(60)
                 self._lf.set_filename(self._filename)
                 newest_spe = max(glob.iglob(self._filedir + '*.spe'), key=os.path.getctime)
-                spe2pngraw.spe2pngraw(self._filedir, newest_spe)
+                spe2pngraw.spe2pngraw(self._filedir, newest_spe,
+                                      background=self._background)
+                try:
+                    if cube is None:
+                        cube = spe_cube.open_cube(cube_filename, newest_spe)
+                    cube.append_spe(newest_spe, self._background)
+                except Exception as err:
+                    print(err)
                 newest_png = newest_spe.rstrip('.spe') + '.png'
                 self._img = wx.Image(newest_png, wx.BITMAP_TYPE_ANY).ConvertToBitmap()
                 wx.CallAfter(self._display.SetBitmap, self._img)
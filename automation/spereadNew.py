@@ -1,5 +1,8 @@
 import numpy as np
 import os.path
+import queue
+import threading
+import spe_calibration
 
 def datatype_to_string(datatype):
     switcher = {
@@ -65,8 +68,9 @@ def spereadJanis(filename):
     calib_value = np.fromfile(file,'double',10)
     calib_value = calib_value[0:calib_count-1]
     polynom_coeff = np.fromfile(file,'double',6)
-    xindex = np.arange(0,xDim)
-    xaxis = polynom_coeff[0] + xindex*polynom_coeff[1] + pow(xindex,2)*polynom_coeff[2]
+    calibration = spe_calibration.get_calibration(
+        tuple(polynom_coeff), polynom_order, xDim)
+    xaxis = np.array(calibration.wavelength)
     
     # read in the image data
     file.seek(4100,0) # move  pointer to start of data
@@ -88,3 +92,339 @@ def spereadJanis(filename):
     file.close()
     image.shape = (NumFrames,yDim,xDim)
     return (image,xaxis,error_code,message)
+
+
+# Layout of the 4100 byte WinView/LightField SPE header. Only the fields
+# used by the automation scripts are named, everything else is padding.
+SPE_HEADER_SIZE = 4100
+SPE_HEADER_DTYPE = np.dtype({
+    'names': ['xDimDet', 'exp_sec', 'yDimDet', 'DetTemperature', 'xdim',
+              'SpecCenterWlNm', 'datatype', 'ADCoffset', 'ADCrate',
+              'ADCtype', 'ADCresolution', 'ADCbitAdjust', 'gain',
+              'SpecGrooves', 'ydim', 'NumFrames', 'NumROI', 'ROIinfblk',
+              'polynom_order', 'calib_count', 'pixel_position',
+              'calib_value', 'polynom_coeff', 'lastvalue'],
+    'formats': ['<u2', '<f4', '<u2', '<f4', '<u2',
+                '<f4', '<i2', '<u2', '<u2',
+                '<u2', '<u2', '<u2', '<u2',
+                '<f4', '<u2', '<i4', '<i2', ('<u2', (10, 6)),
+                'u1', 'u1', ('<f8', 10),
+                ('<f8', 10), ('<f8', 6), '<i2'],
+    'offsets': [6, 10, 18, 36, 42,
+                72, 108, 188, 190,
+                192, 194, 196, 198,
+                650, 656, 1446, 1510, 1512,
+                3101, 3102, 3103,
+                3183, 3263, 4098],
+    'itemsize': SPE_HEADER_SIZE,
+    })
+
+
+def read_header(filename):
+    """Reads only the header of an SPE file.
+
+    Parameters
+    ----------
+    filename : str
+        Full path name for the file to be read.
+
+    Returns
+    -------
+    dict
+        The image dimensions, datatype, frame count, calibration
+        polynomial, detector size and spectrometer settings of the file.
+
+    """
+    header = np.fromfile(filename, SPE_HEADER_DTYPE, 1)
+    if header.size != 1:
+        raise Exception("Corrupt header in SPE file %s" % filename)
+    return _header_dict(header[0])
+
+
+def parse_header(data):
+    """Parses the header fields of read_header from the 4100 header
+    bytes of an SPE file."""
+    if len(data) < SPE_HEADER_SIZE:
+        raise Exception("Corrupt SPE header")
+    return _header_dict(np.frombuffer(data, SPE_HEADER_DTYPE, 1)[0])
+
+
+def patch_calibration(data, coeff, order):
+    """Returns header bytes with a new calibration polynomial.
+
+    Parameters
+    ----------
+    data : bytes
+        The 4100 header bytes of an SPE file.
+    coeff : sequence of float
+        Up to six polynomial coefficients, lowest order first.
+    order : int
+        The polynomial order.
+
+    """
+    header = np.frombuffer(data[:SPE_HEADER_SIZE], SPE_HEADER_DTYPE,
+                           1).copy()
+    header['polynom_order'] = order
+    header['polynom_coeff'] = _coefficients(coeff)
+    return header.tobytes() + bytes(data[SPE_HEADER_SIZE:])
+
+
+def write_calibration(filename, coeff, order):
+    """Replaces the calibration polynomial of an SPE file in place,
+    leaving the rest of the header and the data untouched."""
+    fields = SPE_HEADER_DTYPE.fields
+    with open(filename, 'r+b') as file:
+        file.seek(fields['polynom_order'][1])
+        file.write(np.array(order, fields['polynom_order'][0]).tobytes())
+        file.seek(fields['polynom_coeff'][1])
+        file.write(_coefficients(coeff).tobytes())
+
+
+def _coefficients(coeff):
+    coeff = np.asarray(coeff, dtype='<f8').reshape(-1)
+    if coeff.size > 6:
+        raise Exception("An SPE calibration has at most 6 coefficients")
+    return np.concatenate((coeff, np.zeros(6 - coeff.size, '<f8')))
+
+
+def _header_dict(header):
+    return {
+        'xdim': int(header['xdim']),
+        'ydim': int(header['ydim']),
+        'num_frames': int(header['NumFrames']),
+        'datatype': int(header['datatype']),
+        'datatype_str': datatype_to_string(int(header['datatype'])),
+        'polynom_order': int(header['polynom_order']),
+        'polynom_coeff': tuple(float(c) for c in header['polynom_coeff']),
+        'xDimDet': int(header['xDimDet']),
+        'yDimDet': int(header['yDimDet']),
+        'exposure': float(header['exp_sec']),
+        'center_wavelength': float(header['SpecCenterWlNm']),
+        'grating': float(header['SpecGrooves']),
+        }
+
+
+class SPEFile:
+    """Read-only, memory-mapped view of an SPE file.
+
+    The header is parsed once into ``SPE_HEADER_DTYPE`` and the data block
+    is exposed as a ``np.memmap`` of shape (NumFrames, yDim, xDim), so
+    opening a file costs the same regardless of its size and only the
+    pages which are sliced are ever read from disk.
+
+    Parameters
+    ----------
+    filename : str
+        Full path name for the file to be read.
+
+    """
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise Exception("SPE file %s does not exist" % filename)
+        header = np.fromfile(filename, SPE_HEADER_DTYPE, 1)
+        if header.size != 1:
+            raise Exception("Corrupt header in SPE file %s" % filename)
+        self.filename = filename
+        self.header = header[0]
+        self.xdim = int(self.header['xdim'])
+        self.ydim = int(self.header['ydim'])
+        self.num_frames = int(self.header['NumFrames'])
+        datatype_str = datatype_to_string(int(self.header['datatype']))
+        if datatype_str == "invalid":
+            raise Exception("Invalid datatype in SPE file %s" % filename)
+        self.dtype = np.dtype(datatype_str).newbyteorder('<')
+        shape = (self.num_frames, self.ydim, self.xdim)
+        data_size = self.dtype.itemsize * self.num_frames * self.ydim * self.xdim
+        if os.path.getsize(filename) < SPE_HEADER_SIZE + data_size:
+            raise Exception("Less data points than expected in SPE file %s"
+                            % filename)
+        self.data = np.memmap(filename, dtype=self.dtype, mode='r',
+                              offset=SPE_HEADER_SIZE, shape=shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def polynom_coeff(self):
+        return tuple(float(c) for c in self.header['polynom_coeff'])
+
+    @property
+    def polynom_order(self):
+        return int(self.header['polynom_order'])
+
+    @property
+    def calibration(self):
+        """The shared spe_calibration.Calibration of the file."""
+        return spe_calibration.get_calibration(
+            self.polynom_coeff, self.polynom_order, self.xdim)
+
+    @property
+    def xaxis(self):
+        """The read-only wavelength axis of the full stored polynomial."""
+        return self.calibration.wavelength
+
+    def iter_frames(self, chunk_frames=16, readahead=2):
+        """Yields (frame_index, frame_array) for every frame in the file.
+
+        Frames are read in chunks, see ``iter_chunks``. The yielded arrays
+        are views into the current chunk and must be copied if they are
+        kept past the next iteration.
+
+        Parameters
+        ----------
+        chunk_frames : int
+            Number of frames read from disk at a time.
+        readahead : int
+            Number of chunks read ahead of the consumer, 0 reads
+            synchronously.
+
+        """
+        for start, chunk in self.iter_chunks(chunk_frames, readahead):
+            for i in range(chunk.shape[0]):
+                yield start + i, chunk[i]
+
+    def iter_chunks(self, chunk_frames=16, readahead=2):
+        """Yields (first_frame_index, frames) blocks of the file in order.
+
+        Chunks of ``chunk_frames`` frames are read by a background thread
+        which stays at most ``readahead`` chunks ahead of the consumer, so
+        memory use is bounded by ``(readahead + 2) * chunk_frames`` frames
+        whatever the file size.
+
+        """
+        chunk_frames = max(1, int(chunk_frames))
+        if readahead <= 0:
+            yield from self._read_chunks(chunk_frames)
+            return
+        chunks = queue.Queue(maxsize=readahead)
+        stop = threading.Event()
+
+        def put(item):
+            # give up once the consumer has gone away
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                for item in self._read_chunks(chunk_frames):
+                    if not put(item):
+                        return
+                put(None)
+            except Exception as err:
+                put(err)
+
+        reader = threading.Thread(target=producer, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+
+    def _read_chunks(self, chunk_frames):
+        # read consecutive frame blocks straight into fresh buffers
+        frame_shape = (self.ydim, self.xdim)
+        frame_bytes = self.dtype.itemsize * self.ydim * self.xdim
+        with open(self.filename, 'rb') as file:
+            file.seek(SPE_HEADER_SIZE)
+            for start in range(0, self.num_frames, chunk_frames):
+                count = min(chunk_frames, self.num_frames - start)
+                chunk = np.empty((count,) + frame_shape, self.dtype)
+                if file.readinto(chunk) != count * frame_bytes:
+                    raise Exception("Less data points than expected in "
+                                    "SPE file %s" % self.filename)
+                yield start, chunk
+
+    def read_roi(self, frames=None, rows=None, cols=None, binning=(1, 1)):
+        """Reads a region of interest of some frames, optionally binned.
+
+        Only the rows of the region are read from disk, with one readinto
+        call per frame (or a single one if the rows span whole frames).
+        Column windows are cut from those rows in memory: a detector row
+        is smaller than a page, so skipping columns would not save any
+        I/O.
+
+        Parameters
+        ----------
+        frames : int or slice, optional
+            Frames to read, all by default.
+        rows, cols : tuple of int, optional
+            Half open (start, stop) pixel ranges, the full axis by default.
+        binning : tuple of int
+            (rows, cols) software binning factor. Binned pixels are summed
+            into float32 and a partial bin at the end is dropped.
+
+        Returns
+        -------
+        ndarray
+            (frames, rows, cols) in the file datatype, or float32 if
+            binned.
+
+        """
+        if frames is None:
+            frames = slice(None)
+        if isinstance(frames, slice):
+            frame_list = range(*frames.indices(self.num_frames))
+        else:
+            frame = range(self.num_frames)[frames]
+            frame_list = range(frame, frame + 1)
+        r0, r1, _ = slice(*(rows or (None,))).indices(self.ydim)
+        c0, c1, _ = slice(*(cols or (None,))).indices(self.xdim)
+        nrows = max(0, r1 - r0)
+        frame_items = self.ydim * self.xdim
+        roi = np.empty((len(frame_list), nrows, self.xdim), self.dtype)
+        with open(self.filename, 'rb') as file:
+            if nrows == self.ydim and frame_list.step == 1 and frame_list:
+                # whole consecutive frames are one contiguous block
+                file.seek(SPE_HEADER_SIZE + self.dtype.itemsize
+                          * frame_list.start * frame_items)
+                file.readinto(roi)
+            else:
+                for i, frame in enumerate(frame_list):
+                    file.seek(SPE_HEADER_SIZE + self.dtype.itemsize
+                              * (frame * frame_items + r0 * self.xdim))
+                    file.readinto(roi[i])
+        roi = roi[:, :, c0:c1]
+        (by, bx) = binning
+        if by == 1 and bx == 1:
+            return roi
+        ny = roi.shape[1] // by
+        nx = roi.shape[2] // bx
+        roi = roi[:, :ny * by, :nx * bx].astype(np.float32)
+        return roi.reshape(roi.shape[0], ny, by, nx, bx).sum(axis=(2, 4))
+
+    def roi_xaxis(self, cols=None, bin_cols=1):
+        """Returns the wavelength axis matching read_roi(cols, binning)."""
+        c0, c1, _ = slice(*(cols or (None,))).indices(self.xdim)
+        xaxis = self.xaxis[c0:c1]
+        n = xaxis.size // bin_cols
+        return xaxis[:n * bin_cols].reshape(n, bin_cols).mean(axis=1)
+
+    def close(self):
+        """Releases the memory map. Arrays sliced from it stay valid."""
+        self.data = None
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import spereadNew as sperd
+
+
+def _write_spe(filename, data, coeff=(700.0, 0.09, -1e-6), order=2):
+    # minimal uint16 SPE 2.x file of (frames, rows, columns) data
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    (frames, ydim, xdim) = data.shape
+    header = np.zeros(1, sperd.SPE_HEADER_DTYPE)
+    header['xdim'] = xdim
+    header['ydim'] = ydim
+    header['NumFrames'] = frames
+    header['datatype'] = 3
+    header['xDimDet'] = xdim
+    header['yDimDet'] = ydim
+    header['exp_sec'] = 1.0
+    header['SpecCenterWlNm'] = 770.0
+    header['polynom_coeff'] = np.concatenate((coeff, np.zeros(6 - len(coeff))))
+    header['polynom_order'] = order
+    header['calib_count'] = 3
+    header['lastvalue'] = 0x5555
+    with open(filename, 'wb') as file:
+        file.write(header.tobytes())
+        file.write(np.clip(np.rint(data), 0, 65535).astype('<u2').tobytes())
+    return filename
+
+
+@pytest.fixture
+def write_spe():
+    return _write_spe
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pytest
+import power_analysis
+
+
+def _peak(height, xdim=64, rows=4):
+    x = np.arange(xdim)
+    line = 100 + height / (1 + ((x - 32) / 2.0)**2)
+    return np.tile(line, (rows, 1))
+
+
+def _series(tmp_path, write_spe, names, heights):
+    return [write_spe(os.path.join(tmp_path, name + '.spe'), _peak(height))
+            for name, height in zip(names, heights)]
+
+
+def _voltage_run(tmp_path, write_spe):
+    # one fixed power per run, the excitation is swept with the LCVR
+    voltages = [1.0, 1.2, 1.4, 1.6, 1.8, 2.0]
+    heights = [10, 12, 15, 300, 3000, 4000]
+    names = ['s_OD0_770nm_5mW_%gV' % v for v in voltages]
+    return _series(tmp_path, write_spe, names[::-1], heights[::-1])
+
+
+def test_fixed_power_axis_finds_no_threshold(tmp_path, write_spe):
+    files = _voltage_run(tmp_path, write_spe)
+    result = power_analysis.analyse_series(files, cache_dir=None)
+    assert result['threshold'] is None
+
+
+def test_voltage_axis_orders_and_finds_threshold(tmp_path, write_spe):
+    files = _voltage_run(tmp_path, write_spe)
+    result = power_analysis.analyse_series(files, cache_dir=None,
+                                           axis='voltage')
+    assert result['unit'] == 'V'
+    assert np.all(np.diff(result['excitation']) > 0)
+    assert 1.4 < result['threshold']['excitation'] < 1.8
+
+
+def test_transmission_curve_axis(tmp_path, write_spe):
+    files = _voltage_run(tmp_path, write_spe)
+    # transmission falling with voltage reverses the order
+    curve = ([1.0, 2.0], [5.0, 0.5])
+    result = power_analysis.analyse_series(files, cache_dir=None,
+                                           axis=curve)
+    assert result['unit'] == 'mW'
+    assert np.all(np.diff(result['excitation']) > 0)
+    assert np.all(np.diff(result['voltage']) < 0)
+
+
+def test_detection_od_scales_intensity(tmp_path, write_spe):
+    files = _series(tmp_path, write_spe,
+                    ['s_OD0_770nm_5mW_1V', 's_OD1_770nm_5mW_1V'],
+                    [2000, 200])
+    result = power_analysis.analyse_series(files, power=False,
+                                           cache_dir=None,
+                                           od_filter='detection')
+    assert result['excitation'] == pytest.approx([5, 5])
+    (plain, filtered) = result['intensity']
+    assert filtered == pytest.approx(plain, rel=0.02)
+
+
+def test_excitation_od_scales_power(tmp_path, write_spe):
+    files = _series(tmp_path, write_spe,
+                    ['s_OD0_770nm_5mW_1V', 's_OD1_770nm_5mW_1V'],
+                    [2000, 200])
+    result = power_analysis.analyse_series(files, power=False,
+                                           cache_dir=None,
+                                           od_filter='excitation')
+    assert result['excitation'] == pytest.approx([5, 0.5])
+    assert result['intensity'][1] == pytest.approx(
+        result['intensity'][0] / 10, rel=0.05)
+
+
+def test_voltage_axis_rejects_excitation_od(tmp_path, write_spe):
+    files = _voltage_run(tmp_path, write_spe)
+    with pytest.raises(Exception):
+        power_analysis.analyse_series(files, cache_dir=None, axis='voltage',
+                                      od_filter='excitation')
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+import spe_cosmic
+import spe_reduce
+
+
+def _frames(count, rng, line_sigma=None):
+    # (count, 100, 200) frames of shot and read noise on a 500 count
+    # level, with a line one column wide extending line_sigma rows
+    frames = 500 + rng.normal(0, np.sqrt(525), (count, 100, 200))
+    if line_sigma is not None:
+        rows = np.arange(100)
+        frames[:, :, 100] += 5000 * np.exp(-0.5 * ((rows - 50)
+                                                    / line_sigma)**2)
+    return frames.astype(np.float32)
+
+
+@pytest.mark.parametrize('sigma', [1, 2, 3, 4, 6])
+def test_single_frame_keeps_narrow_line(sigma):
+    stack = _frames(1, np.random.default_rng(1), sigma)
+    (spikes, _) = spe_cosmic.find_cosmic_rays(stack)
+    assert not spikes.any()
+
+
+def test_single_frame_finds_hits_next_to_line():
+    rng = np.random.default_rng(2)
+    stack = _frames(1, rng, 3)
+    hits = np.zeros(stack.shape, dtype=bool)
+    ys = rng.integers(0, 100, 40)
+    xs = rng.integers(0, 200, 40)
+    xs[xs == 100] = 102
+    hits[0, ys, xs] = True
+    stack[hits] += 4000
+    (spikes, _) = spe_cosmic.find_cosmic_rays(stack)
+    assert np.array_equal(spikes, hits)
+
+
+def test_two_frames_noise_level():
+    rng = np.random.default_rng(3)
+    stack = _frames(2, rng)
+    stack[0, 50, 50] += 250
+    (spikes, _) = spe_cosmic.find_cosmic_rays(stack)
+    assert spikes.sum() == 1 and spikes[0, 50, 50]
+
+
+def test_reduce_counts_every_spike_once(tmp_path, write_spe):
+    rng = np.random.default_rng(4)
+    frames = _frames(17, rng, 3)
+    # one hit per frame, the last frame alone in its chunk
+    frames[np.arange(17), rng.integers(0, 100, 17),
+           rng.integers(0, 90, 17)] += 4000
+    filename = write_spe(os.path.join(tmp_path, 'kinetics.spe'), frames)
+    correction = spe_cosmic.CosmicRayFilter()
+    result = spe_reduce.reduce_frames(filename, sigma=3, median=True,
+                                      correction=correction,
+                                      chunk_frames=16)
+    assert correction.spikes == 17
+    assert np.abs(result['mean'] - np.round(frames).mean(axis=0))[
+        :, 90:].max() < 1e-3
@@ -0,0 +1,30 @@
+import numpy as np
+import spe_peakfit
+
+
+def _spectra(model, count=500, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-10, 10, 200)
+    params = np.stack([rng.uniform(100, 1000, count),
+                       rng.uniform(-3, 3, count),
+                       rng.uniform(0.5, 3, count),
+                       rng.uniform(0, 50, count)], axis=1)
+    values, _ = spe_peakfit.evaluate(model, x, params, jacobian=False)
+    return x, params, values + rng.normal(0, 1, values.shape)
+
+
+def test_fits_at_the_optimum_are_converged():
+    for model in ('lorentzian', 'gaussian'):
+        (x, params, spectra) = _spectra(model)
+        result = spe_peakfit.fit_peaks(x, spectra, model)
+        assert result['converged'].all()
+        assert not result['stalled'].any()
+        assert np.abs(result['center'] - params[:, 1]).max() < 0.02
+
+
+def test_pseudo_voigt_mixing_held_on_its_bound():
+    (x, params, spectra) = _spectra('lorentzian')
+    result = spe_peakfit.fit_peaks(x, spectra, 'pseudo_voigt')
+    assert result['converged'].all()
+    assert result['iterations'].max() < 30
+    assert np.median(result['eta']) == 1